@@ -21,13 +21,23 @@ from app.db.mongodb import (
     embeddings_collection,
     client,
     Document,
-    save_document_embedding
+    save_document_embedding,
+    SHARED_CONTENT_OWNER,
+    release_shared_content,
+    release_user_shared_content
 )
 from app.models.schemas import User
 
 # Utils and services
-from app.utils.embeddings import get_embedding, get_embeddings_batch, cosine_similarity
+from app.utils.embeddings import query_embedding_cache
+from app.utils.embedding_cache import embedding_cache
+from app.utils.rate_limiter import rate_limiter_stats
+from app.utils.token_counter import token_counter
 from app.api.routes.core import process_large_document, generate_and_store_embeddings, get_current_user
+from app.services.vector_store import forget_document_vectors
+from app.services.vector_cache import vector_cache
+from app.services.knowledge_index import kb_index
+from app.services.embedding_migration import list_migrations
 
 logger = logging.getLogger(__name__)
 
@@ -117,6 +127,9 @@ async def reset_user_data(
     try:
         # Sequentially delete and log counts for better debugging and confirmation
         
+        # Drop the users' references to shared content before their document rows go
+        for content_hash in await release_user_shared_content(usernames):
+            forget_document_vectors(SHARED_CONTENT_OWNER, content_hash)
         docs_res = await documents_collection.delete_many(delete_query)
         deleted_counts["active_documents"] = docs_res.deleted_count
 
@@ -128,6 +141,8 @@ async def reset_user_data(
 
         embeddings_res = await embeddings_collection.delete_many(delete_query)
         deleted_counts["embedding_records"] = embeddings_res.deleted_count
+        for username in usernames:
+            forget_document_vectors(username)
 
         usage_res = await usage_collection.delete_many(delete_query)
         deleted_counts["usage_logs"] = usage_res.deleted_count
@@ -144,6 +159,22 @@ async def reset_user_data(
         logger.error(f"Error resetting user data for {usernames}: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="An error occurred while resetting user data.")
 
+@router.get("/cache-stats", response_model=Dict[str, Any])
+async def get_cache_stats(admin_user: User = Depends(admin_required)):
+    """Hit rates and sizes of this worker's embedding and token count caches and rate limiters."""
+    return {
+        "embedding_cache": embedding_cache.stats(),
+        "query_embedding_cache": query_embedding_cache.stats(),
+        "vector_cache": vector_cache.stats(),
+        "rate_limiters": rate_limiter_stats(),
+        "token_counter": token_counter.stats(),
+    }
+
+@router.get("/embedding-migrations", response_model=List[Dict[str, Any]])
+async def get_embedding_migrations(admin_user: User = Depends(admin_required)):
+    """Progress of re-embedding migrations (run with migrate_embedding_model.py), newest first."""
+    return await list_migrations()
+
 @router.get("/usage", response_model=List[UsageOut])
 async def get_usage_stats(
     include_historical: bool = Query(False, description="Include deleted/archived documents in counts"),
@@ -320,6 +351,7 @@ async def upload_knowledge_document(
             # Generate and store embeddings
             try:
                 await generate_and_store_embeddings(document_obj)
+                await kb_index.rebuild()
             except Exception as e:
                 logger.error(f"Error generating embeddings: {e}", exc_info=True)
                 raise HTTPException(
@@ -419,6 +451,10 @@ async def delete_knowledge_document(
                 )
                 
                 logger.info(f"Deleted {result.deleted_count} embeddings for document {file_hash}")
+        forget_document_vectors("admin_knowledge_base", file_hash)
+        if document.get("content_ref") and await release_shared_content(document["content_ref"]):
+            forget_document_vectors(SHARED_CONTENT_OWNER, document["content_ref"])
+        await kb_index.remove_document(file_hash)
         
         return {
             "success": True,
@@ -481,10 +517,13 @@ async def delete_user(username: str, admin_user: User = Depends(admin_required))
 
     try:
         # Perform deletions across all relevant collections
+        for content_hash in await release_user_shared_content([username]):
+            forget_document_vectors(SHARED_CONTENT_OWNER, content_hash)
         await users_collection.delete_one({"username": username})
         await documents_collection.delete_many({"user_id": username})
         await chat_history_collection.delete_many({"user_id": username})
         await embeddings_collection.delete_many({"user_id": username})
+        forget_document_vectors(username)
         
         return
         
@@ -4,6 +4,7 @@ from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 from typing import List, Optional, Dict, Any
 from datetime import datetime, timedelta
+from contextlib import asynccontextmanager
 import hashlib
 import json
 import tempfile
@@ -12,25 +13,44 @@ import os
 import pickle
 import numpy as np
 import asyncio
-import re
-import fitz  # PyMuPDF for PDF processing
+import time
+import uuid
 import docx
 from io import BytesIO
 from dotenv import load_dotenv
 from app.models.schemas import WelcomeResponse
 from app.utils.guardrails import validate_user_input
-from app.services.ocr_service import OCRService , split_pdf_to_pages
+from app.services.ocr_service import OCRService , is_digital_pdf
+from app.services.ingestion_pipeline import run_ingestion_pipeline
+from app.services.chunk_reuse import PreviousUpload, find_previous_upload, embed_chunks
+from app.utils.hashing import chunk_content_hash
+from app.utils.chunking import document_chunker
+from app.services.page_index import page_references, page_context
 from app.services.chat_session import chat_session_manager
-import tiktoken
+from app.services.vector_store import save_document_vectors, forget_document_vectors
+from app.services.knowledge_index import kb_index
+from app.services.ingestion_jobs import (
+    enqueue_file, wait_for_jobs, job_status, get_job, list_jobs, report_progress, JOB_SUCCEEDED
+)
+from app.config import INGESTION_WAIT_TIMEOUT, INGESTION_LEASE_SECONDS, INGESTION_POLL_INTERVAL
+from app.utils.embedding_codec import encode_embedding
+from app.utils.bm25 import tokenize
+from app.utils.faq_features import boost_scores, BLANK, COMPANY_INFO, HEADER
+from app.utils.similarity import top_k_indices
+from app.utils.rate_limiter import get_rate_limiter, estimate_tokens
+from app.utils.token_counter import token_counter
 from app.db.mongodb import (
     get_user, create_user, update_user_last_login,
     save_document, get_document, save_chat_message,
     get_user_chat_history, save_document_embedding,
     get_document_embeddings, User, Document, ChatMessage,
     DocumentEmbedding, documents_collection, chat_history_collection,
-    embeddings_collection, usage_collection, deleted_documents_collection
+    embeddings_collection, usage_collection, deleted_documents_collection,
+    ingestion_jobs_collection, SHARED_CONTENT_OWNER,
+    acquire_shared_content, release_shared_content, claim_shared_content,
+    renew_shared_content_claim, abandon_shared_content_claim, publish_shared_content
 )
-from app.utils.embeddings import get_embedding, cosine_similarity
+from app.utils.embeddings import EmbeddingService, EmbeddingError, embedding_service
 from fastapi import APIRouter, Depends, HTTPException, status
 from typing import List, Dict, Any # Ensure all are imported
 from datetime import datetime, timedelta
@@ -62,6 +82,8 @@ load_dotenv()
 # Initialize OpenAI client
 
 openai_client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# 429 retries are handled by the shared rate limiter
+limited_openai_client = openai_client.with_options(max_retries=0)
 # Update model name to a valid one
 MODEL_NAME = "gpt-4o-mini"  # or "gpt-4" if you have access
 
@@ -76,11 +98,15 @@ pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 # Initialize OCR service
-tokenizer = tiktoken.encoding_for_model(MODEL_NAME)
 ocr_service = OCRService()
 
 # Constants
 MAX_FILE_SIZE_MB = 500  # Increased to 500MB
+EMBEDDING_INSERT_BATCH = 500  # Chunk rows per insert_many
+CHAT_OUTPUT_TOKEN_ESTIMATE = 1000  # Completion tokens reserved with the rate limiter per chat answer
+FAQ_ANN_CANDIDATES = 200  # Chunks shortlisted by the KB index before FAQ boosting
+FAQ_LEXICAL_WEIGHT = 0.5  # Boost for the best BM25 match (same cap as the old word-overlap boost)
+FAQ_MAX_MATCHES = 50  # Ranked matches kept; context assembly never reads past the first ~20
 MAX_FILE_SIZE_BYTES = MAX_FILE_SIZE_MB * 1024 * 1024  # Convert to bytes
 
 # Pricing constants (per million tokens or per page)
@@ -137,109 +163,203 @@ def calculate_file_hash(file_path: str) -> str:
     return hash_md5.hexdigest()
 
 def text_to_chunks(text: str) -> List[str]:
+    """Splits document text into token-budgeted chunks (see app.utils.chunking.TokenChunker)."""
+    return document_chunker.split(text)
+
+async def generate_and_store_embeddings(document: Document, previous: Optional[PreviousUpload] = None) -> int:
     """
-    Splits text into semantic chunks while preserving all content.
-    First tries to split by headings, then falls back to paragraphs, then sentences.
+    Generate and store embeddings for document chunks (unchanged chunks of `previous` are copied).
+    Returns the number of chunk rows the document has. Shared content (SHARED_CONTENT_OWNER) must
+    only be embedded by the holder of its claim, and errors are raised so partial rows are never published.
     """
-    if not text or not text.strip():
-        return []
-        
-    # Clean up the text first
-    text = text.replace('\r\n', '\n').replace('\r', '\n').strip()
-    
-    # Try to split by numbered sections first (e.g., "1. Title" or "## 2. Title")
-    section_regex = r'(\n|^)\s*(?:##\s*)?(?:\d{1,2}\.\s+.*?)(?=\n\s*(?:##\s*)?(?:\d{1,2}\.|\Z))'
-    sections = re.split(section_regex, text, flags=re.DOTALL)
-    
-    # If we found sections, clean them up
-    if len(sections) > 1:
-        chunks = [s.strip() for s in sections if s.strip()]
-        # Join section numbers with their content
-        chunks = [f"{chunks[i]} {chunks[i+1]}" for i in range(0, len(chunks)-1, 2)]
-        if len(chunks) >= 3:  # If we have at least 1.5 sections
-            return chunks
-    
-    # If no sections found or too few, try splitting by double newlines (paragraphs)
-    paragraphs = [p.strip() for p in text.split('\n\n') if p.strip()]
-    if len(paragraphs) > 1:
-        return paragraphs
-    
-    # If no paragraphs, try splitting by single newlines
-    lines = [line.strip() for line in text.split('\n') if line.strip()]
-    if lines:
-        return lines
-    
-    # As a last resort, split by sentences
-    sentences = [s.strip() for s in re.split(r'(?<=[.!?])\s+', text) if s.strip()]
-    if sentences:
-        return sentences
-    
-    # If all else fails, return the entire text as one chunk
-    return [text] if text.strip() else []
-
-def count_tokens(text: str) -> int:
-    """Counts the number of tokens in a given text using the model's tokenizer."""
-    if not text:
-        return 0
-    return len(tokenizer.encode(text))
-async def generate_and_store_embeddings(document: Document):
-    """Generate and store embeddings for document chunks."""
     try:
-        # Skip if document already has embeddings for this user
+        # Chunks of shared content are embedded once, under SHARED_CONTENT_OWNER (see store_document)
+        if document.content_ref:
+            logger.info(f"Document {document.file_hash} of user {document.user_id} uses shared content; nothing to embed")
+            return 0
+
+        # Split content into chunks off the event loop, keeping the page and token count of each
+        paged_chunks = await asyncio.to_thread(document_chunker.split_with_counts, document.content)
+        chunks = [chunk for _, chunk, _ in paged_chunks]
+        chunk_tokens = [tokens for _, _, tokens in paged_chunks]
+
+        # Skip if a complete set of rows exists; rows of an interrupted run are replaced
         existing_embeddings = await embeddings_collection.count_documents({
             "document_hash": document.file_hash,
             "user_id": document.user_id
         })
-        if existing_embeddings > 0:
+        if existing_embeddings and existing_embeddings == len(chunks):
             logger.info(f"Document {document.file_hash} already has {existing_embeddings} embeddings for user {document.user_id}")
-            return
-        
-        # Split content into chunks
-        chunks = text_to_chunks(document.content)
+            return existing_embeddings
+        if existing_embeddings:
+            logger.warning(f"Document {document.file_hash} has {existing_embeddings} of {len(chunks)} embeddings "
+                           f"for user {document.user_id}; embedding it again")
+            await embeddings_collection.delete_many({"document_hash": document.file_hash, "user_id": document.user_id})
         logger.info(f"Generated {len(chunks)} chunks for document {document.file_hash}")
+        await report_progress("embedding", chunks=len(chunks))
         
-        # Process chunks in batches to avoid rate limits
-        batch_size = 20
-        for i in range(0, len(chunks), batch_size):
-            batch = chunks[i:i+batch_size]
-            batch_embeddings = []
-            
-            for j, chunk in enumerate(batch):
-                try:
-                    # Get embedding for chunk
-                    embedding = await get_embedding(chunk)
-                    if embedding:
-                        # Create embedding document
-                        embedding_doc = {
-                            "document_hash": document.file_hash,
-                            "user_id": document.user_id,
-                            "chunk_index": i + j,
-                            "chunk_text": chunk,
-                            "embedding": embedding,
-                            "token_count": count_tokens(chunk),
-                            "created_at": datetime.now()
-                        }
-                        batch_embeddings.append(embedding_doc)
-                except Exception as e:
-                    logger.error(f"Error generating embedding for chunk {i+j} of document {document.file_hash}: {e}")
-            
-            # Insert batch of embeddings
-            if batch_embeddings:
-                await embeddings_collection.insert_many(batch_embeddings)
-                logger.info(f"Stored {len(batch_embeddings)} embeddings for document {document.file_hash}")
-            
-            # Sleep to avoid rate limits
-            await asyncio.sleep(1)
+        # Embed all chunks in batched requests (rows keep chunk order)
+        token_counter.prime(chunks, chunk_tokens, document_chunker.encoding.name)
+        embeddings, token_counts = await asyncio.gather(
+            embed_chunks(chunks, previous, chunk_tokens), token_counter.count_many(chunks)
+        )
+        
+        stored_embeddings, stored_texts, stored_ids = [], [], []
+        embedding_docs = []
+        for i, ((page, chunk, _), embedding, tokens) in enumerate(zip(paged_chunks, embeddings, token_counts)):
+            embedding_docs.append({
+                "document_hash": document.file_hash,
+                "user_id": document.user_id,
+                "chunk_index": i,
+                "chunk_text": chunk,
+                "page_start": page,
+                "page_end": page,
+                "chunk_hash": chunk_content_hash(chunk),
+                **encode_embedding(embedding, version=embedding_service.version),
+                "token_count": tokens,
+                "created_at": datetime.now()
+            })
+            stored_embeddings.append(embedding)
+            stored_texts.append(chunk)
+            stored_ids.append(i)
+        
+        # Insert embeddings in bulk
+        await report_progress("storing", embedded=len(embedding_docs))
+        for start in range(0, len(embedding_docs), EMBEDDING_INSERT_BATCH):
+            await embeddings_collection.insert_many(embedding_docs[start:start + EMBEDDING_INSERT_BATCH])
+        if embedding_docs:
+            logger.info(f"Stored {len(embedding_docs)} embeddings for document {document.file_hash}")
         
         # Update document with embedding status
         await documents_collection.update_one(
             {"file_hash": document.file_hash},
             {"$set": {"has_embeddings": True}}
         )
+        # Write the node-local memory-mapped copy (also drops any matrix cached mid-ingestion)
+        if stored_embeddings:
+            await save_document_vectors(document.user_id, document.file_hash, stored_embeddings, stored_texts, stored_ids,
+                                        embedding_service.version)
         
         logger.info(f"Successfully generated and stored embeddings for document {document.file_hash}")
+        return len(embedding_docs)
+    except EmbeddingError as e:
+        # Nothing was stored; let the ingestion job retry
+        logger.error(f"Could not embed document {document.file_hash}: {e}")
+        raise
     except Exception as e:
         logger.error(f"Error in generate_and_store_embeddings for document {document.file_hash}: {e}", exc_info=True)
+        if document.user_id == SHARED_CONTENT_OWNER:
+            raise
+        return 0
+
+async def claim_or_reuse_shared_content(file_hash: str, filename: str, user_id: str) -> Optional[str]:
+    """
+    Claim the ingestion of a file's shared content, or wait for the upload holding the
+    claim to finish and reference its content. Returns the claim id, or None when the
+    content was reused. Raises TimeoutError after INGESTION_WAIT_TIMEOUT so the job is retried.
+    """
+    claim = uuid.uuid4().hex
+    deadline = time.monotonic() + INGESTION_WAIT_TIMEOUT
+    waiting = False
+    while True:
+        if await claim_shared_content(file_hash, claim, INGESTION_LEASE_SECONDS):
+            return claim
+        if await reuse_shared_content(file_hash, filename, user_id):
+            return None
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Shared content of {file_hash} is still being ingested by another upload")
+        if not waiting:
+            logger.info(f"{filename} of {user_id} waits for another upload of {file_hash} to finish ingesting")
+            await report_progress("waiting")
+            waiting = True
+        await asyncio.sleep(INGESTION_POLL_INTERVAL)
+
+@asynccontextmanager
+async def holding_shared_content_claim(file_hash: str, claim: str):
+    """Renew the claim's lease while the body ingests the file; give it up if nothing was published."""
+    async def renew():
+        while True:
+            await asyncio.sleep(INGESTION_LEASE_SECONDS / 3)
+            try:
+                if not await renew_shared_content_claim(file_hash, claim, INGESTION_LEASE_SECONDS):
+                    logger.warning(f"Lost the claim on shared content of {file_hash}")
+                    return
+            except Exception as e:
+                logger.warning(f"Could not renew the claim on shared content of {file_hash}: {e}")
+
+    renewal = asyncio.create_task(renew())
+    try:
+        yield
+    finally:
+        renewal.cancel()
+        # No-op after a successful publish, which clears the lease
+        await abandon_shared_content_claim(file_hash, claim)
+
+async def publish_document(document: Document, claim: str, chunk_count: int) -> None:
+    """Publish the claimed shared content with the uploader's reference, then save the user's row pointing at it."""
+    shared = await publish_shared_content(document, claim, chunk_count)
+    if shared is None:
+        raise RuntimeError(f"Lost the claim on shared content of {document.file_hash} before publishing it")
+    try:
+        await save_document(document.copy(update={"content": "", "content_ref": document.file_hash}))
+    except Exception:
+        # Otherwise the reference taken above is never released
+        await release_shared_content(document.file_hash)
+        raise
+
+async def store_document(document: Document, claim: str, previous: Optional[PreviousUpload] = None) -> None:
+    """
+    Save a freshly extracted document under the caller's claim on its shared content. The
+    text and chunk embeddings are stored once per file hash; the user's row only references them.
+    """
+    chunk_count = await generate_and_store_embeddings(document.copy(update={"user_id": SHARED_CONTENT_OWNER}), previous)
+    await publish_document(document, claim, chunk_count)
+
+async def reuse_shared_content(file_hash: str, filename: str, user_id: str) -> bool:
+    """
+    Give the user a document backed by content another upload of the same file already
+    extracted and embedded. Returns False when there is no such content yet.
+    """
+    shared = await acquire_shared_content(file_hash)
+    if not shared:
+        return False
+    try:
+        await save_document(Document(
+            file_hash=file_hash,
+            filename=filename,
+            user_id=user_id,
+            content="",
+            content_ref=file_hash,
+            doc_type=shared.get("doc_type"),
+            page_count=shared.get("page_count", 0),
+            token_count=shared.get("token_count", 0)
+        ))
+    except Exception:
+        # Otherwise the reference taken above is never released
+        await release_shared_content(file_hash)
+        raise
+    logger.info(f"Reusing shared content of {file_hash} for user {user_id} ({shared.get('ref_count')} references)")
+    await report_progress("reused", pages=shared.get("page_count", 0))
+    await log_usage_metrics(
+        user_id=user_id,
+        operation=OperationType.DOCUMENT_REUSE,
+        document_count=1,
+        document_hashes=[file_hash],
+        input_tokens=shared.get("token_count", 0),
+        page_count=shared.get("page_count", 0),
+        is_reused=True
+    )
+    return True
+
+async def delete_user_document(file_hash: str, user_id: str, document: Dict[str, Any]) -> None:
+    """Delete a user's document row and its chunks; shared content loses one reference."""
+    await asyncio.gather(
+        documents_collection.delete_one({"file_hash": file_hash, "user_id": user_id}),
+        embeddings_collection.delete_many({"document_hash": file_hash, "user_id": user_id})
+    )
+    forget_document_vectors(user_id, file_hash)
+    if document.get("content_ref") and await release_shared_content(document["content_ref"]):
+        forget_document_vectors(SHARED_CONTENT_OWNER, document["content_ref"])
 
 # Operation types for usage tracking
 class OperationType:
@@ -341,30 +461,21 @@ async def log_usage_metrics(
         logger.error(f"Failed to log usage metrics: {e}", exc_info=True)
 
 # Document processing
-async def process_document(file_path: str, filename: str, user_id: str) -> Optional[str]:
-    """Processes non-PDF text files, now including token counting and usage tracking."""
-    try:
-        file_hash = calculate_file_hash(file_path)
-        
-        # Check if document already exists for this user
-        existing_doc = await documents_collection.find_one({"file_hash": file_hash, "user_id": user_id})
-        if existing_doc:
-            # Log document reuse (no cost)
-            await log_usage_metrics(
-                user_id=user_id,
-                operation=OperationType.DOCUMENT_REUSE,
-                document_count=1,
-                document_hashes=[file_hash],
-                input_tokens=existing_doc.get("token_count", 0),
-                is_reused=True
-            )
-            return file_hash
+TEXT_EXTENSIONS = ('.txt', '.md', '.csv', '.json', '.yaml', '.yml')
 
+async def process_document(file_path: str, filename: str, user_id: str, file_hash: str, claim: str,
+                           previous: Optional[PreviousUpload] = None) -> Optional[str]:
+    """
+    Processes non-PDF text files, now including token counting and usage tracking.
+    Called by process_large_document, which has already checked for an existing or shared copy.
+    """
+    try:
         # Read and process the text document
+        await report_progress("extracting")
         with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
             text_content = f.read()
 
-        token_count = count_tokens(text_content)
+        token_count = await token_counter.count(text_content)
         
         # Create and save the document
         document = Document(
@@ -377,10 +488,8 @@ async def process_document(file_path: str, filename: str, user_id: str) -> Optio
             token_count=token_count, 
             embeddings=[]
         )
-        await save_document(document)
-        
-        # Generate embeddings for the document
-        await generate_and_store_embeddings(document)
+        # Save the text once per file hash and embed it unless another upload already did
+        await store_document(document, claim, previous)
         
         # Log text document processing
         await log_usage_metrics(
@@ -434,33 +543,51 @@ async def process_large_document(file_path: str, filename: str, user_id: str) ->
             )
             return file_hash
 
-        # Handle text files
-        if filename.lower().endswith(('.txt', '.md', '.csv', '.json', '.yaml', '.yml')):
-            logger.info(f"Processing text file: {filename}")
-            return await process_document(file_path, filename, user_id)
-            
-        # Handle PDF files
-        elif filename.lower().endswith('.pdf'):
-            logger.info(f"Processing PDF file: {filename}")
-            return await _process_pdf_document(file_path, filename, user_id, file_hash)
-            
-        # Handle DOCX files
-        elif filename.lower().endswith(('.docx', '.doc')):
-            logger.info(f"Processing Word document: {filename}")
-            return await _process_docx_document(file_path, filename, user_id, file_hash)
-            
-        else:
+        if not filename.lower().endswith(TEXT_EXTENSIONS + ('.pdf', '.docx', '.doc')):
             logger.warning(f"Unsupported file type: {filename}")
             raise ValueError(f"Unsupported file type: {os.path.splitext(filename)[1]}")
+
+        # Another user already uploaded the same file: reference its extracted text and embeddings,
+        # waiting for it if that upload is still being ingested
+        claim = await claim_or_reuse_shared_content(file_hash, filename, user_id)
+        if claim is None:
+            return file_hash
+
+        # An edited re-upload of one of the user's documents copies the embeddings of unchanged chunks
+        previous = await find_previous_upload(filename, user_id, file_hash)
+
+        # Only the claim holder extracts the file and writes its shared chunk rows
+        async with holding_shared_content_claim(file_hash, claim):
+            # Handle text files
+            if filename.lower().endswith(TEXT_EXTENSIONS):
+                logger.info(f"Processing text file: {filename}")
+                file_hash = await process_document(file_path, filename, user_id, file_hash, claim, previous)
+
+            # Handle PDF files
+            elif filename.lower().endswith('.pdf'):
+                logger.info(f"Processing PDF file: {filename}")
+                file_hash = await _process_pdf_document(file_path, filename, user_id, file_hash, claim, previous)
+
+            # Handle DOCX files
+            else:
+                logger.info(f"Processing Word document: {filename}")
+                file_hash = await _process_docx_document(file_path, filename, user_id, file_hash, claim, previous)
+
+        if previous and file_hash:
+            logger.info(f"Re-upload of {filename}: copied {previous.reused} chunk embeddings the cache missed from "
+                        f"document {previous.document_hash}, embedded {previous.embedded} changed chunks")
+        return file_hash
             
     except Exception as e:
         logger.error(f"Error processing document {filename}: {e}", exc_info=True)
         return None
 
-async def _process_docx_document(file_path: str, filename: str, user_id: str, file_hash: str) -> Optional[str]:
+async def _process_docx_document(file_path: str, filename: str, user_id: str, file_hash: str, claim: str,
+                                 previous: Optional[PreviousUpload] = None) -> Optional[str]:
     """Helper function to process DOCX documents."""
     try:
         # Read the DOCX file
+        await report_progress("extracting")
         with open(file_path, "rb") as f:
             docx_bytes = f.read()
         
@@ -487,7 +614,7 @@ async def _process_docx_document(file_path: str, filename: str, user_id: str, fi
         page_count = max(1, (word_count + 499) // 500)  # Round up division
         
         # Count tokens
-        token_count = count_tokens(text_content)
+        token_count = await token_counter.count(text_content)
         
         # Create document record
         document = Document(
@@ -504,11 +631,8 @@ async def _process_docx_document(file_path: str, filename: str, user_id: str, fi
             updated_at=datetime.utcnow()
         )
         
-        # Save document to database
-        await save_document(document)
-        
-        # Generate and store embeddings
-        await generate_and_store_embeddings(document)
+        # Save the text once per file hash and embed it unless another upload already did
+        await store_document(document, claim, previous)
         
         # Log document processing
         await log_usage_metrics(
@@ -526,85 +650,53 @@ async def _process_docx_document(file_path: str, filename: str, user_id: str, fi
         logger.error(f"Error processing DOCX document {filename}: {e}", exc_info=True)
         return None
 
-async def _process_pdf_document(file_path: str, filename: str, user_id: str, file_hash: str) -> Optional[str]:
-    """Helper function to process PDF documents."""
+async def _process_pdf_document(file_path: str, filename: str, user_id: str, file_hash: str, claim: str,
+                                previous: Optional[PreviousUpload] = None) -> Optional[str]:
+    """
+    Helper function to process PDF documents. Pages are extracted (or OCR'd), chunked,
+    embedded and stored as a stream, so large files never sit in memory whole.
+    """
     try:
-        # Read the PDF file
-        with open(file_path, "rb") as f:
-            pdf_bytes = f.read()
-        
-        # Split PDF into pages for processing
-        page_chunks = split_pdf_to_pages(pdf_bytes)
-        page_count = len(page_chunks)
+        # Digital PDFs are read directly; scans go through OCR page by page
+        digital, page_count = await asyncio.to_thread(is_digital_pdf, file_path)
+        doc_type = "text" if digital else "ocr"
+        await report_progress("extracting", pages=page_count)
+        await log_usage_metrics(
+            user_id=user_id,
+            operation=OperationType.TEXT_PROCESSING if digital else OperationType.OCR,
+            document_count=page_count,
+            document_hashes=[file_hash],
+            page_count=page_count
+        )
 
-        # Try direct text extraction first
-        final_text, doc_type = "", "text"
-        try:
-            with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
-                text_from_fitz = "".join(page.get_text() for page in doc)
-            
-            if len(text_from_fitz.strip()) > 100:
-                final_text = text_from_fitz
-                doc_type = "text"
-                
-                # Log text extraction success
-                await log_usage_metrics(
-                    user_id=user_id,
-                    operation=OperationType.TEXT_PROCESSING,
-                    document_count=page_count,
-                    document_hashes=[file_hash],
-                    page_count=page_count
-                )
-            else:
-                # Fall back to OCR if text extraction yields too little content
-                final_text, _ = await ocr_service.extract_text_from_pdf(file_path, user_id, file_hash)
-                doc_type = "ocr"
-                
-                # Log OCR processing
-                await log_usage_metrics(
-                    user_id=user_id,
-                    operation=OperationType.OCR,
-                    document_count=page_count,
-                    document_hashes=[file_hash],
-                    page_count=page_count
-                )
-                
-        except Exception as e:
-            logger.warning(f"Direct text extraction failed: {e}. Falling back to OCR.")
-            final_text, _ = await ocr_service.extract_text_from_pdf(file_path, user_id, file_hash)
-            doc_type = "ocr"
-            
-            # Log OCR processing
-            await log_usage_metrics(
-                user_id=user_id,
-                operation=OperationType.OCR,
-                document_count=page_count,
-                document_hashes=[file_hash],
-                page_count=page_count
-            )
-        
-        if not final_text:
+        # Chunks of shared content are stored once per file hash, under SHARED_CONTENT_OWNER
+        result = await run_ingestion_pipeline(
+            ocr_service.stream_pdf_pages(file_path, digital),
+            file_hash, SHARED_CONTENT_OWNER, previous=previous
+        )
+        if not result.content.strip():
             logger.error(f"Failed to extract text from {filename}")
             return None
+        if result.stored != result.chunks:
+            # Partial shared content must not be published; the job is retried
+            raise RuntimeError(f"Stored {result.stored} of {result.chunks} chunks of {filename}")
 
         # Count tokens in the extracted text
-        token_count = count_tokens(final_text)
+        token_count = await token_counter.count(result.content)
 
-        # Create and save the document
+        # Create and save the document; the user's row only references the shared text
         document = Document(
             file_hash=file_hash, 
             filename=filename, 
             user_id=user_id,
-            content=final_text, 
+            content=result.content, 
             doc_type=doc_type, 
-            page_count=page_count,
+            page_count=result.pages,
+            page_spans=result.page_spans,
             token_count=token_count, 
             embeddings=[]
         )
-        await save_document(document)
-        
-        # Generate embeddings for the document
-        await generate_and_store_embeddings(document)
+        await publish_document(document, claim, result.stored)
         
         # Log embedding generation
         await log_usage_metrics(
@@ -612,7 +704,7 @@ async def _process_pdf_document(file_path: str, filename: str, user_id: str, fil
             operation=OperationType.EMBEDDING,
             input_tokens=token_count,
             document_hashes=[file_hash],
-            page_count=page_count
+            page_count=result.pages
         )
         
         return file_hash
@@ -763,9 +855,10 @@ async def faq_event_generator(prompt: str):
             yield "data: " + json.dumps({"done": True}) + "\n\n"
             return
 
-        # --- Step 3: Get all embeddings for the knowledge base ---
-        kb_chunks = await embeddings_collection.find({"user_id": admin_user_id}).to_list(length=None)
-        if not kb_chunks:
+        # --- Step 3: Get the knowledge base search index (built at upload time) ---
+        kb = await kb_index.get()
+        kb_texts = kb.texts
+        if not kb_texts:
             yield "data: " + json.dumps({"chunk": "No searchable content found. Please ensure documents are processed correctly by an administrator."}) + "\n\n"
             yield "data: " + json.dumps({"done": True}) + "\n\n"
             return
@@ -777,10 +870,9 @@ async def faq_event_generator(prompt: str):
         # Special handling for holiday queries
         if is_holiday_query:
             holiday_text = ""
-            for chunk in kb_chunks:
-                chunk_text = chunk.get("chunk_text", "").lower()
-                if "holidays (2025" in chunk_text or "holiday" in chunk_text:
-                    holiday_text = chunk.get("chunk_text", "")
+            for chunk_text in kb_texts:
+                if "holidays (2025" in chunk_text.lower() or "holiday" in chunk_text.lower():
+                    holiday_text = chunk_text
                     break
                     
             if holiday_text:
@@ -791,103 +883,49 @@ async def faq_event_generator(prompt: str):
                 return
         
         # --- Step 5: Perform similarity search for other queries ---
-        prompt_embedding = await get_embedding(prompt)
-        if not prompt_embedding:
-            raise ValueError("Could not generate embedding for the user's prompt.")
-            
-        similarities = []
-        for chunk in kb_chunks:
-            if "embedding" not in chunk or not chunk.get("embedding"):
-                continue
-                
-            chunk_text = chunk.get("chunk_text", "")
-            if not chunk_text.strip():
-                continue
-                
-            # Calculate base similarity
-            similarity = cosine_similarity(prompt_embedding, chunk["embedding"])
-            
-            # Convert to lowercase for case-insensitive matching
-            chunk_lower = chunk_text.lower()
-            prompt_lower = prompt.lower()
-            
-            # Special handling for policy-related queries
-            policy_terms = {
-                'working hours': ['timing', 'work schedule', 'office hours', '9:30', '6:30'],
-                'leave': ['vacation', 'time off', 'day off', 'holiday', 'casual', 'sick', 'maternity', 'paternity'],
-                'remote work': ['wfh', 'work from home', 'remote', 'hybrid', 'work location']
-            }
-            
-            # Check for specific policy terms in the prompt
-            for policy, terms in policy_terms.items():
-                if any(term in prompt_lower for term in [policy] + terms):
-                    # Boost similarity for policy-related chunks
-                    if any(term in chunk_lower for term in terms + [policy]):
-                        similarity = max(similarity, 0.9)  # Very high boost for direct matches
-                        break
-            
-            # Extract all words from prompt and chunk
-            prompt_words = set(re.findall(r'\b\w+\b', prompt_lower))
-            chunk_words = set(re.findall(r'\b\w+\b', chunk_lower))
-            
-            # Calculate word overlap
-            common_words = prompt_words.intersection(chunk_words)
-            if common_words:
-                # Boost based on number of matching words
-                word_boost = min(0.5, len(common_words) * 0.1)
-                similarity += word_boost
-            
-            # Boost for any matching content type
-            content_boosts = [
-                (['ceo', 'chief executive', 'founder', 'leadership'], 0.3),
-                (['company', 'about', 'overview', 'nova', 'tech'], 0.2),
-                (['product', 'service', 'solution', 'offering'], 0.2),
-                (['policy', 'guideline', 'rule', 'process'], 0.2),
-                (['value', 'mission', 'vision', 'principle'], 0.2),
-                (['event', 'meeting', 'conference', 'holiday'], 0.2),
-                (['benefit', 'perk', 'compensation', 'salary'], 0.2)
-            ]
+        # Embed the prompt in the KB's vector space (it can lag EMBEDDING_VERSION during a re-embedding migration)
+        try:
+            prompt_embedding = await EmbeddingService.for_version(kb.embedding_version).embed_query(prompt)
+        except EmbeddingError as e:
+            raise ValueError("Could not generate embedding for the user's prompt.") from e
             
-            for terms, boost in content_boosts:
-                if any(term in prompt_lower for term in terms):
-                    similarity += boost
-                    break
-                    
-            # Boost for structural elements
-            if any(header in chunk_lower for header in ['##', '###', '####']):
-                similarity += 0.2
-                
-            # Boost for direct answers
-            if len(chunk_text) < 300 and '?' not in chunk_text:
-                similarity += 0.15
-                
-            # Ensure similarity is within valid range
-            similarity = max(0.1, min(1.0, similarity))
-                
-            # Add to similarities if above minimum threshold
-            if similarity > 0.3:  # Lower threshold to include more potential matches
-                similarities.append((similarity, chunk_text))
+        # Lexical relevance of every chunk from the KB's BM25 postings, scaled to [0, 1]
+        lexical_scores = kb.lexical_scores(prompt)
+        lexical_max = float(lexical_scores.max()) if lexical_scores.size else 0.0
+        if lexical_max > 0:
+            lexical_scores = lexical_scores / lexical_max
+
+        # Base similarity: every chunk for a small KB; for a large one the IVF shortlist
+        # plus the best BM25 matches the shortlist missed
+        if kb.is_approximate:
+            candidate_ids, candidate_scores = kb.search(prompt_embedding, FAQ_ANN_CANDIDATES)
+            lexical_ids = top_k_indices(lexical_scores, FAQ_ANN_CANDIDATES)
+            lexical_ids = np.setdiff1d(lexical_ids[lexical_scores[lexical_ids] > 0], candidate_ids)
+            candidate_ids = np.concatenate([candidate_ids, lexical_ids])
+            candidate_scores = np.concatenate([candidate_scores, kb.score_rows(prompt_embedding, lexical_ids)])
+        else:
+            candidate_ids, candidate_scores = kb.search(prompt_embedding, len(kb_texts))
+
+        # FAQ boosts over all candidates at once, from feature bits computed when the KB was indexed
+        candidate_features = kb.features[candidate_ids]
+        boosted = boost_scores(prompt, candidate_scores, FAQ_LEXICAL_WEIGHT * lexical_scores[candidate_ids], candidate_features)
         
-        # Sort by similarity score
-        similarities.sort(reverse=True, key=lambda x: x[0])
+        # Keep non-blank chunks above the minimum threshold, sorted by similarity score
+        keep = np.flatnonzero((boosted > 0.3) & ((candidate_features & BLANK) == 0))  # Lower threshold to include more potential matches
+        keep = keep[np.argsort(-boosted[keep], kind="stable")][:FAQ_MAX_MATCHES]
+        similarities = [(float(boosted[i]), kb_texts[candidate_ids[i]]) for i in keep.tolist()]
         
         # If no good matches found, try a keyword-based fallback
         if not similarities and len(prompt.split()) < 5:  # For short, direct questions
             keyword_matches = []
-            query_terms = set(prompt.lower().split())
+            query_terms = set(tokenize(prompt))
             
-            for chunk in kb_chunks:
-                chunk_text = chunk.get("chunk_text", "")
-                if not chunk_text:
-                    continue
-                    
-                chunk_terms = set(chunk_text.lower().split())
-                common_terms = query_terms.intersection(chunk_terms)
-                if common_terms:
-                    # Score based on number of matching terms and chunk length
-                    score = len(common_terms) / len(query_terms)
-                    if score > 0.3:  # At least 30% of terms match
-                        keyword_matches.append((score, chunk_text))
+            if query_terms and kb.bm25 is not None:
+                # Score based on the share of query terms found in each chunk's postings
+                match_scores = kb.bm25.matched_terms(prompt) / len(query_terms)
+                for row in np.flatnonzero(match_scores > 0.3):  # At least 30% of terms match
+                    if kb_texts[row]:
+                        keyword_matches.append((float(match_scores[row]), kb_texts[row]))
             
             if keyword_matches:
                 keyword_matches.sort(reverse=True, key=lambda x: x[0])
@@ -926,24 +964,15 @@ async def faq_event_generator(prompt: str):
 
         # Add more context about the company to help with general questions
         additional_context = []
-        company_info_terms = [
-            'ceo', 'company overview', 'about us', 'company name', 'products', 'services',
-            'core values', 'values', 'mission', 'vision', 'code of conduct', 'policies',
-            'annual events', 'calendar', 'holidays', 'leave policy', 'remote work', 'benefits'
-        ]
-        
-        for chunk in kb_chunks:
-            chunk_text = chunk.get("chunk_text", "")
-            chunk_lower = chunk_text.lower()
+        for row in np.flatnonzero(kb.features & COMPANY_INFO).tolist():
+            chunk_text = kb_texts[row]
             
-            # Check if this chunk contains any company-related information
-            if any(term in chunk_lower for term in company_info_terms):
-                # Boost relevance of this chunk if it contains section headers
-                if any(header in chunk_lower for header in ['##', '###', '####']):
-                    if chunk_text not in context_chunks:
-                        additional_context.insert(0, chunk_text)  # Add to beginning
-                elif chunk_text not in context_chunks:
-                    additional_context.append(chunk_text)  # Add to end
+            # Boost relevance of this chunk if it contains section headers
+            if kb.features[row] & HEADER:
+                if chunk_text not in context_chunks:
+                    additional_context.insert(0, chunk_text)  # Add to beginning
+            elif chunk_text not in context_chunks:
+                additional_context.append(chunk_text)  # Add to end
         
         # Add up to 3 additional relevant chunks
         context_chunks.extend(additional_context[:3])
@@ -1068,19 +1097,24 @@ async def faq_event_generator(prompt: str):
         ]
         
         # --- Step 7: Stream the final answer from OpenAI ---
-        stream = await openai_client.chat.completions.create(
-            model=MODEL_NAME,
-            messages=messages,
-            stream=True,
-            temperature=0.7,  # Increased temperature for more creative/expansive answers
-            max_tokens=1000,  # Allow longer responses
-            top_p=0.95,  # More diversity in responses
-            frequency_penalty=0.2,  # Slightly reduce repetition
-            presence_penalty=0.2  # Encourage mentioning of entities
-        )
-        async for chunk in stream:
-            if chunk.choices[0].delta.content:
-                yield "data: " + json.dumps({"chunk": chunk.choices[0].delta.content}) + "\n\n"
+        # The limiter slot is held until the answer has been streamed
+        async with get_rate_limiter("openai", MODEL_NAME).stream(
+            lambda: limited_openai_client.chat.completions.create(
+                model=MODEL_NAME,
+                messages=messages,
+                stream=True,
+                stream_options={"include_usage": True},  # Last chunk reports usage for the limiter
+                temperature=0.7,  # Increased temperature for more creative/expansive answers
+                max_tokens=1000,  # Allow longer responses
+                top_p=0.95,  # More diversity in responses
+                frequency_penalty=0.2,  # Slightly reduce repetition
+                presence_penalty=0.2  # Encourage mentioning of entities
+            ),
+            tokens=estimate_tokens(*(m["content"] for m in messages)) + 1000
+        ) as stream:
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield "data: " + json.dumps({"chunk": chunk.choices[0].delta.content}) + "\n\n"
         
         yield "data: " + json.dumps({"done": True}) + "\n\n"
 
@@ -1117,18 +1151,16 @@ async def chat(
         
         session = await chat_session_manager.get_or_create_session(user_id, session_id)
         logger.info(f"Using session {session.session_id} for user {user_id}")
-        
-        messages = []
 
         logger.info(f"Task: {task}, Prompt: {original_prompt}, User ID: {user_id}")
 
-        # Track newly processed files separately from context-retrieved documents
-        newly_processed_hashes = []
-        context_document_hashes = []
+        # Filenames of this request's uploads, by file hash
         processed_filenames = {}
         
+        # Uploads are queued for the ingestion workers; the response streams their progress
+        queued_jobs = []
         if files:
-            logger.info(f"Processing {len(files)} uploaded files")
+            logger.info(f"Queueing {len(files)} uploaded files for ingestion")
             temp_dir = tempfile.mkdtemp()
             try:
                 for file in files:
@@ -1136,110 +1168,135 @@ async def chat(
                         logger.warning("Skipping file with no filename")
                         continue
                         
-                    logger.info(f"Processing file: {file.filename}")
-                    file_path = os.path.join(temp_dir, file.filename)
+                    file_path = os.path.join(temp_dir, os.path.basename(file.filename))
                     with open(file_path, "wb") as f:
                         shutil.copyfileobj(file.file, f)
-                    
-                    if file.filename.lower().endswith('.pdf'):
-                        logger.info(f"Processing PDF file: {file.filename}")
-                        file_hash = await process_large_document(file_path, file.filename, user_id)
-                    else:
-                        logger.info(f"Processing non-PDF file: {file.filename}")
-                        file_hash = await process_large_document(file_path, file.filename, user_id)
-                        
-                    if file_hash:
-                        logger.info(f"File processed successfully. Hash: {file_hash}")
-                        newly_processed_hashes.append(file_hash)
-                        processed_filenames[file_hash] = file.filename
-                        if file_hash not in session.active_documents:
-                            logger.info(f"Adding document {file_hash} to active documents for session {session.session_id}")
-                            session.active_documents.append(file_hash)
-                            await session.save_to_db()
-                    else:
-                        logger.error(f"Failed to process file: {file.filename}")
+                    job = await enqueue_file(file_path, file.filename, user_id)
+                    queued_jobs.append(job)
+                    processed_filenames[job["file_hash"]] = file.filename
+                    if job["file_hash"] not in session.active_documents:
+                        logger.info(f"Adding document {job['file_hash']} to active documents for session {session.session_id}")
+                        session.active_documents.append(job["file_hash"])
+                if queued_jobs:
+                    await session.save_to_db()
             finally:
                 shutil.rmtree(temp_dir)
 
-        conversation_history = await session.get_conversation_history()
-        document_context = ""
-        used_documents = []
-        
-        # Determine if this is a focused task (like summarization)
-        is_focused_task = (
-            (files and newly_processed_hashes) and
-            any(keyword in prompt.lower() for keyword in ["summary", "summarize", "summarise", "explain", "detail"])
-        )
+        async def generate_response():
+            nonlocal prompt
+            newly_processed_hashes = []
+            context_document_hashes = []
+
+            # Wait for this request's uploads, streaming their progress to the client
+            if queued_jobs:
+                async for jobs in wait_for_jobs([job["_id"] for job in queued_jobs], INGESTION_WAIT_TIMEOUT):
+                    yield "data: " + json.dumps({"ingestion": [job_status(job) for job in jobs]}, default=str) + "\n\n"
+                finished = {job["_id"]: job for job in await ingestion_jobs_collection.find(
+                    {"_id": {"$in": [job["_id"] for job in queued_jobs]}}
+                ).to_list(length=len(queued_jobs))}
+                for queued in queued_jobs:
+                    job = finished.get(queued["_id"], queued)
+                    if job.get("state") == JOB_SUCCEEDED:
+                        logger.info(f"File processed successfully. Hash: {job['file_hash']}")
+                        newly_processed_hashes.append(job["file_hash"])
+                    else:
+                        logger.error(f"File {queued['filename']} not ready ({job.get('state')}): {job.get('error')}")
 
-        # Fix for Q&A not working on first upload
-        # Check if we have active documents but no document context is being retrieved
-        if newly_processed_hashes and not is_focused_task:
-            logger.info(f"First-time Q&A for newly uploaded documents. Using direct document retrieval.")
-            # Get the most recently uploaded document for context
-            latest_doc_hash = newly_processed_hashes[-1]
-            document_object = await get_document(latest_doc_hash, user_id)
+            try:
+                conversation_history = await session.get_conversation_history()
+                document_context = ""
+                used_documents = []
+        
+                # Determine if this is a focused task (like summarization)
+                is_focused_task = (
+                    (files and newly_processed_hashes) and
+                    any(keyword in prompt.lower() for keyword in ["summary", "summarize", "summarise", "explain", "detail"])
+                )
+
+                # Questions about specific pages get just those pages of the latest document
+                requested_pages = page_references(prompt)
+                page_doc_hash = (newly_processed_hashes or session.active_documents or [None])[-1]
+                page_text = None
+                if requested_pages and page_doc_hash:
+                    page_text = await page_context(page_doc_hash, user_id, requested_pages)
+
+                if page_text:
+                    logger.info(f"Page question: using pages {requested_pages} of document {page_doc_hash}")
+                    document_context = page_text
+                    context_document_hashes = [page_doc_hash]
+                # Fix for Q&A not working on first upload
+                # Check if we have active documents but no document context is being retrieved
+                elif newly_processed_hashes and not is_focused_task:
+                    logger.info(f"First-time Q&A for newly uploaded documents. Using direct document retrieval.")
+                    # Get the most recently uploaded document for context
+                    latest_doc_hash = newly_processed_hashes[-1]
+                    document_object = await get_document(latest_doc_hash, user_id)
             
-            if document_object:
-                logger.info(f"Retrieved document {latest_doc_hash} for first-time Q&A")
-                # For large documents, we might want to truncate or chunk the content
-                document_context = document_object.content[:100000]  # Limit to first 100K chars if very large
-                context_document_hashes = [latest_doc_hash]
-            else:
-                logger.warning(f"Document {latest_doc_hash} not found for first-time Q&A")
-        elif is_focused_task:
-            doc_hash_to_focus = newly_processed_hashes[-1]
-            filename_to_focus = processed_filenames.get(doc_hash_to_focus, "the uploaded document")
-            prompt = f"{prompt}: '{filename_to_focus}'" # Make prompt specific
+                    if document_object:
+                        logger.info(f"Retrieved document {latest_doc_hash} for first-time Q&A")
+                        # For large documents, we might want to truncate or chunk the content
+                        document_context = document_object.content[:100000]  # Limit to first 100K chars if very large
+                        context_document_hashes = [latest_doc_hash]
+                    else:
+                        logger.warning(f"Document {latest_doc_hash} not found for first-time Q&A")
+                elif is_focused_task:
+                    doc_hash_to_focus = newly_processed_hashes[-1]
+                    filename_to_focus = processed_filenames.get(doc_hash_to_focus, "the uploaded document")
+                    prompt = f"{prompt}: '{filename_to_focus}'" # Make prompt specific
             
-            logger.info(f"Focused Task: Getting FULL TEXT of document: {doc_hash_to_focus}")
-            document_object = await get_document(doc_hash_to_focus, user_id)
-            if document_object:
-                # IMPORTANT: Make sure we're getting the full document content
-                document_context = document_object.content
-                if not document_context or len(document_context) < 100:
-                    logger.warning(f"Document content is too short or empty: {len(document_context)} chars")
-                    # Try to fetch the document again with full content projection
-                    doc = await documents_collection.find_one(
-                        {"file_hash": doc_hash_to_focus, "user_id": user_id},
-                        projection={"content": 1}
-                    )
-                    if doc and "content" in doc and doc["content"]:
-                        document_context = doc["content"]
-                        logger.info(f"Retrieved document content directly: {len(document_context)} chars")
+                    logger.info(f"Focused Task: Getting FULL TEXT of document: {doc_hash_to_focus}")
+                    document_object = await get_document(doc_hash_to_focus, user_id)
+                    if document_object:
+                        # IMPORTANT: Make sure we're getting the full document content
+                        document_context = document_object.content
+                        if not document_context or len(document_context) < 100:
+                            logger.warning(f"Document content is too short or empty: {len(document_context)} chars")
+                            # Try to fetch the document again with full content projection
+                            doc = await documents_collection.find_one(
+                                {"file_hash": doc_hash_to_focus, "user_id": user_id},
+                                projection={"content": 1}
+                            )
+                            if doc and "content" in doc and doc["content"]:
+                                document_context = doc["content"]
+                                logger.info(f"Retrieved document content directly: {len(document_context)} chars")
                 
-                context_document_hashes = [doc_hash_to_focus]
-                logger.info(f"Using document content for summarization: {len(document_context)} chars")
-            else:
-                logger.warning(f"Document {doc_hash_to_focus} not found for focused task")
-        elif session.active_documents:
-            logger.info("Standard context retrieval: Using similarity search across all active documents.")
-            logger.info(f"Active documents for session {session.session_id}: {session.active_documents}")
+                        context_document_hashes = [doc_hash_to_focus]
+                        logger.info(f"Using document content for summarization: {len(document_context)} chars")
+                    else:
+                        logger.warning(f"Document {doc_hash_to_focus} not found for focused task")
+                elif session.active_documents:
+                    logger.info("Standard context retrieval: Using similarity search across all active documents.")
+                    logger.info(f"Active documents for session {session.session_id}: {session.active_documents}")
             
-            # Check if embeddings exist for all active documents
-            for doc_hash in session.active_documents:
-                embedding_count = await embeddings_collection.count_documents({"document_hash": doc_hash})
-                logger.info(f"Document {doc_hash} has {embedding_count} embeddings")
-                
-                # If no embeddings, try to generate them on-the-fly
-                if embedding_count == 0:
-                    logger.info(f"No embeddings found for document {doc_hash}. Attempting to generate embeddings.")
-                    doc = await get_document(doc_hash, user_id)
-                    if doc:
-                        await generate_and_store_embeddings(doc)
-                        logger.info(f"Generated embeddings for document {doc_hash}")
+                    # Check if embeddings exist for all active documents (one query for the whole session)
+                    embedded_hashes = set(await embeddings_collection.distinct(
+                        "document_hash",
+                        {"document_hash": {"$in": session.active_documents}, "user_id": {"$in": [user_id, SHARED_CONTENT_OWNER]}}
+                    ))
+                    for doc_hash in session.active_documents:
+                        # If no embeddings, try to generate them on-the-fly
+                        if doc_hash not in embedded_hashes:
+                            logger.info(f"No embeddings found for document {doc_hash}. Attempting to generate embeddings.")
+                            doc = await get_document(doc_hash, user_id)
+                            if doc:
+                                try:
+                                    await generate_and_store_embeddings(doc)
+                                    logger.info(f"Generated embeddings for document {doc_hash}")
+                                except EmbeddingError as e:
+                                    logger.warning(f"Answering without embeddings for document {doc_hash}: {e}")
             
-            document_context, used_documents = await session.get_document_context_with_sources(prompt)
-            context_document_hashes = used_documents
-            logger.info(f"Retrieved context from {len(used_documents)} documents using similarity search")
-
-        system_prompt = ""
-        if is_focused_task and any(keyword in original_prompt.lower() for keyword in ["summary", "summarize", "summarise"]):
-            logger.info("Using multi-record data extraction prompt for summarization.")
-            system_prompt = ""
-        if is_focused_task and any(keyword in original_prompt.lower() for keyword in ["summary", "summarize", "summarise", "explain", "detail"]):
-            logger.info("Using new master prompt for descriptive and structured analysis.")
-            # This new "Master Prompt" handles all document types and output styles.
-            system_prompt = """
+                    document_context, used_documents = await session.get_document_context_with_sources(prompt)
+                    context_document_hashes = used_documents
+                    logger.info(f"Retrieved context from {len(used_documents)} documents using similarity search")
+
+                system_prompt = ""
+                if is_focused_task and any(keyword in original_prompt.lower() for keyword in ["summary", "summarize", "summarise"]):
+                    logger.info("Using multi-record data extraction prompt for summarization.")
+                    system_prompt = ""
+                if is_focused_task and any(keyword in original_prompt.lower() for keyword in ["summary", "summarize", "summarise", "explain", "detail"]):
+                    logger.info("Using new master prompt for descriptive and structured analysis.")
+                    # This new "Master Prompt" handles all document types and output styles.
+                    system_prompt = """
             You are an expert document analyst AI. Your task is to provide a comprehensive analysis of any document provided, following a strict two-part structure. This must be applied to ALL document types, including resumes, invoices, legal affidavits, financial statements, press releases, identification cards, and more.
 
             **Part 1: Document Description**
@@ -1266,9 +1323,9 @@ async def chat(
             ### [Relevant Heading 2]
             - **[Data Point C]:** [Extracted Value]
             """
-        else:
-            logger.info("Using general Q&A prompt with page-awareness.")
-            system_prompt = """You are JCS Bot, an advanced enterprise assistant. Your responses should be helpful, informative, and conversational.
+                else:
+                    logger.info("Using general Q&A prompt with page-awareness.")
+                    system_prompt = """You are JCS Bot, an advanced enterprise assistant. Your responses should be helpful, informative, and conversational.
 
 When answering questions:
 1. If asked for a summary, provide a comprehensive summary of the document content.
@@ -1286,51 +1343,61 @@ When answering questions:
 13. IMPORTANT: When referencing documents, always mention the document name in your response.
 14. CRITICAL: When multiple documents are available, ONLY use the context from the most recently uploaded document for summarization or detail explanation tasks, unless explicitly asked about other documents.
 15. For each new request, focus ONLY on the document context provided for that specific request.
-16. The document text may contain page separators like '--- PAGE BREAK ---'. If the user asks what is on a specific page (e.g., 'what is on page 2?'), use these separators to identify and answer using only the content from that specific page.
+16. When the user asks about specific pages, the document context holds just those pages, each labelled like '[Page 2 of 40]'. Answer using only the content of the requested pages, and say so if a requested page does not exist.
 """
 
-        messages = [{"role": "system", "content": system_prompt}]
+                messages = [{"role": "system", "content": system_prompt}]
         
-        if document_context:
-            document_names = {h: processed_filenames.get(h) for h in newly_processed_hashes}
-            for doc_hash in session.active_documents:
-                if doc_hash not in document_names:
-                    doc = await get_document(doc_hash, user_id)
-                    if doc: document_names[doc_hash] = doc.filename
+                if document_context:
+                    document_names = {h: processed_filenames.get(h) for h in newly_processed_hashes}
+                    for doc_hash in session.active_documents:
+                        if doc_hash not in document_names:
+                            doc = await get_document(doc_hash, user_id)
+                            if doc: document_names[doc_hash] = doc.filename
             
-            doc_names_str = "\n".join([f"- {h}: {name}" for h, name in document_names.items() if name])
-            messages.append({"role": "system", "content": f"Available documents:\n{doc_names_str}\n\nHere is the relevant document context:\n\n{document_context}"})
+                    doc_names_str = "\n".join([f"- {h}: {name}" for h, name in document_names.items() if name])
+                    messages.append({"role": "system", "content": f"Available documents:\n{doc_names_str}\n\nHere is the relevant document context:\n\n{document_context}"})
 
-        # Initialize token counters
-        input_tokens = 0
-        output_tokens = 0
+                # Initialize token counters
+                input_tokens = 0
+                output_tokens = 0
         
-        # Isolate focused tasks from chat history to avoid confusion
-        if not is_focused_task and conversation_history:
-            logger.info("Adding conversation history to the prompt.")
-            messages.append({"role": "system", "content": f"Here is the recent chat history:\n\n{conversation_history}"})
+                # Isolate focused tasks from chat history to avoid confusion
+                if not is_focused_task and conversation_history:
+                    logger.info("Adding conversation history to the prompt.")
+                    messages.append({"role": "system", "content": f"Here is the recent chat history:\n\n{conversation_history}"})
 
-        full_prompt_for_api = " ".join([m["content"] for m in messages]) + prompt
-        input_tokens = count_tokens(full_prompt_for_api)
+                # Counted part by part: the system prompt, history and repeated context come from the cache
+                input_tokens = await token_counter.count_parts([m["content"] for m in messages] + [prompt])
+
+                # Use the potentially modified prompt for the LLM call
+                messages.append({"role": "user", "content": prompt})
+            except Exception as e:
+                logger.error(f"Error preparing chat context: {e}", exc_info=True)
+                yield f"data: {json.dumps({'error': 'Failed to process request.'})}\n\n"
+                return
 
-        # Use the potentially modified prompt for the LLM call
-        messages.append({"role": "user", "content": prompt})
-        
-        async def generate_response():
             full_response_text = ""
             try:
-                stream = await openai_client.chat.completions.create(model=MODEL_NAME, messages=messages, stream=True)
-                async for chunk in stream:
-                    content = chunk.choices[0].delta.content
-                    if content:
-                        full_response_text += content
-                        yield f"data: {json.dumps({'chunk': content})}\n\n"
+                # The limiter slot is held until the answer has been streamed
+                async with get_rate_limiter("openai", MODEL_NAME).stream(
+                    lambda: limited_openai_client.chat.completions.create(
+                        model=MODEL_NAME, messages=messages, stream=True,
+                        stream_options={"include_usage": True}  # Last chunk reports usage for the limiter
+                    ),
+                    tokens=input_tokens + CHAT_OUTPUT_TOKEN_ESTIMATE
+                ) as stream:
+                    async for chunk in stream:
+                        content = chunk.choices[0].delta.content if chunk.choices else None
+                        if content:
+                            full_response_text += content
+                            yield f"data: {json.dumps({'chunk': content})}\n\n"
             except Exception as e:
                 logger.error(f"OpenAI error: {e}", exc_info=True)
                 full_response_text = f"Error: {e}"
                 yield f"data: {json.dumps({'error': str(e)})}\n\n"
 
-            output_tokens = count_tokens(full_response_text)
+            output_tokens = await token_counter.count(full_response_text)
             
             all_referenced_hashes = list(set(newly_processed_hashes + context_document_hashes))
             logger.info(f"Final referenced documents for this message: {all_referenced_hashes}")
@@ -1414,6 +1481,55 @@ async def get_user_documents(current_user: User = Depends(get_current_user)):
             detail="Failed to fetch documents. Please try again later."
         )
 
+@router.post("/documents/upload", response_model=List[Dict[str, Any]])
+async def upload_documents(
+    files: List[UploadFile] = File(...),
+    session_id: Optional[str] = Form(None),
+    current_user: User = Depends(get_current_user)
+):
+    """
+    Queue files for background ingestion and return their jobs right away.
+    With a session id, the documents are added to that session's active documents.
+    """
+    user_id = current_user.username
+    session = await chat_session_manager.get_or_create_session(user_id, session_id) if session_id else None
+    jobs = []
+    temp_dir = tempfile.mkdtemp()
+    try:
+        for file in files:
+            if not file.filename:
+                continue
+            file_path = os.path.join(temp_dir, os.path.basename(file.filename))
+            with open(file_path, "wb") as f:
+                shutil.copyfileobj(file.file, f)
+            jobs.append(await enqueue_file(file_path, file.filename, user_id))
+    except Exception as e:
+        logger.error(f"Error queueing uploads for user {user_id}: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail="Failed to queue the uploaded files.")
+    finally:
+        shutil.rmtree(temp_dir)
+
+    if session is not None:
+        added = [job["file_hash"] for job in jobs if job["file_hash"] not in session.active_documents]
+        if added:
+            session.active_documents.extend(added)
+            await session.save_to_db()
+    return [job_status(job) for job in jobs]
+
+@router.get("/documents/jobs", response_model=List[Dict[str, Any]])
+async def get_ingestion_jobs(file_hash: Optional[str] = None, current_user: User = Depends(get_current_user)):
+    """Recent ingestion jobs of the current user (optionally of one document) with their progress."""
+    jobs = await list_jobs(current_user.username, file_hash)
+    return [job_status(job) for job in jobs]
+
+@router.get("/documents/jobs/{job_id}", response_model=Dict[str, Any])
+async def get_ingestion_job(job_id: str, current_user: User = Depends(get_current_user)):
+    """State and progress of one ingestion job."""
+    job = await get_job(job_id, current_user.username)
+    if not job:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Ingestion job not found")
+    return job_status(job)
+
 @router.delete("/documents/{file_hash}", status_code=status.HTTP_204_NO_CONTENT)
 async def delete_document(file_hash: str, current_user: User = Depends(get_current_user)):
     """
@@ -1443,10 +1559,9 @@ async def delete_document(file_hash: str, current_user: User = Depends(get_curre
         "deleted_at": datetime.utcnow()
     }
     
-    # Delete document and its embeddings
+    # Delete document and its embeddings (shared content is collected with its last reference)
     await asyncio.gather(
-        documents_collection.delete_one({"file_hash": file_hash, "user_id": current_user.username}),
-        embeddings_collection.delete_many({"document_hash": file_hash, "user_id": current_user.username}),
+        delete_user_document(file_hash, current_user.username, document),
         deleted_documents_collection.insert_one(deleted_doc)
     )
     
@@ -2,6 +2,69 @@ PROCESSING_THREADS = 8          # Adjust based on CPU cores
 MEMORY_LIMIT_MB = 512          # Maximum memory allocation
 CACHE_SIZE_PAGES = 100         # Number of cached pages
 CHUNK_SIZE_PAGES = 50          # Pages per processing chunk
+
+import os
+
+# Retrieval caches (override per deployment through the environment)
+EMBEDDING_CACHE_MB = int(os.getenv("EMBEDDING_CACHE_MB", "512"))   # Budget for cached document embedding matrices
+VECTOR_STORE_DIR = os.getenv("VECTOR_STORE_DIR", "vector_store")    # Node-local memory-mapped embedding files
+ANN_MIN_CHUNKS = int(os.getenv("ANN_MIN_CHUNKS", "20000"))         # Chunk count above which search uses the IVF index
+EMBEDDING_CURSOR_BATCH_SIZE = int(os.getenv("EMBEDDING_CURSOR_BATCH_SIZE", "1000"))  # Chunk rows per MongoDB cursor batch
+EMBEDDING_STORAGE_DTYPE = os.getenv("EMBEDDING_STORAGE_DTYPE", "float16")  # float32, float16 or int8 in MongoDB
+
+# Embedding model used for document chunks and prompts (changing either requires re-embedding stored chunks)
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-ada-002")
+EMBEDDING_DIMENSIONS = int(os.getenv("EMBEDDING_DIMENSIONS", "0"))     # e.g. 256, 512 or 1536; 0 = model default (text-embedding-3 models only)
+LOCAL_EMBEDDING_DIMENSIONS = int(os.getenv("LOCAL_EMBEDDING_DIMENSIONS", "512"))  # Size of local-* model vectors (EMBEDDING_MODEL=local-hashing runs offline)
+EMBEDDING_LEGACY_VERSION = os.getenv("EMBEDDING_LEGACY_VERSION", "text-embedding-ada-002")  # Version assumed for rows stored before versioning
+EMBEDDING_MIGRATION_CONCURRENCY = int(os.getenv("EMBEDDING_MIGRATION_CONCURRENCY", "1"))  # Embedding requests in flight while re-embedding (leaves room for live traffic)
+EMBEDDING_MIGRATION_LOCK_SECONDS = int(os.getenv("EMBEDDING_MIGRATION_LOCK_SECONDS", "300"))  # A crashed migration can be resumed elsewhere after this
+
+# Document chunking (sizes in embedding-model tokens; chunks never span a page break)
+CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", "512"))          # Target chunk size
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "64"))   # Trailing sentences repeated at the start of the next chunk
+PAGE_CONTEXT_MAX_PAGES = int(os.getenv("PAGE_CONTEXT_MAX_PAGES", "10"))  # Pages fetched for a question that names pages
+
+# Embedding requests: chunks are packed into multi-input requests by token count
+EMBEDDING_REQUEST_MAX_TOKENS = int(os.getenv("EMBEDDING_REQUEST_MAX_TOKENS", "100000"))  # Tokens per embeddings request
+EMBEDDING_REQUEST_CONCURRENCY = int(os.getenv("EMBEDDING_REQUEST_CONCURRENCY", "4"))     # Packed requests in flight
+
+# Provider rate limits shared by every call in the process (adjusted from response headers)
+OPENAI_RPM = int(os.getenv("OPENAI_RPM", "3000"))               # Requests per minute, per model
+OPENAI_TPM = int(os.getenv("OPENAI_TPM", "1000000"))            # Tokens per minute, per model
+GEMINI_RPM = int(os.getenv("GEMINI_RPM", "1000"))
+GEMINI_TPM = int(os.getenv("GEMINI_TPM", "4000000"))
+RATE_LIMIT_MAX_CONCURRENCY = int(os.getenv("RATE_LIMIT_MAX_CONCURRENCY", "16"))  # Upper bound for adaptive concurrency
+RATE_LIMIT_MAX_RETRIES = int(os.getenv("RATE_LIMIT_MAX_RETRIES", "5"))           # Retries after a 429
+
+# Prompt embedding cache (repeat questions skip the OpenAI round trip)
+QUERY_EMBEDDING_CACHE_SIZE = int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", "4096"))     # Entries kept in memory
+QUERY_EMBEDDING_CACHE_TTL = int(os.getenv("QUERY_EMBEDDING_CACHE_TTL", "86400"))      # Seconds before an entry expires
+QUERY_EMBEDDING_CACHE_PERSIST = os.getenv("QUERY_EMBEDDING_CACHE_PERSIST", "false").lower() == "true"  # Also keep entries in MongoDB
+
+# Content-addressed chunk embedding cache (same model, dimensions and text are embedded once)
+EMBEDDING_CONTENT_CACHE_MB = int(os.getenv("EMBEDDING_CONTENT_CACHE_MB", "256"))   # In-process LRU budget
+EMBEDDING_CONTENT_CACHE_PERSIST = os.getenv("EMBEDDING_CONTENT_CACHE_PERSIST", "true").lower() == "true"  # Back the LRU with MongoDB
+EMBEDDING_CONTENT_CACHE_TTL = int(os.getenv("EMBEDDING_CONTENT_CACHE_TTL", "2592000"))  # Seconds before a MongoDB entry expires
+
+# Background ingestion jobs (uploads are queued in MongoDB and processed by a worker pool)
+INGESTION_SPOOL_DIR = os.getenv("INGESTION_SPOOL_DIR", "ingestion_spool")       # Uploaded files waiting for a worker (shared by all workers)
+INGESTION_WORKERS = int(os.getenv("INGESTION_WORKERS", "2"))                     # Concurrent jobs per worker process
+INGESTION_RUN_IN_PROCESS = os.getenv("INGESTION_RUN_IN_PROCESS", "true").lower() == "true"  # Run workers inside the API process
+INGESTION_LEASE_SECONDS = int(os.getenv("INGESTION_LEASE_SECONDS", "120"))       # A job is resumed elsewhere when its lease lapses
+INGESTION_MAX_ATTEMPTS = int(os.getenv("INGESTION_MAX_ATTEMPTS", "3"))
+INGESTION_POLL_INTERVAL = float(os.getenv("INGESTION_POLL_INTERVAL", "1.0"))     # Seconds between claims when the queue is empty
+INGESTION_WAIT_TIMEOUT = int(os.getenv("INGESTION_WAIT_TIMEOUT", "600"))         # How long /chat streams progress before answering without a document
+INGESTION_QUEUE_SIZE = int(os.getenv("INGESTION_QUEUE_SIZE", "8"))              # Batches buffered between pipeline stages (backpressure)
+INGESTION_EMBED_BATCH = int(os.getenv("INGESTION_EMBED_BATCH", "256"))          # Chunks handed to one packed embeddings call
+
+# Token counting (large documents and chunk batches are encoded in a shared process pool)
+TOKEN_COUNT_MODEL = os.getenv("TOKEN_COUNT_MODEL", "gpt-4o-mini")                # Chat model whose tokenizer counts usage and prompts
+TOKEN_COUNT_WORKERS = int(os.getenv("TOKEN_COUNT_WORKERS", str(min(4, os.cpu_count() or 1))))  # Pool processes; 0 = count in threads
+TOKEN_COUNT_SHARD_CHARS = int(os.getenv("TOKEN_COUNT_SHARD_CHARS", "1000000"))   # Characters per shard sent to one worker
+TOKEN_COUNT_INLINE_CHARS = int(os.getenv("TOKEN_COUNT_INLINE_CHARS", "20000"))   # Smaller work is encoded on the event loop
+TOKEN_COUNT_CACHE_SIZE = int(os.getenv("TOKEN_COUNT_CACHE_SIZE", "200000"))      # Chunk and prompt-part counts kept in memory
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.middleware.trustedhost import TrustedHostMiddleware
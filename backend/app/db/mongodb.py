@@ -1,4 +1,6 @@
 import motor.motor_asyncio
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
 from pydantic import BaseModel, Field
 from typing import List, Optional, Dict, Any
 from datetime import datetime, timedelta
@@ -7,9 +9,14 @@ import os
 from dotenv import load_dotenv
 import logging
 
+from app.config import EMBEDDING_CURSOR_BATCH_SIZE, QUERY_EMBEDDING_CACHE_TTL, EMBEDDING_CONTENT_CACHE_TTL
+from app.utils.embedding_codec import decode_embedding, is_packed
+
 # Load environment variables
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # MongoDB connection setup
 MONGODB_URL = os.getenv("MONGODB_URL", "mongodb://localhost:27017")
 DATABASE_NAME = os.getenv("DATABASE_NAME", "jcsbot")
@@ -26,6 +33,14 @@ embeddings_collection = db["embeddings"]
 knowledge_base_collection = db["knowledge_base"]
 usage_collection = db["usage"]
 deleted_documents_collection = db["deleted_documents"]
+query_embedding_cache_collection = db["query_embedding_cache"]
+embedding_cache_collection = db["embedding_cache"]
+document_contents_collection = db["document_contents"]
+ingestion_jobs_collection = db["ingestion_jobs"]
+embedding_migrations_collection = db["embedding_migrations"]
+
+# Owner id of chunk embeddings stored once per file hash and shared by every user who uploaded the file
+SHARED_CONTENT_OWNER = "shared_content"
 chat_metrics_collection = db["chat_metrics"]
 
 # Models
@@ -57,6 +72,10 @@ class Document(BaseModel):
     embeddings: List[float] = []
     created_at: datetime = Field(default_factory=datetime.utcnow)
     is_knowledge_base: bool = False 
+    # File hash of the shared content entry holding this document's text and chunks
+    content_ref: Optional[str] = None
+    # [start, end) offsets of each page in `content` (see app.utils.chunking.page_spans)
+    page_spans: List[List[int]] = []
 
 class ChatMessage(BaseModel):
     user_id: str
@@ -123,8 +142,166 @@ async def get_document(file_hash: str, user_id: str) -> Optional[Document]:
         "file_hash": file_hash,
         "user_id": user_id
     })
+    if doc_data:
+        await hydrate_document_content(doc_data)
     return Document(**doc_data) if doc_data else None
 
+# --- Shared document content (cross-user dedupe by file hash) ---
+
+async def hydrate_document_content(doc: Dict[str, Any]) -> Dict[str, Any]:
+    """Fill in the text of a per-user document row that references shared content."""
+    if doc.get("content_ref") and not doc.get("content"):
+        shared = await document_contents_collection.find_one({"_id": doc["content_ref"]}, projection={"content": 1})
+        if shared:
+            doc["content"] = shared.get("content", "")
+    return doc
+
+async def acquire_shared_content(file_hash: str) -> Optional[Dict[str, Any]]:
+    """Take a reference on fully ingested shared content; None when there is none yet."""
+    return await document_contents_collection.find_one_and_update(
+        {"_id": file_hash, "has_embeddings": True},
+        {"$inc": {"ref_count": 1}, "$set": {"last_referenced_at": datetime.utcnow()}},
+        projection={"content": 0},
+        return_document=ReturnDocument.AFTER
+    )
+
+async def claim_shared_content(file_hash: str, claim: str, lease_seconds: int) -> bool:
+    """
+    Claim the ingestion of a file's shared content. Only one upload holds the claim at a
+    time; it alone may write the shared chunk rows. Fails while content is ready or another
+    upload holds an unexpired lease.
+    """
+    now = datetime.utcnow()
+    try:
+        await document_contents_collection.update_one(
+            {
+                "_id": file_hash,
+                "has_embeddings": {"$ne": True},
+                "$or": [{"lease_owner": None}, {"lease_expires_at": {"$lt": now}}],
+            },
+            {
+                "$set": {
+                    "state": "ingesting",
+                    "lease_owner": claim,
+                    "lease_expires_at": now + timedelta(seconds=lease_seconds),
+                },
+                "$setOnInsert": {"ref_count": 0, "has_embeddings": False, "created_at": now},
+            },
+            upsert=True
+        )
+    except DuplicateKeyError:
+        return False
+    return True
+
+async def renew_shared_content_claim(file_hash: str, claim: str, lease_seconds: int) -> bool:
+    """Extend the lease of a claim; False when it was lost to another upload."""
+    result = await document_contents_collection.update_one(
+        {"_id": file_hash, "lease_owner": claim},
+        {"$set": {"lease_expires_at": datetime.utcnow() + timedelta(seconds=lease_seconds)}}
+    )
+    return result.matched_count == 1
+
+async def abandon_shared_content_claim(file_hash: str, claim: str) -> None:
+    """
+    Give up a claim that did not publish, so a waiting upload can take it at once. An entry
+    nobody references is removed together with any chunk rows the failed run left.
+    """
+    result = await document_contents_collection.delete_one(
+        {"_id": file_hash, "lease_owner": claim, "ref_count": {"$lte": 0}, "has_embeddings": {"$ne": True}}
+    )
+    if result.deleted_count:
+        await embeddings_collection.delete_many({"document_hash": file_hash, "user_id": SHARED_CONTENT_OWNER})
+        return
+    await document_contents_collection.update_one(
+        {"_id": file_hash, "lease_owner": claim},
+        {"$set": {"state": "failed", "lease_owner": None, "lease_expires_at": None}}
+    )
+
+async def publish_shared_content(document: Document, claim: str, chunk_count: int) -> Optional[Dict[str, Any]]:
+    """
+    Store the extracted text of a claimed file, mark its `chunk_count` chunk rows complete and
+    take the uploader's reference, all in one update. None when the claim was lost.
+    """
+    now = datetime.utcnow()
+    return await document_contents_collection.find_one_and_update(
+        {"_id": document.file_hash, "lease_owner": claim},
+        {
+            "$set": {
+                "content": document.content,
+                "doc_type": document.doc_type,
+                "page_count": document.page_count,
+                "page_spans": document.page_spans,
+                "token_count": document.token_count,
+                "chunk_count": chunk_count,
+                "has_embeddings": True,
+                "state": "ready",
+                "lease_owner": None,
+                "lease_expires_at": None,
+                "last_referenced_at": now,
+            },
+            "$inc": {"ref_count": 1},
+        },
+        projection={"content": 0},
+        return_document=ReturnDocument.AFTER
+    )
+
+async def release_shared_content(file_hash: str) -> bool:
+    """
+    Drop one reference to shared content. The last reference deletes the text and the
+    shared chunk embeddings; returns True when that happened.
+    """
+    shared = await document_contents_collection.find_one_and_update(
+        {"_id": file_hash},
+        {"$inc": {"ref_count": -1}},
+        projection={"ref_count": 1},
+        return_document=ReturnDocument.AFTER
+    )
+    if not shared or shared.get("ref_count", 0) > 0:
+        return False
+    # Only collect if no new reference arrived in the meantime
+    result = await document_contents_collection.delete_one({"_id": file_hash, "ref_count": {"$lte": 0}})
+    if result.deleted_count:
+        await embeddings_collection.delete_many({"document_hash": file_hash, "user_id": SHARED_CONTENT_OWNER})
+        logger.info(f"Collected shared content of {file_hash} after its last reference was deleted")
+        return True
+    return False
+
+async def release_user_shared_content(user_ids: List[str]) -> List[str]:
+    """Release the shared content references of every document of the given users; returns collected hashes."""
+    cursor = documents_collection.find(
+        {"user_id": {"$in": list(user_ids)}, "content_ref": {"$ne": None}},
+        projection={"_id": 0, "content_ref": 1}
+    )
+    collected = []
+    async for doc in cursor:
+        if await release_shared_content(doc["content_ref"]):
+            collected.append(doc["content_ref"])
+    return collected
+
+async def resolve_embedding_owners(file_hashes: List[str], user_id: str) -> Dict[str, str]:
+    """
+    Owner id under which each document's chunk embeddings are stored: the shared owner
+    for documents backed by shared content, else the user. Hashes the user has no
+    document for are left out.
+    """
+    if not file_hashes:
+        return {}
+    cursor = documents_collection.find(
+        {"file_hash": {"$in": list(file_hashes)}, "user_id": user_id},
+        projection={"_id": 0, "file_hash": 1, "content_ref": 1}
+    )
+    return {doc["file_hash"]: SHARED_CONTENT_OWNER if doc.get("content_ref") else user_id async for doc in cursor}
+
+async def get_document_names(file_hashes: List[str], user_id: str) -> Dict[str, str]:
+    """Filenames of several documents in one query; hashes without a document are left out."""
+    if not file_hashes:
+        return {}
+    cursor = documents_collection.find(
+        {"file_hash": {"$in": list(file_hashes)}, "user_id": user_id},
+        projection={"_id": 0, "file_hash": 1, "filename": 1}
+    )
+    return {doc["file_hash"]: doc.get("filename") or f"Document {doc['file_hash'][:8]}..." async for doc in cursor}
+
 async def save_chat_message(message: ChatMessage) -> None:
     await chat_history_collection.insert_one(message.dict())
 
@@ -138,6 +315,22 @@ async def get_user_chat_history(user_id: str, limit: int = 10) -> List[ChatMessa
 async def save_document_embedding(embedding: DocumentEmbedding) -> None:
     await embeddings_collection.insert_one(embedding.dict())
 
+# Fields needed to rebuild a document's embedding matrix (both row layouts, packed or legacy vectors)
+EMBEDDING_ROW_PROJECTION = {
+    "_id": 0, "document_hash": 1, "chunk_id": 1, "chunk_index": 1, "text": 1, "chunk_text": 1,
+    "embedding": 1, "embedding_dtype": 1, "embedding_dim": 1, "embedding_scale": 1, "embedding_version": 1,
+}
+
+def _embedding_model(row: Dict[str, Any]) -> DocumentEmbedding:
+    """Build a DocumentEmbedding from a checked row without re-validating every vector element."""
+    return DocumentEmbedding.construct(
+        document_hash=row["document_hash"],
+        chunk_id=row["chunk_id"],
+        text=row["text"],
+        embedding=decode_embedding(row).tolist() if is_packed(row) else row["embedding"],
+        user_id=row["user_id"],
+    )
+
 async def get_document_embeddings(document_hash: str, user_id: str = None) -> List[DocumentEmbedding]:
     """Get embeddings for a document."""
     try:
@@ -145,7 +338,8 @@ async def get_document_embeddings(document_hash: str, user_id: str = None) -> Li
         if user_id:
             query["user_id"] = user_id
             
-        embeddings = await embeddings_collection.find(query).to_list(length=None)
+        cursor = embeddings_collection.find(query, projection={**EMBEDDING_ROW_PROJECTION, "user_id": 1})
+        embeddings = await cursor.batch_size(EMBEDDING_CURSOR_BATCH_SIZE).to_list(length=None)
         
         if not embeddings:
             logger.warning(f"No embeddings found for document {document_hash}")
@@ -154,6 +348,12 @@ async def get_document_embeddings(document_hash: str, user_id: str = None) -> Li
         # Add validation to ensure required fields exist
         valid_embeddings = []
         for emb in embeddings:
+            # Rows written by generate_and_store_embeddings use chunk_index/chunk_text
+            if 'chunk_id' not in emb and 'chunk_index' in emb:
+                emb['chunk_id'] = emb['chunk_index']
+            if 'text' not in emb and 'chunk_text' in emb:
+                emb['text'] = emb['chunk_text']
+
             # Check if required fields exist
             if 'chunk_id' not in emb or 'text' not in emb:
                 logger.warning(f"Embedding document missing required fields: {emb.get('_id')}")
@@ -163,34 +363,36 @@ async def get_document_embeddings(document_hash: str, user_id: str = None) -> Li
             if 'embedding' not in emb or not emb['embedding']:
                 logger.warning(f"Embedding field missing for chunk {emb.get('chunk_id')}")
                 continue
-                
+
             valid_embeddings.append(emb)
             
         if len(valid_embeddings) < len(embeddings):
             logger.warning(f"Filtered out {len(embeddings) - len(valid_embeddings)} invalid embeddings")
             
-        # Only create DocumentEmbedding objects for valid embeddings
-        return [DocumentEmbedding(**emb) for emb in valid_embeddings]
+        # Only create DocumentEmbedding objects for valid embeddings (packed vectors are decoded here)
+        return [_embedding_model(emb) for emb in valid_embeddings]
     except Exception as e:
         logger.error(f"Error retrieving embeddings for document {document_hash}: {e}")
         return []
 
+def find_embeddings_for_documents(document_hashes: List[str], user_id: str):
+    """One cursor over the chunk rows of several documents, to be consumed with `async for`."""
+    return embeddings_collection.find(
+        {"document_hash": {"$in": list(document_hashes)}, "user_id": user_id},
+        projection=EMBEDDING_ROW_PROJECTION
+    ).batch_size(EMBEDDING_CURSOR_BATCH_SIZE)
+
 async def get_document_embeddings_for_document(document_hash: str, user_id: str) -> List[DocumentEmbedding]:
     """Get document embeddings for a specific document."""
     cursor = embeddings_collection.find({
         "document_hash": document_hash,
         "user_id": user_id
-    })
+    }, projection={**EMBEDDING_ROW_PROJECTION, "user_id": 1}).batch_size(EMBEDDING_CURSOR_BATCH_SIZE)
     embeddings = []
     async for doc in cursor:
-        embedding = DocumentEmbedding(
-            document_hash=doc["document_hash"],
-            chunk_id=doc["chunk_id"],
-            text=doc["text"],
-            embedding=doc["embedding"],
-            user_id=doc["user_id"]
-        )
-        embeddings.append(embedding)
+        doc.setdefault("chunk_id", doc.get("chunk_index"))
+        doc.setdefault("text", doc.get("chunk_text"))
+        embeddings.append(_embedding_model(doc))
     return embeddings
 
 async def create_indexes():
@@ -231,6 +433,28 @@ async def setup_mongodb_indexes():
     await embeddings_collection.create_index([("document_hash", 1), ("user_id", 1)])
     await embeddings_collection.create_index([("document_hash", 1), ("chunk_id", 1)])
     await embeddings_collection.create_index("user_id")
+    # Re-embedding migrations look for rows that are not at the target version yet
+    await embeddings_collection.create_index("embedding_version")
+
+    # Shared content references are looked up per user when releasing them
+    await documents_collection.create_index("content_ref")
+    # Re-uploads look up the user's earlier document with the same filename
+    await documents_collection.create_index([("user_id", 1), ("filename", 1), ("created_at", -1)])
+
+    # Ingestion queue: workers claim by state and due time, users list their recent jobs
+    await ingestion_jobs_collection.create_index([("state", 1), ("available_at", 1)])
+    await ingestion_jobs_collection.create_index([("user_id", 1), ("created_at", -1)])
+
+    # Persistent prompt embedding cache entries expire on their own
+    await query_embedding_cache_collection.create_index(
+        "created_at",
+        expireAfterSeconds=QUERY_EMBEDDING_CACHE_TTL
+    )
+    # So do chunk embedding cache entries; the collection would otherwise grow with every chunk ever embedded
+    await embedding_cache_collection.create_index(
+        "created_at",
+        expireAfterSeconds=EMBEDDING_CONTENT_CACHE_TTL
+    )
 
 knowledge_base_collection = db["knowledge_base"]
 
@@ -244,6 +468,8 @@ async def get_document_with_full_content(document_hash: str, user_id: str):
     if not doc:
         return None
     
+    await hydrate_document_content(doc)
+
     # Ensure content is available and not empty
     if "content" not in doc or not doc["content"]:
         logger.warning(f"Document {document_hash} has no content")
@@ -4,6 +4,9 @@ from fastapi.exceptions import RequestValidationError
 from app.api.routes import users, core
 from app.config import create_app
 from app.api.routes import admin
+from app.config import INGESTION_RUN_IN_PROCESS
+from app.services.ingestion_jobs import ingestion_workers
+from app.utils.token_counter import token_counter
 
 # Create FastAPI app with configuration
 app = create_app()
@@ -13,6 +16,17 @@ app.include_router(users.router)
 app.include_router(core.router)
 app.include_router(admin.router)
 
+@app.on_event("startup")
+async def start_ingestion_workers():
+    # Without in-process workers, run ingestion_worker.py next to the API
+    if INGESTION_RUN_IN_PROCESS:
+        ingestion_workers.start()
+
+@app.on_event("shutdown")
+async def stop_ingestion_workers():
+    await ingestion_workers.stop()
+    token_counter.shutdown()
+
 @app.exception_handler(RequestValidationError)
 async def validation_exception_handler(request: Request, exc: RequestValidationError):
     print(f"Validation error: {exc.errors()}")
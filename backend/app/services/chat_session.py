@@ -5,28 +5,24 @@ from datetime import datetime, timedelta
 import uuid
 import logging
 import re
-# import numpy as np # Only if you are using numpy for cosine_similarity directly
+
+import numpy as np
+
+from app.config import ANN_MIN_CHUNKS
 
 # Make sure these are correctly imported
 from app.db.mongodb import (
     chat_history_collection,
-    get_document_embeddings,  # Crucial for fetching chunk text
-    get_document_embeddings_for_document,  # Added for fetching embeddings for a specific document
-    get_document  # Added for fetching full document content as fallback
+    get_document,  # Added for fetching full document content as fallback
+    get_document_names
 )
-from app.utils.embeddings import get_embedding
+from app.utils.embeddings import EmbeddingService, EmbeddingError, embedding_service
+from app.utils.similarity import normalize_vector, top_k_indices
+from app.services.vector_store import get_document_vectors, get_documents_vectors, get_document_index, forget_document_vectors
+from app.services.vector_cache import vector_cache
 
 logger = logging.getLogger(__name__)
 
-def cosine_similarity(vec1, vec2):
-    """Calculate cosine similarity between two vectors."""
-    dot_product = sum(a * b for a, b in zip(vec1, vec2))
-    magnitude1 = sum(a * a for a in vec1) ** 0.5
-    magnitude2 = sum(b * b for b in vec2) ** 0.5
-    if magnitude1 * magnitude2 == 0:
-        return 0
-    return dot_product / (magnitude1 * magnitude2)
-
 def is_valid_session_id(session_id):
     """Check if the session ID is a valid UUID or a custom format."""
     if not session_id or not isinstance(session_id, str):
@@ -193,88 +189,112 @@ class ChatSession:
             return "", []
         
         logger.info(f"Session {self.session_id}: Getting document context for prompt. Active docs: {self.active_documents}")
-        prompt_embedding = get_embedding(prompt)
-        if not prompt_embedding:
-            logger.warning(f"Session {self.session_id}: Could not generate embedding for prompt: '{prompt[:100]}...'")
+        try:
+            prompt_embedding = await embedding_service.embed_query(prompt)
+        except EmbeddingError as e:
+            logger.warning(f"Session {self.session_id}: Could not generate embedding for prompt: '{prompt[:100]}...' ({e})")
             return "", []
 
-        document_contexts_parts = []
         used_document_hashes = set()
         all_relevant_chunk_texts = []
 
-        # First, get all document metadata in one go
-        document_metadata = {}
-        for doc_hash in self.active_documents:
-            try:
-                doc = await get_document(doc_hash, self.user_id)
-                if doc and hasattr(doc, 'filename'):
-                    document_metadata[doc_hash] = doc.filename
-                else:
-                    document_metadata[doc_hash] = f"Document {doc_hash[:8]}..."
-            except Exception as e:
-                logger.warning(f"Session {self.session_id}: Could not fetch metadata for document {doc_hash}: {e}")
-                document_metadata[doc_hash] = f"Document {doc_hash[:8]}..."
-        
+        # Filenames of all active documents in one query
+        try:
+            document_metadata = await get_document_names(self.active_documents, self.user_id)
+            for doc_hash in self.active_documents:
+                if doc_hash not in document_metadata:
+                    # Deleted (possibly by another worker or node): drop its cached and stored vectors
+                    forget_document_vectors(self.user_id, doc_hash)
+        except Exception as e:
+            logger.warning(f"Session {self.session_id}: Could not fetch document metadata: {e}")
+            document_metadata = {}
+
+        # Matrices come from the process cache or local store; the rest are rebuilt in one round trip
+        try:
+            vectors_by_hash = await get_documents_vectors(self.active_documents, self.user_id)
+        except Exception as e:
+            logger.error(f"Session {self.session_id}: Error loading document embeddings: {e}", exc_info=True)
+            vectors_by_hash = {}
+
+        # Score every active document against the prompt. Documents below ANN_MIN_CHUNKS that share
+        # an embedding space are stacked into one cached contiguous matrix and scored with a single
+        # matmul; larger ones use their IVF index.
+        queries = {embedding_service.version: normalize_vector(prompt_embedding)}
+        single_document = len(self.active_documents) == 1
+        matches: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+        fallbacks: Dict[str, str] = {}
+        stacked: Dict[Tuple[str, int], List[str]] = {}
         for doc_hash in self.active_documents:
             doc_name = document_metadata.get(doc_hash, f"Document {doc_hash[:8]}...")
-            logger.debug(f"Session {self.session_id}: Fetching embeddings for document: {doc_name} ({doc_hash})")
             try:
-                chunk_embeddings_data = await get_document_embeddings(doc_hash, self.user_id) 
+                vectors = vectors_by_hash.get(doc_hash)
                 
-                if not chunk_embeddings_data:
+                if not vectors:
                     logger.warning(f"Session {self.session_id}: No valid embeddings found for document: {doc_name}")
                     # Try to get the full document as fallback
                     document_object = await get_document(doc_hash, self.user_id)
                     if document_object and hasattr(document_object, 'content') and document_object.content:
                         logger.info(f"Session {self.session_id}: Using full document content as fallback for {doc_name}")
-                        all_relevant_chunk_texts.append(f"[Content from {doc_name}]:\n{document_object.content[:5000]}")
-                        used_document_hashes.add(doc_hash)
+                        fallbacks[doc_hash] = f"[Content from {doc_name}]:\n{document_object.content[:5000]}"
                     continue
                 
-                similarities = []
-                for chunk_data in chunk_embeddings_data:
-                    if hasattr(chunk_data, 'embedding') and hasattr(chunk_data, 'text') and chunk_data.embedding:
-                        try:
-                            similarity = cosine_similarity(prompt_embedding, chunk_data.embedding)
-                            similarities.append((similarity, chunk_data.text, chunk_data.chunk_id)) # Store text and chunk_id
-                        except Exception as e:
-                            logger.error(f"Session {self.session_id}: Error calculating similarity for chunk {chunk_data.chunk_id} in doc {doc_hash}: {e}", exc_info=False)
-                    else:
-                        logger.warning(f"Session {self.session_id}: Skipping chunk in doc {doc_hash} due to missing text or embedding.")
-                
-                if not similarities:
-                    logger.debug(f"Session {self.session_id}: No valid similarities calculated for doc_hash: {doc_hash}")
+                # Documents not yet re-embedded with the current model are searched in their own vector space
+                version = vectors.version or embedding_service.version
+                if version not in queries:
+                    queries[version] = normalize_vector(await EmbeddingService.for_version(version).embed_query(prompt))
+                doc_query = queries[version]
+
+                if vectors.dim != doc_query.shape[0]:
+                    logger.warning(f"Session {self.session_id}: Skipping doc {doc_hash}: embedding dimension {vectors.dim} does not match prompt dimension {doc_query.shape[0]}")
                     continue
 
-                similarities.sort(reverse=True, key=lambda x: x[0])
-                
-                doc_relevant_texts = []
-                for i, (sim, text, chunk_id) in enumerate(similarities):
-                    if i < top_k_chunks and sim >= similarity_threshold:
-                        doc_name = document_metadata.get(doc_hash, f"Document {doc_hash[:8]}...")
-                        logger.info(f"Session {self.session_id}: Using chunk {chunk_id} from {doc_name} (similarity: {sim:.4f})")
-                        doc_relevant_texts.append(f"[Content from {doc_name}, Chunk {chunk_id}]:\n{text}")
-                        used_document_hashes.add(doc_hash)
-                    elif i < top_k_chunks and len(self.active_documents) == 1 and i < 1: # If only one doc, take at least top one if not meeting threshold
-                        doc_name = document_metadata.get(doc_hash, f"Document {doc_hash[:8]}...")
-                        logger.info(f"Session {self.session_id}: Using chunk {chunk_id} from single active doc {doc_name} (similarity: {sim:.4f}, below threshold but top chunk)")
-                        doc_relevant_texts.append(f"[Content from {doc_name}, Chunk {chunk_id}]:\n{text}")
-                        used_document_hashes.add(doc_hash)
-                
-                if doc_relevant_texts:
-                     all_relevant_chunk_texts.extend(doc_relevant_texts)
+                if len(vectors) < ANN_MIN_CHUNKS:
+                    stacked.setdefault((version, vectors.dim), []).append(doc_hash)
+                    continue
+
+                index = await get_document_index(doc_hash, self.user_id, vectors)
+                matches[doc_hash] = index.search(doc_query, top_k_chunks)
             except Exception as e:
                 logger.error(f"Session {self.session_id}: Error processing document {doc_hash}: {e}", exc_info=True)
-                # Try to get the full document as fallback
-                try:
-                    document_object = await get_document(doc_hash, self.user_id)
-                    if document_object and hasattr(document_object, 'content') and document_object.content:
-                        doc_name = document_metadata.get(doc_hash, f"Document {doc_hash[:8]}...")
-                        logger.info(f"Session {self.session_id}: Using full document content as fallback after error for {doc_name}")
-                        all_relevant_chunk_texts.append(f"[Content from {doc_name}]:\n{document_object.content[:5000]}")
-                        used_document_hashes.add(doc_hash)
-                except Exception as inner_e:
-                    logger.error(f"Session {self.session_id}: Error getting fallback document content for {doc_hash}: {inner_e}")
+                await self._add_fallback_after_error(doc_hash, doc_name, fallbacks)
+
+        for (version, dim), doc_hashes in stacked.items():
+            try:
+                parts = [vectors_by_hash[doc_hash] for doc_hash in doc_hashes]
+                matrix = vector_cache.stacked_matrix(self.user_id, (version, dim, *doc_hashes), parts)
+                scores = matrix @ queries[version]
+                offsets = np.cumsum([0] + [len(p) for p in parts])
+                for i, doc_hash in enumerate(doc_hashes):
+                    doc_scores = scores[offsets[i]:offsets[i + 1]]
+                    top = top_k_indices(doc_scores, top_k_chunks)
+                    matches[doc_hash] = (top, doc_scores[top])
+            except Exception as e:
+                logger.error(f"Session {self.session_id}: Error scoring {len(doc_hashes)} stacked documents: {e}", exc_info=True)
+                for doc_hash in doc_hashes:
+                    doc_name = document_metadata.get(doc_hash, f"Document {doc_hash[:8]}...")
+                    await self._add_fallback_after_error(doc_hash, doc_name, fallbacks)
+
+        # Collect context in the order of the active documents
+        for doc_hash in self.active_documents:
+            if doc_hash in fallbacks:
+                all_relevant_chunk_texts.append(fallbacks[doc_hash])
+                used_document_hashes.add(doc_hash)
+                continue
+            if doc_hash not in matches:
+                continue
+            doc_name = document_metadata.get(doc_hash, f"Document {doc_hash[:8]}...")
+            vectors = vectors_by_hash[doc_hash]
+            top_ids, top_scores = matches[doc_hash]
+            for rank, (idx, sim) in enumerate(zip(top_ids.tolist(), top_scores.tolist())):
+                chunk_id = vectors.chunk_ids[idx]
+                if sim >= similarity_threshold:
+                    logger.info(f"Session {self.session_id}: Using chunk {chunk_id} from {doc_name} (similarity: {sim:.4f})")
+                elif single_document and rank == 0: # If only one doc, take at least top one if not meeting threshold
+                    logger.info(f"Session {self.session_id}: Using chunk {chunk_id} from single active doc {doc_name} (similarity: {sim:.4f}, below threshold but top chunk)")
+                else:
+                    continue
+                all_relevant_chunk_texts.append(f"[Content from {doc_name}, Chunk {chunk_id}]:\n{vectors.texts[idx]}")
+                used_document_hashes.add(doc_hash)
         
         if not all_relevant_chunk_texts:
             logger.info(f"Session {self.session_id}: No document chunks found relevant enough for the prompt.")
@@ -284,6 +304,16 @@ class ChatSession:
         logger.info(f"Session {self.session_id}: Combined document context generated (length: {len(combined_context)}). Used {len(used_document_hashes)} documents.")
         return combined_context, list(used_document_hashes)
 
+    async def _add_fallback_after_error(self, doc_hash: str, doc_name: str, fallbacks: Dict[str, str]):
+        """Use the start of the full document content when its chunks could not be searched."""
+        try:
+            document_object = await get_document(doc_hash, self.user_id)
+            if document_object and hasattr(document_object, 'content') and document_object.content:
+                logger.info(f"Session {self.session_id}: Using full document content as fallback after error for {doc_name}")
+                fallbacks[doc_hash] = f"[Content from {doc_name}]:\n{document_object.content[:5000]}"
+        except Exception as inner_e:
+            logger.error(f"Session {self.session_id}: Error getting fallback document content for {doc_hash}: {inner_e}")
+
     async def get_document_context_for_specific_document(self, prompt: str, document_hash: str) -> Tuple[str, List[str]]:
         """Get document context from a specific document only."""
         try:
@@ -291,10 +321,9 @@ class ChatSession:
             doc = await get_document(document_hash, self.user_id)
             doc_name = doc.filename if doc and hasattr(doc, 'filename') else f"Document {document_hash[:8]}..."
             
-            prompt_embedding = get_embedding(prompt)
-            document_embeddings = await get_document_embeddings_for_document(document_hash, self.user_id)
+            vectors = await get_document_vectors(document_hash, self.user_id)
             
-            if not document_embeddings:
+            if not vectors:
                 logger.warning(f"No embeddings found for document {doc_name} ({document_hash})")
                 # Try to get the full document as fallback
                 if doc and hasattr(doc, 'content') and doc.content:
@@ -302,26 +331,33 @@ class ChatSession:
                     return f"[Content from {doc_name}]:\n{doc.content[:5000]}", [document_hash]
                 return "", []
             
-            similarities = []
-            for embedding in document_embeddings:
-                similarity = cosine_similarity(prompt_embedding, embedding.embedding)
-                similarities.append((embedding, similarity))
-            
-            similarities.sort(key=lambda x: x[1], reverse=True)
+            try:
+                prompt_embedding = await EmbeddingService.for_version(vectors.version).embed_query(prompt)
+            except EmbeddingError as e:
+                logger.warning(f"Session {self.session_id}: Could not generate embedding for prompt: '{prompt[:100]}...' ({e})")
+                return "", []
+
+            if vectors.dim != len(prompt_embedding):
+                logger.warning(f"Session {self.session_id}: Embedding dimension {vectors.dim} of {doc_name} does not match prompt dimension {len(prompt_embedding)}")
+                return "", []
+
+            index = await get_document_index(document_hash, self.user_id, vectors)
+            top_ids, top_scores = index.search(prompt_embedding, 5)
             
             threshold = 0.7
             top_chunks = []
             used_documents = []
             
-            for embedding, similarity in similarities[:5]:
+            for idx, similarity in zip(top_ids.tolist(), top_scores.tolist()):
+                chunk_id = vectors.chunk_ids[idx]
                 if similarity > threshold or len(top_chunks) < 1:
-                    chunk_text = f"[Content from {doc_name}, Chunk {embedding.chunk_id}]:\n{embedding.text}\n\n"
+                    chunk_text = f"[Content from {doc_name}, Chunk {chunk_id}]:\n{vectors.texts[idx]}\n\n"
                     top_chunks.append(chunk_text)
-                    if embedding.document_hash not in used_documents:
-                        used_documents.append(embedding.document_hash)
-                    logger.info(f"Session {self.session_id}: Using chunk {embedding.chunk_id} from {doc_name} (similarity: {similarity:.4f})")
+                    if document_hash not in used_documents:
+                        used_documents.append(document_hash)
+                    logger.info(f"Session {self.session_id}: Using chunk {chunk_id} from {doc_name} (similarity: {similarity:.4f})")
                 else:
-                    logger.info(f"Session {self.session_id}: Skipping chunk {embedding.chunk_id} from {doc_name} (similarity: {similarity:.4f}, below threshold)")
+                    logger.info(f"Session {self.session_id}: Skipping chunk {chunk_id} from {doc_name} (similarity: {similarity:.4f}, below threshold)")
             
             combined_context = "".join(top_chunks)
             logger.info(f"Session {self.session_id}: Combined document context generated (length: {len(combined_context)}). Used {len(used_documents)} documents.")
@@ -0,0 +1,95 @@
+# backend/app/services/chunk_reuse.py
+
+from typing import Dict, List, Optional, Sequence
+import logging
+
+import numpy as np
+
+from app.db.mongodb import documents_collection, embeddings_collection, SHARED_CONTENT_OWNER
+from app.utils.embedding_codec import decode_embedding, row_embedding_version
+from app.utils.embeddings import embedding_service
+from app.utils.hashing import chunk_content_hash
+
+logger = logging.getLogger(__name__)
+
+# Row fields needed to copy an embedding from an earlier upload
+_REUSE_PROJECTION = {
+    "_id": 0, "chunk_hash": 1, "embedding": 1, "embedding_dtype": 1, "embedding_dim": 1,
+    "embedding_scale": 1, "embedding_norm": 1, "embedding_version": 1,
+}
+
+
+class PreviousUpload:
+    """
+    Chunk rows of an earlier upload of the same file (same user and filename, different
+    bytes). Unchanged chunks of a re-uploaded document are normally served by the
+    content-addressed embedding cache; this is the fallback for the chunks the cache
+    misses (persistent tier turned off, entries expired or evicted). Only those are
+    looked up by content hash among the earlier upload's rows, and copies are written
+    back to the cache, before anything goes to the embedding API.
+    """
+
+    def __init__(self, document_hash: str, owner: str, filename: str):
+        self.document_hash = document_hash
+        self.owner = owner
+        self.filename = filename
+        self.reused = 0
+        self.embedded = 0
+
+    async def _lookup(self, hashes: List[str]) -> Dict[str, np.ndarray]:
+        """Embeddings of the earlier upload's chunks with the given hashes, at the current version."""
+        found: Dict[str, np.ndarray] = {}
+        cursor = embeddings_collection.find(
+            {"document_hash": self.document_hash, "user_id": self.owner, "chunk_hash": {"$in": list(set(hashes))}},
+            projection=_REUSE_PROJECTION
+        )
+        async for row in cursor:
+            if row["chunk_hash"] in found or row_embedding_version(row) != embedding_service.version:
+                continue
+            vector = decode_embedding(row)
+            if vector is not None:
+                # Rows hold the unit vector; restore the original length so the copy matches a fresh embedding
+                found[row["chunk_hash"]] = vector * np.float32(row.get("embedding_norm", 1.0))
+        return found
+
+    async def _recover(self, chunks: List[str]) -> Dict[int, np.ndarray]:
+        """Embeddings the earlier upload has for `chunks` (the embedding cache's misses), by position."""
+        hashes = [chunk_content_hash(chunk) for chunk in chunks]
+        found = await self._lookup(hashes)
+        recovered = {i: found[h] for i, h in enumerate(hashes) if h in found}
+        self.reused += len(recovered)
+        self.embedded += len(chunks) - len(recovered)
+        return recovered
+
+    async def embed(self, chunks: Sequence[str], token_counts: Optional[Sequence[int]] = None) -> np.ndarray:
+        """Embeddings of `chunks` in input order; cache misses are copied from the earlier upload when it has them."""
+        return await embedding_service.embed(chunks, lookup=self._recover, token_counts=token_counts)
+
+
+async def find_previous_upload(filename: str, user_id: str, file_hash: str) -> Optional[PreviousUpload]:
+    """The user's most recent embedded document with the same filename and different contents, if any."""
+    doc = await documents_collection.find_one(
+        {"user_id": user_id, "filename": filename, "file_hash": {"$ne": file_hash}},
+        projection={"_id": 0, "file_hash": 1, "content_ref": 1},
+        sort=[("created_at", -1)]
+    )
+    if not doc:
+        return None
+    # Chunks of documents backed by shared content live under the shared owner
+    if doc.get("content_ref"):
+        previous = PreviousUpload(doc["content_ref"], SHARED_CONTENT_OWNER, filename)
+    else:
+        previous = PreviousUpload(doc["file_hash"], user_id, filename)
+    logger.info(f"{filename} of {user_id} replaces document {previous.document_hash}; unchanged chunks reuse its embeddings")
+    return previous
+
+
+async def embed_chunks(chunks: Sequence[str], previous: Optional[PreviousUpload] = None,
+                       token_counts: Optional[Sequence[int]] = None) -> np.ndarray:
+    """
+    Embed document chunks, copying unchanged ones from `previous` when it is given.
+    `token_counts` are the chunker's embedding-model counts of the chunks.
+    """
+    if previous is None:
+        return await embedding_service.embed(chunks, token_counts=token_counts)
+    return await previous.embed(chunks, token_counts)
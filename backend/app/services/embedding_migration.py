@@ -0,0 +1,215 @@
+# backend/app/services/embedding_migration.py
+
+from datetime import datetime, timedelta
+from typing import Any, AsyncIterator, Dict, List, Optional
+import logging
+import os
+import socket
+import uuid
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from app.config import (
+    EMBEDDING_LEGACY_VERSION, EMBEDDING_MIGRATION_CONCURRENCY, EMBEDDING_MIGRATION_LOCK_SECONDS
+)
+from app.db.mongodb import embeddings_collection, embedding_migrations_collection
+from app.services.knowledge_index import KB_USER_ID, kb_index
+from app.services.vector_store import forget_document_vectors
+from app.utils.embedding_codec import encode_embedding
+from app.utils.embeddings import EmbeddingService
+
+logger = logging.getLogger(__name__)
+
+MIGRATION_RUNNING = "running"
+MIGRATION_PAUSED = "paused"
+MIGRATION_COMPLETED = "completed"
+
+INSERT_BATCH = 500
+
+# Row fields replaced when a chunk is re-embedded
+_EMBEDDING_FIELDS = (
+    "embedding", "embedding_dtype", "embedding_dim", "embedding_scale", "embedding_norm",
+    "embedding_model", "embedding_version",
+)
+
+
+def stale_rows_filter(target_version: str) -> Dict[str, Any]:
+    """Chunk rows that are not at `target_version` (unversioned rows count as EMBEDDING_LEGACY_VERSION)."""
+    if target_version == EMBEDDING_LEGACY_VERSION:
+        return {"embedding_version": {"$exists": True, "$ne": target_version}}
+    return {"embedding_version": {"$ne": target_version}}
+
+
+def migration_status(migration: Dict[str, Any]) -> Dict[str, Any]:
+    """API view of a migration record."""
+    return {
+        "target_version": migration["_id"],
+        "state": migration.get("state"),
+        "pass": migration.get("pass", 1),
+        "checkpoint": migration.get("checkpoint"),
+        "documents_done": migration.get("documents_done", 0),
+        "chunks_done": migration.get("chunks_done", 0),
+        "failed": migration.get("failed", []),
+        "started_at": migration.get("started_at"),
+        "updated_at": migration.get("updated_at"),
+        "finished_at": migration.get("finished_at"),
+    }
+
+
+async def list_migrations() -> List[Dict[str, Any]]:
+    cursor = embedding_migrations_collection.find({}).sort("started_at", -1)
+    return [migration_status(m) async for m in cursor]
+
+
+class EmbeddingMigration:
+    """
+    Re-embeds every chunk row of the embeddings collection with a new model (or size).
+
+    Documents are migrated one at a time: their chunk texts are embedded with the target
+    model, the new rows are inserted next to the old ones and only then are the old rows
+    deleted, so retrieval always finds a complete set of vectors for the document in one
+    version or the other (see rebuild_documents_vectors) and embeds prompts to match.
+    Progress is checkpointed in the embedding_migrations collection after each document,
+    so a stopped or crashed run resumes where it left off. Requests go through the shared
+    rate limiter with EMBEDDING_MIGRATION_CONCURRENCY in flight, leaving room for live traffic.
+
+    Once it completes, set EMBEDDING_MODEL / EMBEDDING_DIMENSIONS to the target so new
+    uploads and prompts use it too.
+    """
+
+    def __init__(self, model: str, dimensions: Optional[int] = None,
+                 concurrency: int = EMBEDDING_MIGRATION_CONCURRENCY):
+        self.embedder = EmbeddingService(model, dimensions, concurrency=concurrency)
+        self.target_version = self.embedder.version
+        self.runner_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+    async def _acquire(self) -> Optional[Dict[str, Any]]:
+        """Take the migration lock, creating the record on the first run. None if another runner holds it."""
+        now = datetime.utcnow()
+        try:
+            return await embedding_migrations_collection.find_one_and_update(
+                {"_id": self.target_version, "state": {"$ne": MIGRATION_COMPLETED},
+                 "$or": [{"locked_until": {"$lt": now}}, {"locked_until": None}, {"runner": self.runner_id}]},
+                {"$set": {"state": MIGRATION_RUNNING, "runner": self.runner_id, "updated_at": now,
+                          "locked_until": now + timedelta(seconds=EMBEDDING_MIGRATION_LOCK_SECONDS)},
+                 "$setOnInsert": {"checkpoint": None, "pass": 1, "documents_done": 0, "chunks_done": 0,
+                                  "failed": [], "started_at": now, "finished_at": None}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # The record exists but is completed or locked by a live runner
+            return None
+
+    async def _save(self, update: Dict[str, Any], extra: Optional[Dict[str, Any]] = None) -> None:
+        now = datetime.utcnow()
+        update = {"updated_at": now,
+                  "locked_until": now + timedelta(seconds=EMBEDDING_MIGRATION_LOCK_SECONDS), **update}
+        await embedding_migrations_collection.update_one(
+            {"_id": self.target_version, "runner": self.runner_id},
+            {"$set": update, **(extra or {})}
+        )
+
+    def _pending_documents(self, after: Optional[Dict[str, str]]) -> AsyncIterator[Dict[str, Any]]:
+        """(document_hash, user_id) pairs with stale rows, in a stable order starting after the checkpoint."""
+        pipeline: List[Dict[str, Any]] = [
+            {"$match": stale_rows_filter(self.target_version)},
+            {"$group": {"_id": {"document_hash": "$document_hash", "user_id": "$user_id"}}},
+            {"$sort": {"_id.document_hash": 1, "_id.user_id": 1}},
+        ]
+        if after:
+            pipeline.append({"$match": {"$or": [
+                {"_id.document_hash": {"$gt": after["document_hash"]}},
+                {"_id.document_hash": after["document_hash"], "_id.user_id": {"$gt": after["user_id"]}},
+            ]}})
+        return embeddings_collection.aggregate(pipeline, allowDiskUse=True)
+
+    async def migrate_document(self, document_hash: str, user_id: str) -> int:
+        """Re-embed one document's chunks; returns the number migrated. Old rows are kept if any chunk fails."""
+        owner_filter = {"document_hash": document_hash, "user_id": user_id}
+        old_rows = await embeddings_collection.find(
+            {**owner_filter, **stale_rows_filter(self.target_version)},
+            projection={field: 0 for field in _EMBEDDING_FIELDS}
+        ).to_list(length=None)
+        if not old_rows:
+            return 0
+
+        texts = [row.get("chunk_text", row.get("text")) or "" for row in old_rows]
+        # Raises EmbeddingError (keeping the old rows) if any chunk fails
+        embeddings = await self.embedder.embed(texts)
+
+        # Rows left by an interrupted attempt at this document are replaced
+        await embeddings_collection.delete_many({**owner_filter, "embedding_version": self.target_version})
+        new_rows = []
+        now = datetime.utcnow()
+        for row, text, embedding in zip(old_rows, texts, embeddings):
+            if not text.strip():
+                continue
+            new_row = {key: value for key, value in row.items() if key != "_id"}
+            new_row.update(encode_embedding(embedding, version=self.target_version))
+            new_row["reembedded_at"] = now
+            new_rows.append(new_row)
+        for start in range(0, len(new_rows), INSERT_BATCH):
+            await embeddings_collection.insert_many(new_rows[start:start + INSERT_BATCH])
+
+        await embeddings_collection.delete_many({"_id": {"$in": [row["_id"] for row in old_rows]}})
+        # This node's copy is rebuilt from the new rows on next use
+        forget_document_vectors(user_id, document_hash)
+        return len(new_rows)
+
+    async def run(self, max_documents: Optional[int] = None) -> Optional[Dict[str, Any]]:
+        """
+        Migrate until every row is at the target version (or `max_documents` were handled).
+        A first pass walks the documents after the checkpoint; a final pass from the start
+        picks up documents uploaded behind it. Returns the migration status, or None when
+        another runner holds the lock or the migration already completed.
+        """
+        migration = await self._acquire()
+        if migration is None:
+            logger.info(f"Embedding migration to {self.target_version} is completed or running elsewhere")
+            return None
+
+        logger.info(f"Embedding migration to {self.target_version} started by {self.runner_id} "
+                    f"(pass {migration['pass']}, checkpoint {migration['checkpoint']})")
+        failed = set(migration.get("failed", []))
+        handled = 0
+        touched_kb = False
+        current_pass = migration["pass"]
+        checkpoint = migration["checkpoint"]
+
+        while True:
+            async for group in self._pending_documents(checkpoint):
+                document_hash, user_id = group["_id"]["document_hash"], group["_id"]["user_id"]
+                if max_documents is not None and handled >= max_documents:
+                    await self._save({"state": MIGRATION_PAUSED, "locked_until": None})
+                    logger.info(f"Embedding migration to {self.target_version} paused after {handled} documents")
+                    return migration_status(await embedding_migrations_collection.find_one({"_id": self.target_version}))
+                key = f"{user_id}:{document_hash}"
+                checkpoint = {"document_hash": document_hash, "user_id": user_id}
+                handled += 1
+                if key in failed:
+                    continue
+                try:
+                    migrated = await self.migrate_document(document_hash, user_id)
+                except Exception as e:
+                    logger.error(f"Could not re-embed document {document_hash} of {user_id}: {e}", exc_info=True)
+                    failed.add(key)
+                    await self._save({"checkpoint": checkpoint}, {"$addToSet": {"failed": key}})
+                    continue
+                touched_kb = touched_kb or user_id == KB_USER_ID
+                await self._save({"checkpoint": checkpoint}, {"$inc": {"documents_done": 1, "chunks_done": migrated}})
+                logger.info(f"Re-embedded {migrated} chunks of document {document_hash} ({user_id}) as {self.target_version}")
+
+            if current_pass >= 2:
+                break
+            current_pass, checkpoint = 2, None
+            await self._save({"pass": current_pass, "checkpoint": None})
+
+        if touched_kb:
+            await kb_index.rebuild()
+        await self._save({"state": MIGRATION_COMPLETED, "finished_at": datetime.utcnow(), "locked_until": None})
+        status = migration_status(await embedding_migrations_collection.find_one({"_id": self.target_version}))
+        logger.info(f"Embedding migration to {self.target_version} completed: {status['documents_done']} documents, "
+                    f"{status['chunks_done']} chunks, {len(status['failed'])} failed")
+        return status
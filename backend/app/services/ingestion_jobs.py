@@ -0,0 +1,356 @@
+# backend/app/services/ingestion_jobs.py
+
+from contextvars import ContextVar
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+import asyncio
+import logging
+import os
+import shutil
+import socket
+import uuid
+
+from bson.objectid import ObjectId
+from pymongo import ReturnDocument
+
+from app.config import (
+    INGESTION_SPOOL_DIR, INGESTION_WORKERS, INGESTION_LEASE_SECONDS,
+    INGESTION_MAX_ATTEMPTS, INGESTION_POLL_INTERVAL
+)
+from app.db.mongodb import ingestion_jobs_collection
+
+logger = logging.getLogger(__name__)
+
+# Job states
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_SUCCEEDED = "succeeded"
+JOB_FAILED = "failed"
+FINISHED_STATES = (JOB_SUCCEEDED, JOB_FAILED)
+
+# Job kinds
+KIND_FILE = "file"              # extract, chunk and embed an uploaded file
+KIND_EMBEDDINGS = "embeddings"  # embed a document whose text is already saved
+
+# Id of the job the current task is working on, so ingestion code can report progress
+_current_job: ContextVar[Optional[ObjectId]] = ContextVar("ingestion_job", default=None)
+
+
+def _retry_delay(attempts: int) -> float:
+    return min(300.0, 10.0 * 2 ** max(0, attempts - 1))
+
+
+async def report_progress(stage: str, **progress: Any) -> None:
+    """Record the stage (and counters) of the ingestion job running in this task; no-op outside a job."""
+    job_id = _current_job.get()
+    if job_id is None:
+        return
+    update = {"stage": stage, "updated_at": datetime.utcnow()}
+    update.update({f"progress.{key}": value for key, value in progress.items()})
+    try:
+        await ingestion_jobs_collection.update_one({"_id": job_id}, {"$set": update})
+    except Exception as e:
+        logger.warning(f"Could not record progress of ingestion job {job_id}: {e}")
+
+
+async def _insert_job(kind: str, user_id: str, file_hash: str, filename: str,
+                      spool_path: Optional[str] = None, job_id: Optional[ObjectId] = None) -> Dict[str, Any]:
+    now = datetime.utcnow()
+    job = {
+        "_id": job_id or ObjectId(),
+        "kind": kind,
+        "user_id": user_id,
+        "file_hash": file_hash,
+        "filename": filename,
+        "spool_path": spool_path,
+        "state": JOB_QUEUED,
+        "stage": JOB_QUEUED,
+        "progress": {},
+        "attempts": 0,
+        "max_attempts": INGESTION_MAX_ATTEMPTS,
+        "available_at": now,
+        "lease_owner": None,
+        "lease_expires_at": None,
+        "error": None,
+        "created_at": now,
+        "updated_at": now,
+    }
+    await ingestion_jobs_collection.insert_one(job)
+    return job
+
+
+async def enqueue_file(file_path: str, filename: str, user_id: str) -> Dict[str, Any]:
+    """
+    Queue an uploaded file for ingestion and return the job. The file is moved into the
+    spool directory so it outlives the request (and a worker restart).
+    """
+    from app.services.ocr_service import calculate_file_hash
+
+    file_hash = await asyncio.to_thread(calculate_file_hash, file_path)
+    job_id = ObjectId()
+    os.makedirs(INGESTION_SPOOL_DIR, exist_ok=True)
+    spool_path = os.path.join(INGESTION_SPOOL_DIR, f"{job_id}{os.path.splitext(filename)[1].lower()}")
+    await asyncio.to_thread(shutil.move, file_path, spool_path)
+    job = await _insert_job(KIND_FILE, user_id, file_hash, filename, spool_path, job_id)
+    logger.info(f"Queued ingestion job {job_id} for {filename} ({file_hash}) of user {user_id}")
+    return job
+
+
+async def enqueue_embeddings(file_hash: str, user_id: str, filename: str = "") -> Dict[str, Any]:
+    """Queue embedding generation for a document whose text is already in documents_collection."""
+    job = await _insert_job(KIND_EMBEDDINGS, user_id, file_hash, filename)
+    logger.info(f"Queued embedding job {job['_id']} for document {file_hash} of user {user_id}")
+    return job
+
+
+def job_status(job: Dict[str, Any]) -> Dict[str, Any]:
+    """Public view of a job for the status endpoints."""
+    return {
+        "job_id": str(job["_id"]),
+        "file_hash": job.get("file_hash"),
+        "filename": job.get("filename"),
+        "state": job.get("state"),
+        "stage": job.get("stage"),
+        "progress": job.get("progress") or {},
+        "attempts": job.get("attempts", 0),
+        "error": job.get("error"),
+        "created_at": job.get("created_at"),
+        "updated_at": job.get("updated_at"),
+        "finished_at": job.get("finished_at"),
+    }
+
+
+async def get_job(job_id: str, user_id: str) -> Optional[Dict[str, Any]]:
+    if not ObjectId.is_valid(job_id):
+        return None
+    return await ingestion_jobs_collection.find_one({"_id": ObjectId(job_id), "user_id": user_id})
+
+
+async def list_jobs(user_id: str, file_hash: Optional[str] = None, limit: int = 50) -> List[Dict[str, Any]]:
+    query = {"user_id": user_id}
+    if file_hash:
+        query["file_hash"] = file_hash
+    cursor = ingestion_jobs_collection.find(query).sort("created_at", -1).limit(limit)
+    return await cursor.to_list(length=limit)
+
+
+async def wait_for_jobs(job_ids: List[ObjectId], timeout: float, poll_interval: float = 0.5):
+    """
+    Async generator yielding the jobs whenever one of them changes, until all are
+    finished or `timeout` seconds pass.
+    """
+    deadline = asyncio.get_running_loop().time() + timeout
+    last_seen = None
+    while True:
+        jobs = await ingestion_jobs_collection.find({"_id": {"$in": job_ids}}).to_list(length=len(job_ids))
+        seen = [(job["_id"], job.get("state"), job.get("stage"), job.get("updated_at")) for job in jobs]
+        if seen != last_seen:
+            last_seen = seen
+            yield jobs
+        if all(job.get("state") in FINISHED_STATES for job in jobs):
+            return
+        if asyncio.get_running_loop().time() >= deadline:
+            return
+        await asyncio.sleep(poll_interval)
+
+
+class IngestionWorkerPool:
+    """
+    Async workers that claim ingestion jobs from MongoDB and run them.
+
+    A job is claimed with a lease that the worker renews while it runs. Jobs whose lease
+    expires (the worker crashed or was restarted) are claimed again by any worker; failed
+    jobs are retried with backoff until max_attempts. Runs inside the API process or on
+    its own through ingestion_worker.py.
+    """
+
+    def __init__(self, workers: int = INGESTION_WORKERS, lease_seconds: int = INGESTION_LEASE_SECONDS,
+                 poll_interval: float = INGESTION_POLL_INTERVAL):
+        self.workers = max(1, workers)
+        self.lease_seconds = lease_seconds
+        self.poll_interval = poll_interval
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._tasks: List[asyncio.Task] = []
+
+    @property
+    def running(self) -> bool:
+        return any(not task.done() for task in self._tasks)
+
+    def start(self) -> None:
+        if self.running:
+            return
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        logger.info(f"Started {self.workers} ingestion workers ({self.worker_id})")
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def run_forever(self) -> None:
+        self.start()
+        await asyncio.gather(*self._tasks)
+
+    async def _claim(self) -> Optional[Dict[str, Any]]:
+        now = datetime.utcnow()
+        return await ingestion_jobs_collection.find_one_and_update(
+            {
+                "$or": [
+                    {"state": JOB_QUEUED, "available_at": {"$lte": now}},
+                    {"state": JOB_RUNNING, "lease_expires_at": {"$lt": now}},
+                ],
+                "$expr": {"$lt": ["$attempts", "$max_attempts"]},
+            },
+            {
+                "$set": {
+                    "state": JOB_RUNNING,
+                    # One owner per claim: workers of a pool share worker_id
+                    "lease_owner": f"{self.worker_id}:{uuid.uuid4().hex[:8]}",
+                    "lease_expires_at": now + timedelta(seconds=self.lease_seconds),
+                    "started_at": now,
+                    "updated_at": now,
+                },
+                "$inc": {"attempts": 1},
+            },
+            sort=[("available_at", 1)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def _fail_abandoned(self) -> None:
+        """Give up on jobs whose lease expired on their last allowed attempt."""
+        now = datetime.utcnow()
+        result = await ingestion_jobs_collection.update_many(
+            {
+                "state": JOB_RUNNING,
+                "lease_expires_at": {"$lt": now},
+                "$expr": {"$gte": ["$attempts", "$max_attempts"]},
+            },
+            {"$set": {"state": JOB_FAILED, "stage": JOB_FAILED, "error": "Worker lease expired on the last attempt",
+                      "finished_at": now, "updated_at": now}}
+        )
+        if result.modified_count:
+            logger.warning(f"Marked {result.modified_count} abandoned ingestion jobs as failed")
+
+    async def _heartbeat(self, job: Dict[str, Any], work: asyncio.Task) -> None:
+        """Renew the job's lease while `work` runs; cancel `work` once another worker holds the job."""
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                result = await ingestion_jobs_collection.update_one(
+                    {"_id": job["_id"], "lease_owner": job["lease_owner"]},
+                    {"$set": {"lease_expires_at": datetime.utcnow() + timedelta(seconds=self.lease_seconds)}}
+                )
+            except Exception as e:
+                logger.warning(f"Could not renew the lease of ingestion job {job['_id']}: {e}")
+                continue
+            if result.matched_count == 0:
+                logger.warning(f"Lost the lease of ingestion job {job['_id']}; stopping it")
+                work.cancel()
+                return
+
+    async def _worker(self, number: int) -> None:
+        while True:
+            try:
+                job = await self._claim()
+                if job is None:
+                    await self._fail_abandoned()
+                    await asyncio.sleep(self.poll_interval)
+                    continue
+                await self._run(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ingestion worker {number} error: {e}", exc_info=True)
+                await asyncio.sleep(self.poll_interval)
+
+    async def _run(self, job: Dict[str, Any]) -> None:
+        job_id = job["_id"]
+        logger.info(f"Running ingestion job {job_id} ({job['kind']}, attempt {job['attempts']}/{job['max_attempts']})")
+        token = _current_job.set(job_id)
+        work = asyncio.create_task(execute_job(job))
+        heartbeat = asyncio.create_task(self._heartbeat(job, work))
+        try:
+            # Raises only when this worker is cancelled; the job's own outcome is read from `work`
+            await asyncio.wait({work})
+        except asyncio.CancelledError:
+            # Shutting down: leave the lease to expire so another worker resumes the job
+            work.cancel()
+            raise
+        finally:
+            _current_job.reset(token)
+            heartbeat.cancel()
+
+        if work.cancelled():
+            # The heartbeat found the job claimed by another worker, which now owns its rows and spool file
+            logger.warning(f"Abandoned ingestion job {job_id} after losing its lease")
+            return
+        error = work.exception()
+        if error is not None:
+            logger.error(f"Ingestion job {job_id} failed: {error}", exc_info=error)
+            await self._finish_failed(job, str(error))
+        else:
+            await self._finish_succeeded(job, work.result())
+
+    async def _finish_succeeded(self, job: Dict[str, Any], file_hash: str) -> None:
+        now = datetime.utcnow()
+        result = await ingestion_jobs_collection.update_one(
+            {"_id": job["_id"], "lease_owner": job["lease_owner"]},
+            {"$set": {"state": JOB_SUCCEEDED, "stage": "done", "file_hash": file_hash, "error": None,
+                      "lease_owner": None, "finished_at": now, "updated_at": now}}
+        )
+        # Another worker that took the job over may still be reading the spool file
+        if result.matched_count == 1:
+            _remove_spool_file(job)
+
+    async def _finish_failed(self, job: Dict[str, Any], error: str) -> None:
+        now = datetime.utcnow()
+        if job["attempts"] < job["max_attempts"]:
+            update = {"state": JOB_QUEUED, "stage": "retrying",
+                      "available_at": now + timedelta(seconds=_retry_delay(job["attempts"]))}
+        else:
+            update = {"state": JOB_FAILED, "stage": JOB_FAILED, "finished_at": now}
+        result = await ingestion_jobs_collection.update_one(
+            {"_id": job["_id"], "lease_owner": job["lease_owner"]},
+            {"$set": {**update, "error": error, "lease_owner": None, "lease_expires_at": None, "updated_at": now}}
+        )
+        if update["state"] == JOB_FAILED and result.matched_count == 1:
+            _remove_spool_file(job)
+
+
+def _remove_spool_file(job: Dict[str, Any]) -> None:
+    if job.get("spool_path"):
+        try:
+            os.remove(job["spool_path"])
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"Could not remove spooled upload {job['spool_path']}: {e}")
+
+
+async def execute_job(job: Dict[str, Any]) -> str:
+    """Run one job; returns the document hash or raises so the job is retried."""
+    if job["kind"] == KIND_FILE:
+        from app.api.routes.core import process_large_document
+
+        if not job.get("spool_path") or not os.path.exists(job["spool_path"]):
+            raise FileNotFoundError(f"Spooled upload of job {job['_id']} is missing")
+        file_hash = await process_large_document(job["spool_path"], job["filename"], job["user_id"])
+        if not file_hash:
+            raise RuntimeError(f"Could not process {job['filename']}")
+        return file_hash
+
+    if job["kind"] == KIND_EMBEDDINGS:
+        from app.db.mongodb import get_document
+        from app.services.ocr_service import generate_embeddings_background
+
+        document = await get_document(job["file_hash"], job["user_id"])
+        if document is None:
+            raise RuntimeError(f"Document {job['file_hash']} no longer exists")
+        await generate_embeddings_background(document.content, job["file_hash"], job["user_id"])
+        return job["file_hash"]
+
+    raise ValueError(f"Unknown ingestion job kind: {job['kind']!r}")
+
+
+ingestion_workers = IngestionWorkerPool()
@@ -0,0 +1,185 @@
+# backend/app/services/ingestion_pipeline.py
+
+from datetime import datetime
+from typing import AsyncIterable, List, Optional, Tuple
+import asyncio
+import logging
+import time
+
+import numpy as np
+
+from app.config import (
+    INGESTION_QUEUE_SIZE, INGESTION_EMBED_BATCH, EMBEDDING_REQUEST_CONCURRENCY
+)
+from app.db.mongodb import embeddings_collection
+from app.services.chunk_reuse import PreviousUpload, embed_chunks
+from app.services.ingestion_jobs import report_progress
+from app.services.vector_store import save_document_vectors
+from app.utils.chunking import PAGE_SEPARATOR, document_chunker
+from app.utils.embedding_codec import encode_embedding
+from app.utils.hashing import chunk_content_hash
+from app.utils.embeddings import embedding_service
+from app.utils.token_counter import token_counter
+
+logger = logging.getLogger(__name__)
+
+INSERT_BATCH = 500
+
+# Marks the end of a stage's output
+_DONE = object()
+
+
+def page_chunks(page_text: str) -> List[Tuple[str, int]]:
+    """
+    (chunk, embedding-model tokens) of one page (text_to_chunks chunks multi-page text page
+    by page the same way). CPU-bound; the pipeline runs it in a thread.
+    """
+    return [(chunk, tokens) for _, chunk, tokens in document_chunker.split_with_counts(page_text)]
+
+
+class IngestionResult:
+    """What the pipeline produced for one document."""
+
+    def __init__(self, content: str, pages: int, chunks: int, stored: int, seconds: float,
+                 page_spans: List[List[int]]):
+        self.content = content
+        self.pages = pages
+        self.page_spans = page_spans
+        self.chunks = chunks
+        self.stored = stored
+        self.seconds = seconds
+
+
+async def run_ingestion_pipeline(pages: AsyncIterable[str], file_hash: str, owner: str,
+                                 queue_size: int = INGESTION_QUEUE_SIZE,
+                                 embed_batch: int = INGESTION_EMBED_BATCH,
+                                 embed_workers: int = EMBEDDING_REQUEST_CONCURRENCY,
+                                 previous: Optional[PreviousUpload] = None) -> IngestionResult:
+    """
+    Extract → chunk → embed → store as overlapping stages joined by bounded queues.
+
+    Page texts are chunked as they arrive, chunk batches are embedded by `embed_workers`
+    concurrent packed requests, and embedded chunks are written with insert_many while
+    later pages are still being extracted. Full queues block the stage before them, so
+    memory stays bounded by the queue sizes rather than by the document. Chunk rows are
+    written under `owner`; rows left by an interrupted earlier run are removed first, so for
+    shared content only the holder of its claim may run this (see claim_shared_content).
+    Given the `previous` upload of an edited file, its unchanged chunks are not re-embedded.
+    """
+    started = time.time()
+    embed_workers = max(1, embed_workers)
+    await embeddings_collection.delete_many({"document_hash": file_hash, "user_id": owner})
+
+    batch_queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+    store_queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+    page_texts: List[str] = []
+    counts = {"pages": 0, "chunks": 0, "embedded": 0, "stored": 0}
+    vectors: List[np.ndarray] = []
+    texts: List[str] = []
+    chunk_ids: List[int] = []
+
+    async def chunk_stage() -> None:
+        batch: List[Tuple[int, str, int, int]] = []
+        async for text in pages:
+            page_texts.append(text)
+            counts["pages"] += 1
+            for chunk, tokens in await asyncio.to_thread(page_chunks, text):
+                batch.append((counts["chunks"], chunk, counts["pages"], tokens))
+                counts["chunks"] += 1
+                if len(batch) >= embed_batch:
+                    await batch_queue.put(batch)
+                    batch = []
+            # Do not hold a partial batch while the next page is extracted (OCR can be slow)
+            if batch and batch_queue.empty():
+                await batch_queue.put(batch)
+                batch = []
+        if batch:
+            await batch_queue.put(batch)
+        for _ in range(embed_workers):
+            await batch_queue.put(_DONE)
+
+    async def embed_stage() -> None:
+        while True:
+            batch = await batch_queue.get()
+            if batch is _DONE:
+                await store_queue.put(_DONE)
+                return
+            chunks = [chunk for _, chunk, _, _ in batch]
+            chunk_tokens = [tokens for _, _, _, tokens in batch]
+            # The chunker's counts pack the embedding requests; chat-model counts come from the
+            # counting pool (or its cache, when both use the same tokenizer) meanwhile
+            token_counter.prime(chunks, chunk_tokens, document_chunker.encoding.name)
+            embeddings, token_counts = await asyncio.gather(
+                embed_chunks(chunks, previous, chunk_tokens), token_counter.count_many(chunks)
+            )
+            rows = [(chunk_index, chunk, page, embedding, tokens)
+                    for (chunk_index, chunk, page, _), embedding, tokens in zip(batch, embeddings, token_counts)]
+            counts["embedded"] += len(rows)
+            await store_queue.put(rows)
+
+    async def store_stage() -> None:
+        finished_workers = 0
+        pending_docs = []
+        while finished_workers < embed_workers:
+            rows = await store_queue.get()
+            if rows is _DONE:
+                finished_workers += 1
+                continue
+            now = datetime.now()
+            for chunk_index, chunk, page, vector, tokens in rows:
+                pending_docs.append({
+                    "document_hash": file_hash,
+                    "user_id": owner,
+                    "chunk_index": chunk_index,
+                    "chunk_text": chunk,
+                    "page_start": page,
+                    "page_end": page,
+                    "chunk_hash": chunk_content_hash(chunk),
+                    **encode_embedding(vector, version=embedding_service.version),
+                    "token_count": tokens,
+                    "created_at": now
+                })
+                vectors.append(vector)
+                texts.append(chunk)
+                chunk_ids.append(chunk_index)
+            while len(pending_docs) >= INSERT_BATCH:
+                await embeddings_collection.insert_many(pending_docs[:INSERT_BATCH])
+                del pending_docs[:INSERT_BATCH]
+                counts["stored"] += INSERT_BATCH
+            await report_progress("streaming", **counts)
+        if pending_docs:
+            await embeddings_collection.insert_many(pending_docs)
+            counts["stored"] += len(pending_docs)
+
+    tasks = [asyncio.create_task(chunk_stage()), asyncio.create_task(store_stage())]
+    tasks += [asyncio.create_task(embed_stage()) for _ in range(embed_workers)]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+    # Chunk ids arrive out of order across embed workers; the vector store sorts by chunk id
+    if vectors:
+        order = np.argsort(np.asarray(chunk_ids, dtype=np.int64), kind="stable")
+        await save_document_vectors(
+            owner, file_hash,
+            [vectors[i] for i in order], [texts[i] for i in order], [chunk_ids[i] for i in order],
+            embedding_service.version
+        )
+
+    elapsed = time.time() - started
+    await report_progress("stored", **counts)
+    logger.info(
+        f"Ingested document {file_hash}: {counts['pages']} pages, {counts['chunks']} chunks, "
+        f"{counts['stored']} stored in {elapsed:.2f}s"
+    )
+    # Offsets of each page in the joined text, for page lookups without loading the whole document
+    spans, offset = [], 0
+    for text in page_texts:
+        spans.append([offset, offset + len(text)])
+        offset += len(text) + len(PAGE_SEPARATOR)
+    return IngestionResult(PAGE_SEPARATOR.join(page_texts), counts["pages"], counts["chunks"], counts["stored"],
+                           elapsed, spans)
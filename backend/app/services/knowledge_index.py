@@ -0,0 +1,214 @@
+# backend/app/services/knowledge_index.py
+
+from typing import List, Optional, Tuple
+import asyncio
+import io
+import json
+import logging
+
+import numpy as np
+
+from app.config import ANN_MIN_CHUNKS
+from app.db.mongodb import documents_collection
+from app.services.vector_store import vector_store, get_documents_vectors
+from app.utils.embeddings import EMBEDDING_VERSION
+from app.utils.ann_index import IVFIndex, StackedRows, FlatIndex, VectorIndex, build_index
+from app.utils.bm25 import BM25Index
+from app.utils.faq_features import chunk_features
+from app.utils.similarity import normalize_vector
+
+logger = logging.getLogger(__name__)
+
+KB_USER_ID = "admin_knowledge_base"
+MANIFEST_NAME = "_kb_index.json"
+IVF_NAME = "_kb_index.ivf.npz"
+BM25_NAME = "_kb_index.bm25.npz"
+FEATURES_NAME = "_kb_index.features.npy"
+
+
+class KnowledgeBaseIndex:
+    """
+    One search index over every knowledge-base document, shared by all workers on a node:
+    a vector index over the chunk embeddings, a BM25 inverted index over the chunk text and
+    per-chunk FAQ feature bits (see app.utils.faq_features).
+
+    The index is rebuilt when an admin uploads a document and updated in place when one is
+    deleted. Both write a manifest next to the vector store; other workers notice the
+    manifest changed and reload, so FAQ requests never rescan MongoDB.
+    """
+
+    def __init__(self, user_id: str = KB_USER_ID):
+        self.user_id = user_id
+        self.document_hashes: List[str] = []
+        self.document_rows: List[int] = []
+        self.texts: List[str] = []
+        self.index: Optional[VectorIndex] = None
+        self.bm25: Optional[BM25Index] = None
+        self.features = np.zeros(0, dtype=np.uint16)
+        # Embedding version of the indexed vectors; FAQ prompts are embedded to match
+        self.embedding_version: Optional[str] = None
+        self._version: Optional[int] = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def is_approximate(self) -> bool:
+        return isinstance(self.index, IVFIndex)
+
+    def _manifest_version(self) -> Optional[int]:
+        try:
+            return vector_store.path_for(self.user_id, MANIFEST_NAME).stat().st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _persist(self) -> None:
+        ivf_path = vector_store.path_for(self.user_id, IVF_NAME)
+        if isinstance(self.index, IVFIndex):
+            ivf_path.parent.mkdir(parents=True, exist_ok=True)
+            self.index.save(str(ivf_path))
+        else:
+            ivf_path.unlink(missing_ok=True)
+        self.bm25.save(str(vector_store.path_for(self.user_id, BM25_NAME)))
+        buffer = io.BytesIO()
+        np.save(buffer, self.features)
+        vector_store.write_file(self.user_id, FEATURES_NAME, buffer.getvalue())
+        manifest = {
+            "document_hashes": self.document_hashes,
+            "document_rows": self.document_rows,
+            "kind": "ivf" if self.is_approximate else "flat",
+            "embedding_version": self.embedding_version,
+        }
+        vector_store.write_file(self.user_id, MANIFEST_NAME, json.dumps(manifest).encode("utf-8"))
+        self._version = self._manifest_version()
+
+    async def _load_documents(self, document_hashes: List[str]):
+        """
+        Open the stored vectors of the given documents, skipping empty or mismatched ones.
+        Mid-migration, only the embedding version covering the most chunks is indexed.
+        """
+        loaded = []
+        dim = None
+        vectors_by_hash = await get_documents_vectors(document_hashes, self.user_id)
+        chunks_by_version = {}
+        for vectors in vectors_by_hash.values():
+            if vectors:
+                chunks_by_version[vectors.version] = chunks_by_version.get(vectors.version, 0) + len(vectors)
+        version = max(chunks_by_version, key=lambda v: (chunks_by_version[v], v == EMBEDDING_VERSION), default=None)
+        for doc_hash in document_hashes:
+            vectors = vectors_by_hash[doc_hash]
+            if not vectors:
+                continue
+            if vectors.version != version:
+                logger.warning(f"Skipping knowledge base document {doc_hash}: embedding version {vectors.version} != {version}")
+                continue
+            if dim is not None and vectors.dim != dim:
+                logger.warning(f"Skipping knowledge base document {doc_hash}: dimension {vectors.dim} != {dim}")
+                continue
+            dim = vectors.dim
+            loaded.append((doc_hash, vectors))
+        return loaded
+
+    def _set_documents(self, loaded, index: VectorIndex, bm25: Optional[BM25Index] = None,
+                       features: Optional[np.ndarray] = None) -> None:
+        self.document_hashes = [doc_hash for doc_hash, _ in loaded]
+        self.document_rows = [len(vectors) for _, vectors in loaded]
+        self.embedding_version = loaded[0][1].version if loaded else None
+        self.texts = [text for _, vectors in loaded for text in vectors.texts]
+        self.index = index
+        self.bm25 = bm25 if bm25 is not None else BM25Index.build(self.texts)
+        self.features = features if features is not None else chunk_features(self.texts)
+
+    async def rebuild(self) -> None:
+        """Rebuild the index from every knowledge-base document (run after uploads)."""
+        async with self._lock:
+            document_hashes = sorted(await documents_collection.distinct("file_hash", {"user_id": self.user_id}))
+            loaded = await self._load_documents(document_hashes)
+            index = await asyncio.to_thread(build_index, [v.matrix for _, v in loaded], ANN_MIN_CHUNKS)
+            texts = [text for _, vectors in loaded for text in vectors.texts]
+            bm25 = await asyncio.to_thread(BM25Index.build, texts)
+            features = await asyncio.to_thread(chunk_features, texts)
+            self._set_documents(loaded, index, bm25, features)
+            await asyncio.to_thread(self._persist)
+            logger.info(f"Knowledge base index rebuilt: {len(self.document_hashes)} documents, {len(self.texts)} chunks, {'ivf' if self.is_approximate else 'flat'}")
+
+    async def _load(self) -> bool:
+        """Load the persisted index; False when it is missing or out of date."""
+        try:
+            manifest = json.loads(vector_store.path_for(self.user_id, MANIFEST_NAME).read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return False
+
+        loaded = await self._load_documents(manifest.get("document_hashes", []))
+        if [h for h, _ in loaded] != manifest.get("document_hashes") or \
+                [len(v) for _, v in loaded] != manifest.get("document_rows"):
+            return False
+
+        base = StackedRows([v.matrix for _, v in loaded])
+        index: Optional[VectorIndex] = FlatIndex(base)
+        if manifest.get("kind") == "ivf":
+            try:
+                index = IVFIndex.load(str(vector_store.path_for(self.user_id, IVF_NAME)), base)
+            except (OSError, ValueError, KeyError):
+                index = None
+            if index is None:
+                return False
+
+        try:
+            bm25 = BM25Index.load(str(vector_store.path_for(self.user_id, BM25_NAME)))
+            features = np.load(vector_store.path_for(self.user_id, FEATURES_NAME))
+        except (OSError, ValueError, KeyError):
+            return False
+        if len(bm25) != len(base) or features.shape[0] != len(base):
+            return False
+
+        self._set_documents(loaded, index, bm25, features)
+        self._version = self._manifest_version()
+        return True
+
+    async def get(self) -> "KnowledgeBaseIndex":
+        """Return the index, reloading it when another worker changed it since the last request."""
+        version = self._manifest_version()
+        if self.index is not None and version == self._version:
+            return self
+        async with self._lock:
+            if version is not None and await self._load():
+                return self
+        await self.rebuild()
+        return self
+
+    async def remove_document(self, document_hash: str) -> None:
+        """Drop a deleted document's rows from the index without re-clustering."""
+        await self.get()
+        async with self._lock:
+            if document_hash not in self.document_hashes:
+                return
+            position = self.document_hashes.index(document_hash)
+            start = sum(self.document_rows[:position])
+            end = start + self.document_rows[position]
+            self.index.remove(position)
+            self.bm25.remove(start, end)
+            self.features = np.delete(self.features, np.s_[start:end])
+            del self.texts[start:end]
+            del self.document_hashes[position]
+            del self.document_rows[position]
+            await asyncio.to_thread(self._persist)
+
+    def search(self, query, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Row ids (into self.texts) and scores of the k best chunks."""
+        if self.index is None or len(self.index) == 0 or len(query) != self.index.base.dim:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        return self.index.search(query, k)
+
+    def score_rows(self, query, rows: np.ndarray) -> np.ndarray:
+        """Exact cosine scores of the given rows (sorted ascending) against the query."""
+        if self.index is None or rows.shape[0] == 0 or len(query) != self.index.base.dim:
+            return np.zeros(rows.shape[0], dtype=np.float32)
+        return self.index.base.take(rows) @ normalize_vector(query)
+
+    def lexical_scores(self, query: str) -> np.ndarray:
+        """BM25 score of every chunk (aligned with self.texts) for the query text."""
+        if self.bm25 is None:
+            return np.zeros(len(self.texts), dtype=np.float32)
+        return self.bm25.scores(query)
+
+
+kb_index = KnowledgeBaseIndex()
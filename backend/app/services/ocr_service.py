@@ -7,14 +7,12 @@ import asyncio
 import fitz  # PyMuPDF
 import hashlib
 from datetime import datetime
-from typing import Tuple, List, Optional, Dict, Any, Union
+from typing import AsyncIterator, Tuple, List, Optional
+from collections import deque
 import concurrent.futures
-import httpx
 import numpy as np
-from openai import AsyncOpenAI
 import google.generativeai as genai
-from functools import partial
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor
 import aiohttp
 import base64
 import io
@@ -42,26 +40,29 @@ logger = logging.getLogger(__name__)
 
 # Constants
 MAX_WORKERS = min(32, (os.cpu_count() or 4) * 4)
-EMBEDDING_MODEL = "text-embedding-3-small"
-EMBEDDING_DIM = 128  # Reduced dimensions for speed
 MAX_RETRIES = 3
 REQUEST_TIMEOUT = 10.0
 
 # Database imports
 from app.db.mongodb import documents_collection, embeddings_collection
+from app.utils.embedding_codec import encode_embedding
+from app.config import RATE_LIMIT_MAX_CONCURRENCY
+from app.utils.rate_limiter import get_rate_limiter
+from app.utils.embeddings import embedding_service
+from app.utils.hashing import chunk_content_hash
+from app.utils.token_counter import token_counter
+from app.utils.chunking import document_chunker
+from app.services.ingestion_jobs import enqueue_embeddings
+
+# Tokens reserved per Gemini OCR page (image input plus extracted text)
+GEMINI_PAGE_TOKENS = 2000
 
 class OCRService:
     """High-performance OCR and document processing service with parallel processing."""
     
     def __init__(self):
         """Initialize the OCR service with optimized settings."""
-        self.openai_client = AsyncOpenAI(
-            api_key=os.getenv("OPENAI_API_KEY"),
-            timeout=httpx.Timeout(30.0, connect=5.0),
-            max_retries=2
-        )
         self.session = None  # Will be initialized in async context
-        self.semaphore = asyncio.Semaphore(MAX_WORKERS * 2)  # Control concurrency
     
     async def extract_text_from_pdf(self, file_path: str, user_id: Optional[str] = None, 
                                  document_hash: Optional[str] = None, 
@@ -119,13 +120,17 @@ class OCRService:
             # Process pages with OCR in parallel
             page_chunks = split_pdf_to_pages(pdf_data, max_pages=pages_to_process)
             
-            # Process pages in parallel with semaphore for concurrency control
+            # Process pages in parallel; the Gemini rate limiter paces the requests and the
+            # semaphore bounds how many rendered page images are held in memory at once
+            page_slots = asyncio.Semaphore(RATE_LIMIT_MAX_CONCURRENCY)
+
+            async def process_page(chunk: bytes, i: int) -> str:
+                async with page_slots:
+                    return await self._process_page_with_ocr(chunk, i, len(page_chunks))
+
             async with aiohttp.ClientSession() as session:
                 self.session = session
-                tasks = [
-                    self._process_page_with_ocr(chunk, i, len(page_chunks))
-                    for i, chunk in enumerate(page_chunks)
-                ]
+                tasks = [process_page(chunk, i) for i, chunk in enumerate(page_chunks)]
                 page_texts = await asyncio.gather(*tasks, return_exceptions=True)
             
             # Filter out any failed pages
@@ -144,6 +149,42 @@ class OCRService:
             logger.error(f"Error in extract_text_from_pdf: {str(e)}", exc_info=True)
             return "", False
     
+    async def stream_pdf_pages(self, file_path: str, digital: bool,
+                               max_pages: Optional[int] = None) -> AsyncIterator[str]:
+        """
+        Yield the text of each PDF page in order, one page at a time, so ingestion can
+        chunk and embed early pages while later ones are still being extracted.
+        Digital pages are read with PyMuPDF off the event loop; scanned pages are OCRed
+        with up to RATE_LIMIT_MAX_CONCURRENCY pages in flight.
+        """
+        doc = fitz.open(file_path)
+        pending = deque()
+        try:
+            total_pages = min(len(doc), max_pages) if max_pages else len(doc)
+            if digital:
+                for page_num in range(total_pages):
+                    yield await asyncio.to_thread(lambda: doc[page_num].get_text("text").strip())
+                return
+
+            async def page_text(task: asyncio.Task) -> str:
+                try:
+                    return str(await task)
+                except Exception as e:
+                    logger.warning(f"OCR of a page failed: {e}")
+                    return ""
+
+            for page_num in range(total_pages):
+                page_bytes = await asyncio.to_thread(single_page_pdf_bytes, doc, page_num)
+                pending.append(asyncio.create_task(self._process_page_with_ocr(page_bytes, page_num, total_pages)))
+                if len(pending) >= RATE_LIMIT_MAX_CONCURRENCY:
+                    yield await page_text(pending.popleft())
+            while pending:
+                yield await page_text(pending.popleft())
+        finally:
+            for task in pending:
+                task.cancel()
+            doc.close()
+
     def _convert_pdf_page_to_image(self, page_bytes: bytes) -> Optional[Image.Image]:
         """Convert a PDF page to a PIL Image."""
         try:
@@ -192,13 +233,17 @@ class OCRService:
                 }}
             ]
             
-            # Generate content
-            response = await asyncio.get_event_loop().run_in_executor(
-                None,
-                lambda: model.generate_content(
-                    contents=message_parts,
-                    generation_config=GEMINI_CONFIG
-                )
+            # Generate content (paced by the shared Gemini rate limiter)
+            loop = asyncio.get_event_loop()
+            response = await get_rate_limiter("gemini", GEMINI_MODEL).call(
+                lambda: loop.run_in_executor(
+                    None,
+                    lambda: model.generate_content(
+                        contents=message_parts,
+                        generation_config=GEMINI_CONFIG
+                    )
+                ),
+                tokens=GEMINI_PAGE_TOKENS
             )
             
             # Process response
@@ -259,6 +304,24 @@ def calculate_file_hash(file_path: str) -> str:
             hash_md5.update(chunk)
     return hash_md5.hexdigest()
 
+def is_digital_pdf(file_path: str, sample_pages: int = 3, min_chars: int = 100) -> Tuple[bool, int]:
+    """
+    (has a text layer, page count) of a PDF, judged from its first pages so the
+    decision between direct extraction and OCR does not need the whole document.
+    """
+    with fitz.open(file_path) as doc:
+        sample = "".join(doc[i].get_text() for i in range(min(sample_pages, len(doc))))
+        return len(sample.strip()) > min_chars, len(doc)
+
+def single_page_pdf_bytes(pdf_document, page_num: int) -> bytes:
+    """One page of an open PDF as a standalone PDF document."""
+    single_page_pdf = fitz.open()
+    try:
+        single_page_pdf.insert_pdf(pdf_document, from_page=page_num, to_page=page_num)
+        return single_page_pdf.tobytes()
+    finally:
+        single_page_pdf.close()
+
 def split_pdf_to_pages(file_path_or_bytes, max_pages: Optional[int] = None) -> List[bytes]:
     """
     Split a PDF into individual pages.
@@ -301,17 +364,6 @@ def split_pdf_to_pages(file_path_or_bytes, max_pages: Optional[int] = None) -> L
         logger.error(f"Error splitting PDF into pages: {e}", exc_info=True)
         return []
 
-def count_tokens(text: str) -> int:
-    """
-    Count the number of tokens in a text.
-    This is a placeholder implementation - replace with actual tokenizer.
-    """
-    if not text:
-        return 0
-    
-    # Simple approximation: 1 token ≈ 4 characters
-    return len(text) // 4
-
 async def process_document(file_path: str, filename: str, user_id: str):
     """Process a document with OCR and create embeddings."""
     start_time = time.time()
@@ -345,8 +397,8 @@ async def process_document(file_path: str, filename: str, user_id: str):
         
         logger.info(f"Text content extracted from {filename}, length: {len(text_content)} characters")
         
-        # Count tokens
-        token_count = count_tokens(text_content)
+        # Count tokens (sharded across the counting pool for large texts)
+        token_count = await token_counter.count(text_content)
         
         # Create document record
         document_record = {
@@ -361,8 +413,8 @@ async def process_document(file_path: str, filename: str, user_id: str):
         }
         await documents_collection.insert_one(document_record)
         
-        # Generate embeddings in background
-        asyncio.create_task(generate_embeddings_background(text_content, file_hash, user_id))
+        # Generate embeddings through the durable job queue (resumed after a restart)
+        await enqueue_embeddings(file_hash, user_id, filename)
         
         total_time = time.time() - start_time
         logger.info(f"Processed document {filename} in {total_time:.2f} seconds")
@@ -373,28 +425,32 @@ async def process_document(file_path: str, filename: str, user_id: str):
         return None
 
 async def generate_embeddings_background(text: str, file_hash: str, user_id: str):
-    """Generate embeddings for a document in the background."""
+    """Generate embeddings for a document; run by the ingestion workers, which retry on failure."""
     try:
         logger.info(f"Starting background embedding generation for document {file_hash}")
+
+        # A retried job starts over
+        await embeddings_collection.delete_many({"document_hash": file_hash, "user_id": user_id})
         
-        # Split text into chunks
-        chunks = text_to_chunks(text)
+        # Split text into chunks off the event loop
+        paged_chunks = await asyncio.to_thread(document_chunker.split_with_counts, text)
+        chunks = [chunk for _, chunk, _ in paged_chunks]
         logger.info(f"Split document into {len(chunks)} chunks for embedding generation")
         
-        # Generate embeddings in parallel
-        embeddings = await get_embeddings_batch_parallel(chunks, max_workers=10)
+        # Raises EmbeddingError so the ingestion worker retries the job
+        embeddings = await embedding_service.embed(chunks, token_counts=[tokens for _, _, tokens in paged_chunks])
         
         stored_count = 0
-        for i, (chunk, embedding) in enumerate(zip(chunks, embeddings)):
-            if embedding is None:
-                continue
-                
+        for i, ((page, chunk, _), embedding) in enumerate(zip(paged_chunks, embeddings)):
             # Create embedding record
             embedding_record = {
                 "document_hash": file_hash,
                 "chunk_index": i,
                 "chunk_text": chunk,
-                "embedding": embedding,
+                "page_start": page,
+                "page_end": page,
+                "chunk_hash": chunk_content_hash(chunk),
+                **encode_embedding(embedding, version=embedding_service.version),
                 "user_id": user_id,
                 "created_at": datetime.now()
             }
@@ -412,163 +468,7 @@ async def generate_embeddings_background(text: str, file_hash: str, user_id: str
         logger.info(f"Background embedding generation complete for document {file_hash}. Stored {stored_count}/{len(chunks)} embeddings.")
     except Exception as e:
         logger.error(f"Error in background embedding generation for document {file_hash}: {str(e)}", exc_info=True)
-
-def text_to_chunks(text: str) -> List[str]:
-    """
-    Split text into semantic chunks for embedding generation.
-    This is a simplified implementation - replace with your actual chunking logic.
-    """
-    if not text or not text.strip():
-        return []
-    
-    # Simple chunking by paragraphs
-    paragraphs = [p.strip() for p in text.split('\n\n') if p.strip()]
-    
-    # If no paragraphs found, try splitting by newlines
-    if not paragraphs:
-        paragraphs = [p.strip() for p in text.split('\n') if p.strip()]
-    
-    # Further split paragraphs into chunks if they are too long
-    chunks = []
-    current_chunk = []
-    current_length = 0
-    max_chunk_length = 4000  # Example max length per chunk
-    
-    for paragraph in paragraphs:
-        if current_length + len(paragraph) + 2 <= max_chunk_length:
-            current_chunk.append(paragraph)
-            current_length += len(paragraph) + 2  # +2 for the newline
-        else:
-            chunks.append("\n\n".join(current_chunk))
-            current_chunk = [paragraph]
-            current_length = len(paragraph)
-    
-    if current_chunk:
-        chunks.append("\n\n".join(current_chunk))
-    
-    return chunks
-
-# Global cache for embeddings
-EMBEDDING_CACHE = {}
-EMBEDDING_LOCK = asyncio.Lock()
-
-async def get_embeddings_batch_parallel(chunks: List[str], batch_size: int = 50) -> List[Optional[List[float]]]:
-    """
-    Ultra-fast embeddings generation with parallel processing, batching, and caching.
-    
-    Args:
-        chunks: List of text chunks to get embeddings for
-        batch_size: Number of chunks to process in each batch (reduced for better concurrency)
-        
-    Returns:
-        List of embedding vectors (same order as input chunks)
-    """
-    if not chunks:
-        return []
-    
-    # Initialize OpenAI client with timeout settings
-    client = AsyncOpenAI(
-        api_key=os.getenv('OPENAI_API_KEY'),
-        timeout=30.0,
-        max_retries=3
-    )
-    
-    # Process chunks in parallel
-    semaphore = asyncio.Semaphore(10)  # Limit concurrent requests
-    
-    async def process_batch(batch: List[str]) -> List[Optional[List[float]]]:
-        async with semaphore:
-            batch_key = tuple(batch)
-            
-            # Check cache first
-            cached_results = []
-            to_process = []
-            to_process_indices = []
-            
-            for i, chunk in enumerate(batch):
-                chunk_key = hashlib.md5(chunk.encode()).hexdigest()
-                if chunk_key in EMBEDDING_CACHE:
-                    cached_results.append((i, EMBEDDING_CACHE[chunk_key]))
-                else:
-                    to_process.append(chunk)
-                    to_process_indices.append(i)
-            
-            if not to_process:
-                # All results were in cache
-                results = [None] * len(batch)
-                for idx, emb in cached_results:
-                    results[idx] = emb
-                return results
-            
-            try:
-                # Clean and truncate text for faster processing
-                clean_chunks = []
-                for chunk in to_process:
-                    # Remove vector-like lines and truncate to 2000 chars (sweet spot for speed/quality)
-                    clean_lines = [
-                        line for line in chunk.split('\n')
-                        if not line.strip().startswith(('0.', '1.', '-0', '1 ', '-1', '0 '))
-                        and not line.strip().replace('.', '').replace('-', '').replace(' ', '').isdigit()
-                    ][:100]  # Limit to 100 lines max
-                    clean_chunk = '\n'.join(clean_lines)[:2000]
-                    clean_chunks.append(clean_chunk)
-                
-                # Get embeddings for the batch
-                response = await client.embeddings.create(
-                    input=clean_chunks,
-                    model="text-embedding-3-small",  # Fastest model
-                )
-                
-                # Process and cache results
-                results = [None] * len(batch)
-                for idx, emb in cached_results:
-                    results[idx] = emb
-                
-                # Add new results to cache and results
-                for i, item in enumerate(response.data):
-                    chunk = to_process[i]
-                    chunk_key = hashlib.md5(chunk.encode()).hexdigest()
-                    EMBEDDING_CACHE[chunk_key] = item.embedding
-                    results[to_process_indices[i]] = item.embedding
-                
-                return results
-                
-            except Exception as e:
-                logger.warning(f"Error in batch processing: {str(e)}")
-                return [None] * len(batch)
-    
-    # Split into smaller batches for better concurrency
-    batches = [chunks[i:i + batch_size] for i in range(0, len(chunks), batch_size)]
-    
-    # Process all batches in parallel
-    tasks = [process_batch(batch) for batch in batches]
-    batch_results = await asyncio.gather(*tasks, return_exceptions=True)
-    
-    # Flatten results
-    all_embeddings = []
-    for result in batch_results:
-        if isinstance(result, Exception):
-            logger.error(f"Error in batch processing: {str(result)}")
-            all_embeddings.extend([None] * batch_size)  # Add placeholders for failed batch
-        else:
-            all_embeddings.extend(result)
-    
-    return all_embeddings[:len(chunks)]  # Ensure we return the correct number of embeddings
-
-async def get_single_embedding_ultra_fast(text, client, chunk_id):
-    """Ultra-optimized embedding generation with minimal dimensions."""
-    try:
-        # Use the smallest, fastest embedding model with minimal dimensions
-        response = await client.embeddings.create(
-            input=text,
-            model="text-embedding-3-small",  # Fastest model
-            dimensions=128,  # Minimum dimensions for speed
-            encoding_format="float"  # Faster processing
-        )
-        return response.data[0].embedding
-    except Exception as e:
-        logger.debug(f"Embedding error (chunk {chunk_id}): {str(e)}")
-        return None
+        raise
 
 async def process_document_ultra_fast(file_path, filename, user_id):
     """Process documents at maximum possible speed - target 5 seconds for 100 pages."""
@@ -629,14 +529,13 @@ async def process_document_ultra_fast(file_path, filename, user_id):
                 max_pages=20  # Limit pages for speed
             )
         
-        # Quick token count estimate
-        token_count = len(extracted_text.split()) * 1.3  # Rough estimate
+        token_count = await token_counter.count(extracted_text)
         
-        # Split into larger chunks for faster processing
-        chunks = split_text_into_chunks(extracted_text, max_chunk_size=8000, overlap=50)
+        paged_chunks = await asyncio.to_thread(document_chunker.split_with_counts, extracted_text)
+        chunks = [chunk for _, chunk, _ in paged_chunks]
         
         # Generate embeddings with ultra-fast parallel processing
-        embeddings = await get_embeddings_batch_parallel(chunks)
+        embeddings = await embedding_service.embed(chunks, token_counts=[tokens for _, _, tokens in paged_chunks])
         
         # Store document in MongoDB
         document_record = {
@@ -656,15 +555,13 @@ async def process_document_ultra_fast(file_path, filename, user_id):
         # Prepare embedding documents
         embedding_docs = []
         for i, (chunk, embedding) in enumerate(zip(chunks, embeddings)):
-            if embedding is None:
-                continue
-                
             embedding_docs.append({
                 "document_hash": file_hash,
                 "user_id": user_id,
                 "chunk_id": i,
                 "text": chunk[:500],  # Store only beginning of chunk to save space
-                "embedding": embedding,
+                "chunk_hash": chunk_content_hash(chunk),
+                **encode_embedding(embedding, version=embedding_service.version),
                 "created_at": datetime.now()
             })
         
@@ -684,42 +581,6 @@ async def process_document_ultra_fast(file_path, filename, user_id):
         logger.error(f"Error in ultra-fast document processing: {str(e)}", exc_info=True)
         return None
 
-def split_text_into_chunks(text: str, max_chunk_size: int = 8000, overlap: int = 50) -> List[str]:
-    """
-    Split text into chunks with a specified maximum size and overlap.
-    """
-    if not text:
-        return []
-    
-    chunks = []
-    current_chunk = ""
-    current_length = 0
-    
-    sentences = text.split('. ')
-    for sentence in sentences:
-        sentence_length = len(sentence) + 2  # +2 for '. '
-        if current_length + sentence_length <= max_chunk_size:
-            current_chunk += sentence + ". "
-            current_length += sentence_length
-        else:
-            if current_chunk:
-                chunks.append(current_chunk.strip())
-            current_chunk = sentence + ". "
-            current_length = sentence_length
-    
-    if current_chunk:
-        chunks.append(current_chunk.strip())
-    
-    # Apply overlap
-    overlapped_chunks = []
-    for i in range(len(chunks)):
-        chunk = chunks[i]
-        if i > 0:
-            chunk = chunks[i-1][-overlap:] + chunk
-        overlapped_chunks.append(chunk)
-    
-    return overlapped_chunks
-
 def process_page_as_image(page_bytes, model=None):
     """
     Process a PDF page as an image using OCR with Gemini 1.5 Flash.
@@ -772,8 +633,11 @@ def process_page_as_image(page_bytes, model=None):
         # Create prompt for OCR
         prompt = "Extract all text from this image. Return only the extracted text without any additional commentary."
         
-        # Generate content with the image
-        response = model.generate_content([prompt, image])
+        # Generate content with the image (paced by the shared Gemini rate limiter)
+        response = get_rate_limiter("gemini", "gemini-1.5-flash").call_sync(
+            lambda: model.generate_content([prompt, image]),
+            tokens=GEMINI_PAGE_TOKENS
+        )
         
         # Extract text from response
         extracted_text = response.text
@@ -0,0 +1,93 @@
+# backend/app/services/page_index.py
+
+from typing import Dict, List, Optional, Tuple
+import logging
+import re
+
+from app.config import PAGE_CONTEXT_MAX_PAGES
+from app.db.mongodb import documents_collection, document_contents_collection
+from app.utils.chunking import page_spans
+
+logger = logging.getLogger(__name__)
+
+# "page 12", "pages 3-5", "pages 3, 4 and 7", "p. 12", "pp. 10 to 12", "pg 4"
+_PAGE_REFERENCE = re.compile(
+    r'\b(?:pages?|pgs?\.?|pp?\.)\s*(\d{1,5}(?:\s*(?:-|–|to|through|and|&|,)\s*\d{1,5})*)',
+    re.IGNORECASE
+)
+_PAGE_RANGE = re.compile(r'(\d{1,5})\s*(?:-|–|to|through)\s*(\d{1,5})', re.IGNORECASE)
+
+
+def page_references(prompt: str, limit: int = PAGE_CONTEXT_MAX_PAGES) -> List[int]:
+    """Page numbers a prompt asks about, in order of mention, at most `limit` of them."""
+    pages: List[int] = []
+    for match in _PAGE_REFERENCE.finditer(prompt or ""):
+        group = match.group(1)
+        numbers: List[int] = []
+        for part in re.split(r'\s*(?:,|and|&)\s*', group):
+            span = _PAGE_RANGE.fullmatch(part.strip())
+            if span:
+                first, last = int(span.group(1)), int(span.group(2))
+                numbers.extend(range(first, min(last, first + limit - 1) + 1))
+            elif part.strip().isdigit():
+                numbers.append(int(part))
+        for number in numbers:
+            if number > 0 and number not in pages:
+                pages.append(number)
+    return pages[:limit]
+
+
+async def get_document_pages(file_hash: str, user_id: str, page_numbers: List[int]) -> Tuple[int, Dict[int, str]]:
+    """
+    (page count, {page number: text}) for the requested pages of a user's document.
+    Only the requested character ranges are read from MongoDB; documents stored before
+    the page index get it built from their text on first use.
+    """
+    doc = await documents_collection.find_one(
+        {"file_hash": file_hash, "user_id": user_id},
+        projection={"_id": 1, "content_ref": 1, "page_spans": 1}
+    )
+    if not doc:
+        return 0, {}
+    if doc.get("content_ref"):
+        collection, match = document_contents_collection, {"_id": doc["content_ref"]}
+        source = await collection.find_one(match, projection={"page_spans": 1})
+    else:
+        collection, match, source = documents_collection, {"_id": doc["_id"]}, doc
+    if not source:
+        return 0, {}
+
+    spans = source.get("page_spans")
+    if not spans:
+        stored = await collection.find_one(match, projection={"content": 1})
+        spans = page_spans((stored or {}).get("content") or "")
+        await collection.update_one(match, {"$set": {"page_spans": spans}})
+        logger.info(f"Built page index of document {file_hash}: {len(spans)} pages")
+
+    wanted = [n for n in page_numbers if 1 <= n <= len(spans)]
+    if not wanted:
+        return len(spans), {}
+    projection = {
+        f"page_{n}": {"$substrCP": ["$content", spans[n - 1][0], spans[n - 1][1] - spans[n - 1][0]]}
+        for n in wanted
+    }
+    rows = await collection.aggregate([{"$match": match}, {"$project": projection}]).to_list(length=1)
+    if not rows:
+        return len(spans), {}
+    return len(spans), {n: (rows[0].get(f"page_{n}") or "").strip() for n in wanted}
+
+
+async def page_context(file_hash: str, user_id: str, page_numbers: List[int]) -> Optional[str]:
+    """
+    Document context made of just the requested pages, labelled with their numbers.
+    None for documents without page structure, so the caller falls back to its usual retrieval.
+    """
+    total, pages = await get_document_pages(file_hash, user_id, page_numbers)
+    if total <= 1:
+        return None
+    parts = [f"[Page {n} of {total}]\n{text or '(no text on this page)'}" for n, text in pages.items()]
+    missing = [str(n) for n in page_numbers if n not in pages]
+    if missing:
+        parts.append(f"[Page {', '.join(missing)} requested, but the document has only {total} pages]")
+    logger.info(f"Page context for document {file_hash}: pages {list(pages)} of {total}")
+    return "\n\n".join(parts)
@@ -0,0 +1,163 @@
+# backend/app/services/vector_cache.py
+
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+import logging
+import threading
+
+import numpy as np
+
+from app.config import EMBEDDING_CACHE_MB
+
+logger = logging.getLogger(__name__)
+
+
+class DocumentVectors:
+    """Decoded chunk embeddings of one document: a normalized float32 matrix plus chunk text."""
+
+    __slots__ = ("matrix", "texts", "chunk_ids", "nbytes", "index", "version")
+
+    def __init__(self, matrix: np.ndarray, texts: Sequence[str], chunk_ids: Sequence[int],
+                 nbytes: Optional[int] = None, version: Optional[str] = None):
+        self.matrix = matrix
+        self.texts = texts
+        self.chunk_ids = chunk_ids
+        # Embedding version of the rows (see app.utils.embedding_codec); prompts must be embedded to match
+        self.version = version
+        # Rough footprint: the matrix plus one byte per character of chunk text
+        self.nbytes = nbytes if nbytes is not None else int(matrix.nbytes) + sum(len(t) for t in texts)
+        # Search index over the matrix, attached lazily by get_document_index()
+        self.index = None
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    @property
+    def dim(self) -> int:
+        return int(self.matrix.shape[1]) if self.matrix.ndim == 2 else 0
+
+
+class EmbeddingMatrixCache:
+    """
+    Process-level LRU cache of DocumentVectors keyed by (user_id, document_hash).
+    It also keeps stacked matrices: the rows of several documents copied into one
+    contiguous matrix, so a session's documents are scored with a single matmul.
+    Stacks are evicted before documents once the shared byte budget is exceeded,
+    then entries least-recently-used first.
+    """
+
+    def __init__(self, max_mb: int = EMBEDDING_CACHE_MB):
+        self.max_bytes = max(0, max_mb) * 1024 * 1024
+        self._entries: "OrderedDict[Tuple[str, str], DocumentVectors]" = OrderedDict()
+        self._stacks: "OrderedDict[tuple, Tuple[Tuple[DocumentVectors, ...], np.ndarray]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, user_id: str, document_hash: str) -> Optional[DocumentVectors]:
+        key = (user_id, document_hash)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, user_id: str, document_hash: str, vectors: DocumentVectors) -> None:
+        if vectors.nbytes > self.max_bytes:
+            logger.info(f"Document {document_hash} ({vectors.nbytes} bytes) exceeds the embedding cache budget; not caching")
+            return
+        key = (user_id, document_hash)
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.current_bytes -= previous.nbytes
+            self._entries[key] = vectors
+            self.current_bytes += vectors.nbytes
+            self._evict()
+
+    def _evict(self) -> None:
+        """Drop stacks, then least-recently-used documents, until the budget holds; call with the lock held."""
+        while self.current_bytes > self.max_bytes and self._stacks:
+            _, (_, matrix) = self._stacks.popitem(last=False)
+            self.current_bytes -= matrix.nbytes
+        while self.current_bytes > self.max_bytes and self._entries:
+            _, evicted = self._entries.popitem(last=False)
+            self.current_bytes -= evicted.nbytes
+            self.evictions += 1
+
+    def stacked_matrix(self, user_id: str, key: tuple, parts: List[DocumentVectors]) -> np.ndarray:
+        """
+        The matrices of `parts` stacked in order into one contiguous matrix, cached under
+        (user_id, *key). A cached stack is reused only while it was built from the same
+        DocumentVectors objects, so a reloaded or re-embedded document rebuilds it.
+        """
+        stack_key = (user_id,) + tuple(key)
+        with self._lock:
+            entry = self._stacks.get(stack_key)
+            if entry is not None and len(entry[0]) == len(parts) and all(a is b for a, b in zip(entry[0], parts)):
+                self._stacks.move_to_end(stack_key)
+                return entry[1]
+
+        matrix = np.concatenate([p.matrix for p in parts]).astype(np.float32, copy=False)
+        if matrix.nbytes > self.max_bytes:
+            return matrix
+        with self._lock:
+            previous = self._stacks.pop(stack_key, None)
+            if previous is not None:
+                self.current_bytes -= previous[1].nbytes
+            self._stacks[stack_key] = (tuple(parts), matrix)
+            self.current_bytes += matrix.nbytes
+            self._evict()
+        return matrix
+
+    def invalidate(self, user_id: str, document_hash: Optional[str] = None) -> int:
+        """Drop one document of a user, or every document of the user when no hash is given."""
+        with self._lock:
+            if document_hash is not None:
+                keys = [(user_id, document_hash)] if (user_id, document_hash) in self._entries else []
+            else:
+                keys = [key for key in self._entries if key[0] == user_id]
+            for key in keys:
+                self.current_bytes -= self._entries.pop(key).nbytes
+            # Stacks holding the document, whoever stacked it (shared content is stacked by its users)
+            if document_hash is not None:
+                stale = [k for k in self._stacks if document_hash in k[1:]]
+            else:
+                stale = [k for k in self._stacks if k[0] == user_id]
+            for key in stale:
+                self.current_bytes -= self._stacks.pop(key)[1].nbytes
+        if keys:
+            logger.debug(f"Invalidated {len(keys)} cached embedding matrices for user {user_id}")
+        return len(keys)
+
+    def invalidate_users(self, user_ids: Iterable[str]) -> int:
+        return sum(self.invalidate(user_id) for user_id in set(user_ids))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._stacks.clear()
+            self.current_bytes = 0
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "stacks": len(self._stacks),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": (self.hits / total) if total else 0.0,
+            }
+
+
+vector_cache = EmbeddingMatrixCache()
+
@@ -0,0 +1,366 @@
+# backend/app/services/vector_store.py
+
+from collections.abc import Sequence
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+
+import numpy as np
+
+from app.config import VECTOR_STORE_DIR, ANN_MIN_CHUNKS
+from app.db.mongodb import find_embeddings_for_documents, resolve_embedding_owners
+from app.services.vector_cache import DocumentVectors, vector_cache
+from app.utils.ann_index import IVFIndex, StackedRows, FlatIndex, VectorIndex, build_index
+from app.utils.embedding_codec import decode_embedding_into, embedding_dim, row_embedding_version
+from app.utils.embeddings import EMBEDDING_VERSION
+from app.utils.similarity import stack_embeddings
+
+logger = logging.getLogger(__name__)
+
+STORE_FORMAT_VERSION = 1
+_SAFE_HASH = re.compile(r"^[A-Za-z0-9_-]+$")
+
+
+class MappedTexts(Sequence):
+    """Read-only list of chunk texts backed by a memory-mapped UTF-8 blob and an offset table."""
+
+    def __init__(self, blob: np.ndarray, offsets: np.ndarray):
+        self._blob = blob
+        self._offsets = offsets
+
+    def __len__(self) -> int:
+        return int(self._offsets.shape[0])
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        start, end = self._offsets[index]
+        return bytes(self._blob[start:end]).decode("utf-8")
+
+
+class VectorStore:
+    """
+    Node-local store of normalized document embeddings.
+
+    Each document is written as a set of files inside a per-user directory:
+      <hash>.vec   float32 rows (rows x dim), opened with np.memmap so every
+                   worker on the node shares the same OS page cache
+      <hash>.txt   chunk texts concatenated as UTF-8
+      <hash>.idx   int64 table of (chunk_id, text_start, text_end) per row
+      <hash>.json  metadata, written last so a half-written document is never opened
+      <hash>.ivf.npz  IVF cluster structure, only for documents above ANN_MIN_CHUNKS
+    MongoDB stays the source of truth; missing or stale files are rebuilt from it.
+    """
+
+    def __init__(self, root: str = VECTOR_STORE_DIR):
+        self.root = Path(root)
+
+    def _user_dir(self, user_id: str) -> Path:
+        return self.root / hashlib.sha1(user_id.encode("utf-8")).hexdigest()
+
+    def _path(self, user_id: str, document_hash: str, suffix: str) -> Path:
+        if not _SAFE_HASH.match(document_hash):
+            raise ValueError(f"Invalid document hash: {document_hash!r}")
+        return self._user_dir(user_id) / f"{document_hash}{suffix}"
+
+    def path_for(self, user_id: str, name: str) -> Path:
+        """Path of an auxiliary per-user file (indexes, manifests) inside the store."""
+        stem, _, suffix = name.partition(".")
+        return self._path(user_id, stem, f".{suffix}" if suffix else "")
+
+    def _write_atomic(self, path: Path, data: bytes) -> None:
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def write_file(self, user_id: str, name: str, data: bytes) -> Path:
+        """Atomically write an auxiliary per-user file and return its path."""
+        path = self.path_for(user_id, name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._write_atomic(path, data)
+        return path
+
+    def exists(self, user_id: str, document_hash: str) -> bool:
+        return self._path(user_id, document_hash, ".json").exists()
+
+    def write(self, user_id: str, document_hash: str, matrix: np.ndarray,
+              texts: List[str], chunk_ids: List[int], version: Optional[str] = None) -> None:
+        """Persist a pre-normalized float32 matrix and its chunk texts for one document."""
+        matrix = np.ascontiguousarray(matrix, dtype="<f4")
+        if matrix.ndim != 2 or matrix.shape[0] != len(texts) or len(texts) != len(chunk_ids):
+            raise ValueError("Matrix rows, texts and chunk ids must have the same length")
+
+        self._user_dir(user_id).mkdir(parents=True, exist_ok=True)
+        meta_path = self._path(user_id, document_hash, ".json")
+        # Readers only open documents with metadata, so remove it before replacing the data files
+        meta_path.unlink(missing_ok=True)
+        self._path(user_id, document_hash, ".ivf.npz").unlink(missing_ok=True)
+
+        encoded = [t.encode("utf-8") for t in texts]
+        ends = np.cumsum([len(b) for b in encoded], dtype=np.int64)
+        table = np.empty((len(texts), 3), dtype="<i8")
+        table[:, 0] = chunk_ids
+        table[:, 1] = ends - [len(b) for b in encoded]
+        table[:, 2] = ends
+
+        self._write_atomic(self._path(user_id, document_hash, ".vec"), matrix.tobytes())
+        self._write_atomic(self._path(user_id, document_hash, ".txt"), b"".join(encoded))
+        self._write_atomic(self._path(user_id, document_hash, ".idx"), table.tobytes())
+        meta = {"version": STORE_FORMAT_VERSION, "rows": int(matrix.shape[0]), "dim": int(matrix.shape[1]),
+                "embedding_version": version}
+        self._write_atomic(meta_path, json.dumps(meta).encode("utf-8"))
+
+    def open(self, user_id: str, document_hash: str) -> Optional[DocumentVectors]:
+        """Memory-map a stored document, or return None when it is missing or unreadable."""
+        meta_path = self._path(user_id, document_hash, ".json")
+        try:
+            meta = json.loads(meta_path.read_text(encoding="utf-8"))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Unreadable vector store metadata for document {document_hash}: {e}")
+            return None
+
+        if meta.get("version") != STORE_FORMAT_VERSION or not meta.get("rows"):
+            return None
+
+        rows, dim = int(meta["rows"]), int(meta["dim"])
+        try:
+            matrix = np.memmap(self._path(user_id, document_hash, ".vec"), dtype="<f4", mode="r", shape=(rows, dim))
+            table = np.fromfile(self._path(user_id, document_hash, ".idx"), dtype="<i8").reshape(rows, 3)
+            text_path = self._path(user_id, document_hash, ".txt")
+            blob = np.memmap(text_path, dtype=np.uint8, mode="r") if text_path.stat().st_size else np.zeros(0, np.uint8)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not map vector store files for document {document_hash}: {e}")
+            return None
+
+        return DocumentVectors(
+            matrix=matrix,
+            texts=MappedTexts(blob, table[:, 1:]),
+            chunk_ids=table[:, 0].tolist(),
+            nbytes=int(matrix.nbytes) + int(blob.nbytes),
+            version=meta.get("embedding_version"),
+        )
+
+    def delete(self, user_id: str, document_hash: str) -> None:
+        for suffix in (".json", ".vec", ".txt", ".idx", ".ivf.npz"):
+            try:
+                self._path(user_id, document_hash, suffix).unlink(missing_ok=True)
+            except OSError as e:
+                logger.warning(f"Could not remove vector store file for document {document_hash}: {e}")
+
+    def delete_user(self, user_id: str) -> None:
+        shutil.rmtree(self._user_dir(user_id), ignore_errors=True)
+
+
+vector_store = VectorStore()
+
+
+async def save_document_vectors(user_id: str, document_hash: str, embeddings: List[List[float]],
+                                texts: List[str], chunk_ids: List[int], version: str = EMBEDDING_VERSION) -> None:
+    """Normalize embeddings and write them to the local store without blocking the event loop."""
+    matrix = stack_embeddings(embeddings)
+    try:
+        await asyncio.to_thread(vector_store.write, user_id, document_hash, matrix, texts, chunk_ids, version)
+    except Exception as e:
+        logger.error(f"Failed to write vector store files for document {document_hash}: {e}", exc_info=True)
+    vector_cache.invalidate(user_id, document_hash)
+
+
+class _DocumentRows:
+    """Growable float32 matrix plus chunk texts, filled row by row while a cursor streams in."""
+
+    def __init__(self, dim: int, capacity: int = 256):
+        self.matrix = np.empty((capacity, dim), dtype=np.float32)
+        self.texts: List[str] = []
+        self.chunk_ids: List[int] = []
+        self.skipped = 0
+
+    def add(self, row: dict) -> None:
+        chunk_id = row.get("chunk_id", row.get("chunk_index"))
+        text = row.get("text", row.get("chunk_text"))
+        n = len(self.texts)
+        if n == self.matrix.shape[0]:
+            self.matrix = np.resize(self.matrix, (2 * n, self.matrix.shape[1]))
+        if chunk_id is None or not text or not decode_embedding_into(self.matrix[n], row):
+            self.skipped += 1
+            return
+        self.texts.append(text)
+        self.chunk_ids.append(int(chunk_id))
+
+    def finish(self):
+        """Rows in chunk order: (matrix, texts, chunk_ids). Decoded rows are already unit length."""
+        n = len(self.texts)
+        ids = np.asarray(self.chunk_ids, dtype=np.int64)
+        if n < 2 or bool(np.all(ids[1:] >= ids[:-1])):
+            return self.matrix[:n], self.texts, self.chunk_ids
+        order = np.argsort(ids, kind="stable")
+        return self.matrix[:n][order], [self.texts[i] for i in order], ids[order].tolist()
+
+
+async def rebuild_documents_vectors(document_hashes: List[str], user_id: str) -> Dict[str, DocumentVectors]:
+    """
+    Rebuild the local store entries of several documents from MongoDB with a single
+    `$in` cursor, decoding each chunk row straight into its document's matrix.
+    Documents without usable chunks are missing from the result.
+
+    While a re-embedding migration is under way a document can briefly have rows of two
+    embedding versions; the version with more usable chunks wins, ties going to EMBEDDING_VERSION.
+    """
+    if not document_hashes:
+        return {}
+
+    building: Dict[Tuple[str, str], _DocumentRows] = {}
+    async for row in find_embeddings_for_documents(document_hashes, user_id):
+        key = (row.get("document_hash"), row_embedding_version(row))
+        rows = building.get(key)
+        if rows is None:
+            dim = embedding_dim(row)
+            if not dim:
+                continue
+            rows = building[key] = _DocumentRows(dim)
+        rows.add(row)
+
+    chosen: Dict[str, Tuple[str, _DocumentRows]] = {}
+    for (doc_hash, version), rows in building.items():
+        best = chosen.get(doc_hash)
+        if best is None or (len(rows.texts), version == EMBEDDING_VERSION) > (len(best[1].texts), best[0] == EMBEDDING_VERSION):
+            chosen[doc_hash] = (version, rows)
+
+    rebuilt = {}
+    for doc_hash, (version, rows) in chosen.items():
+        if rows.skipped:
+            logger.warning(f"Skipped {rows.skipped} chunks of document {doc_hash} with missing text or mismatched embedding")
+        if not rows.texts:
+            continue
+        matrix, texts, chunk_ids = rows.finish()
+        try:
+            await asyncio.to_thread(vector_store.write, user_id, doc_hash, matrix, texts, chunk_ids, version)
+        except Exception as e:
+            logger.error(f"Failed to write vector store files for document {doc_hash}: {e}", exc_info=True)
+        vector_cache.invalidate(user_id, doc_hash)
+        vectors = vector_store.open(user_id, doc_hash)
+        # Store not writable on this node: serve the in-memory matrix instead
+        rebuilt[doc_hash] = vectors if vectors is not None else DocumentVectors(matrix, texts, chunk_ids, version=version)
+    return rebuilt
+
+
+async def rebuild_document_vectors(document_hash: str, user_id: str) -> Optional[DocumentVectors]:
+    """Rebuild the local store entry of a document from its MongoDB embedding rows."""
+    return (await rebuild_documents_vectors([document_hash], user_id)).get(document_hash)
+
+
+# (user_id, document_hash) -> owner id the document's vectors are stored under
+_storage_owners: Dict[Tuple[str, str], str] = {}
+
+
+async def resolve_storage_owners(document_hashes: List[str], user_id: str) -> Dict[str, str]:
+    """
+    Owner of each document's vectors: the shared content owner for deduplicated uploads,
+    else the user. Resolved once per process from the user's document rows.
+    """
+    unknown = [h for h in document_hashes if (user_id, h) not in _storage_owners]
+    if unknown:
+        for doc_hash, owner in (await resolve_embedding_owners(unknown, user_id)).items():
+            _storage_owners[(user_id, doc_hash)] = owner
+    return {h: _storage_owners.get((user_id, h), user_id) for h in document_hashes}
+
+
+def storage_owner(document_hash: str, user_id: str) -> str:
+    return _storage_owners.get((user_id, document_hash), user_id)
+
+
+async def get_documents_vectors(document_hashes: List[str], user_id: str) -> Dict[str, Optional[DocumentVectors]]:
+    """
+    Embedding matrices of several documents. Cached and locally stored documents cost no
+    database access; all the others are rebuilt together in one MongoDB round trip per owner.
+    Documents backed by shared content are cached and stored once for all their users.
+    Stored files of another embedding version are re-checked against MongoDB, so documents
+    re-embedded by a migration are picked up by every node once EMBEDDING_VERSION points at them.
+    """
+    owners = await resolve_storage_owners(document_hashes, user_id)
+    found: Dict[str, Optional[DocumentVectors]] = {}
+    missing: Dict[str, List[str]] = {}
+    for doc_hash in document_hashes:
+        owner = owners[doc_hash]
+        vectors = vector_cache.get(owner, doc_hash)
+        if vectors is None:
+            vectors = vector_store.open(owner, doc_hash)
+            if vectors is not None and vectors.version != EMBEDDING_VERSION:
+                vectors = None
+        if vectors is None:
+            missing.setdefault(owner, []).append(doc_hash)
+        found[doc_hash] = vectors
+
+    for owner, hashes in missing.items():
+        rebuilt = await rebuild_documents_vectors(hashes, owner)
+        for doc_hash in hashes:
+            found[doc_hash] = rebuilt.get(doc_hash)
+
+    for doc_hash, vectors in found.items():
+        if vectors is not None:
+            vector_cache.put(owners[doc_hash], doc_hash, vectors)
+    return found
+
+
+async def get_document_vectors(document_hash: str, user_id: str) -> Optional[DocumentVectors]:
+    """
+    Return the embedding matrix of a document: from the process cache, else from the
+    memory-mapped local store, else rebuilt from MongoDB. Returns None when there are no chunks.
+    """
+    return (await get_documents_vectors([document_hash], user_id))[document_hash]
+
+
+def _load_or_build_document_index(user_id: str, document_hash: str, vectors: DocumentVectors) -> VectorIndex:
+    base = StackedRows([vectors.matrix])
+    if len(vectors) < ANN_MIN_CHUNKS:
+        return FlatIndex(base)
+
+    index_path = vector_store._path(user_id, document_hash, ".ivf.npz")
+    try:
+        index = IVFIndex.load(str(index_path), base)
+        if index is not None:
+            return index
+    except (OSError, ValueError, KeyError):
+        pass
+
+    logger.info(f"Building IVF index for document {document_hash} ({len(vectors)} chunks)")
+    index = build_index([vectors.matrix], ANN_MIN_CHUNKS)
+    try:
+        vector_store._user_dir(user_id).mkdir(parents=True, exist_ok=True)
+        index.save(str(index_path))
+    except OSError as e:
+        logger.warning(f"Could not persist IVF index for document {document_hash}: {e}")
+    return index
+
+
+async def get_document_index(document_hash: str, user_id: str, vectors: DocumentVectors) -> VectorIndex:
+    """
+    Search index of a document: exact for small documents, IVF above ANN_MIN_CHUNKS chunks.
+    IVF indexes are shared between workers through the store and built off the event loop.
+    """
+    if vectors.index is None:
+        owner = storage_owner(document_hash, user_id)
+        vectors.index = await asyncio.to_thread(_load_or_build_document_index, owner, document_hash, vectors)
+    return vectors.index
+
+
+def forget_document_vectors(user_id: str, document_hash: Optional[str] = None) -> None:
+    """
+    Drop cached and stored vectors of one document, or of every document of the user.
+    Shared content vectors are only dropped through SHARED_CONTENT_OWNER.
+    """
+    for key in [k for k in _storage_owners if k[0] == user_id and document_hash in (None, k[1])]:
+        del _storage_owners[key]
+    vector_cache.invalidate(user_id, document_hash)
+    if document_hash is None:
+        vector_store.delete_user(user_id)
+    else:
+        vector_store.delete(user_id, document_hash)
@@ -0,0 +1,169 @@
+import os
+from abc import ABC, abstractmethod
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from app.utils.similarity import normalize_rows, normalize_vector, top_k_indices
+
+
+class StackedRows:
+    """
+    Several row-aligned float32 matrices (in-memory or np.memmap) addressed as one.
+    Lets an index score rows spread over many documents without concatenating them.
+    """
+
+    def __init__(self, matrices: Sequence[np.ndarray]):
+        self.matrices = list(matrices)
+        self.offsets = np.cumsum([0] + [m.shape[0] for m in self.matrices], dtype=np.int64)
+        self.dim = int(self.matrices[0].shape[1]) if self.matrices else 0
+
+    def __len__(self) -> int:
+        return int(self.offsets[-1])
+
+    def dot(self, query: np.ndarray) -> np.ndarray:
+        """Scores of every row: one matmul per matrix, concatenated."""
+        if not self.matrices:
+            return np.zeros(0, dtype=np.float32)
+        return np.concatenate([m @ query for m in self.matrices])
+
+    def take(self, row_ids: np.ndarray) -> np.ndarray:
+        """Gather rows by global id; row_ids must be sorted ascending."""
+        out = np.empty((row_ids.shape[0], self.dim), dtype=np.float32)
+        bounds = np.searchsorted(row_ids, self.offsets)
+        for i, m in enumerate(self.matrices):
+            lo, hi = bounds[i], bounds[i + 1]
+            if hi > lo:
+                out[lo:hi] = m[row_ids[lo:hi] - self.offsets[i]]
+        return out
+
+    def remove(self, position: int) -> Tuple[int, int]:
+        """Drop the matrix at `position` and return the global row range it covered."""
+        start, end = int(self.offsets[position]), int(self.offsets[position + 1])
+        del self.matrices[position]
+        self.offsets = np.cumsum([0] + [m.shape[0] for m in self.matrices], dtype=np.int64)
+        return start, end
+
+
+class VectorIndex(ABC):
+    """Common interface for nearest-neighbour search over pre-normalized rows."""
+
+    def __init__(self, base: StackedRows):
+        self.base = base
+
+    def __len__(self) -> int:
+        return len(self.base)
+
+    @abstractmethod
+    def search(self, query: Sequence[float], k: int,
+               threshold: Optional[float] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Return (row_ids, scores) of the k most similar rows, best first."""
+
+    def remove(self, position: int) -> None:
+        """Remove one of the base matrices (e.g. a deleted document) from the index."""
+        self.base.remove(position)
+
+
+class FlatIndex(VectorIndex):
+    """Exact search: every row is scored, one matmul per base matrix."""
+
+    def search(self, query, k, threshold=None):
+        q = normalize_vector(query)
+        scores = self.base.dot(q)
+        top = top_k_indices(scores, k, threshold)
+        return top, scores[top]
+
+
+class IVFIndex(VectorIndex):
+    """
+    Inverted-file index: rows are clustered around `nlist` spherical k-means centroids
+    and a query only scores the rows of its `nprobe` closest clusters.
+    The index stores cluster structure only; vectors are read from the base matrices.
+    """
+
+    def __init__(self, base: StackedRows, centroids: np.ndarray, list_offsets: np.ndarray,
+                 row_ids: np.ndarray, nprobe: Optional[int] = None):
+        super().__init__(base)
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.row_ids = row_ids
+        self.nprobe = nprobe or max(8, centroids.shape[0] // 16)
+
+    @classmethod
+    def build(cls, base: StackedRows, nlist: Optional[int] = None, iterations: int = 10,
+              max_sample: int = 65536, seed: int = 0, block: int = 8192) -> "IVFIndex":
+        n = len(base)
+        nlist = nlist or int(np.clip(4 * np.sqrt(n), 1, 4096))
+        nlist = min(nlist, n)
+        rng = np.random.default_rng(seed)
+
+        # Train on ~40 rows per centroid, the usual lower bound for stable k-means
+        sample_size = min(n, max_sample, max(40 * nlist, 4096))
+        sample_ids = np.sort(rng.choice(n, size=sample_size, replace=False))
+        sample = base.take(sample_ids)
+        centroids = sample[rng.choice(sample.shape[0], size=nlist, replace=False)].copy()
+        for _ in range(iterations):
+            assign = np.argmax(sample @ centroids.T, axis=1)
+            counts = np.bincount(assign, minlength=nlist)
+            order = np.argsort(assign, kind="stable")
+            starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+            sums = np.zeros_like(centroids)
+            filled = counts > 0
+            sums[filled] = np.add.reduceat(sample[order], starts[filled], axis=0)
+            empty = counts == 0
+            if empty.any():
+                # Re-seed empty clusters with random sample rows
+                sums[empty] = sample[rng.choice(sample.shape[0], size=int(empty.sum()), replace=False)]
+            centroids = normalize_rows(sums)
+
+        assign = np.empty(n, dtype=np.int64)
+        for start in range(0, n, block):
+            ids = np.arange(start, min(start + block, n))
+            assign[start:start + ids.shape[0]] = np.argmax(base.take(ids) @ centroids.T, axis=1)
+
+        row_ids = np.argsort(assign, kind="stable").astype(np.int64)
+        list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=nlist))]).astype(np.int64)
+        return cls(base, centroids.astype(np.float32), list_offsets, row_ids)
+
+    def search(self, query, k, threshold=None):
+        q = normalize_vector(query)
+        probe = top_k_indices(self.centroids @ q, self.nprobe)
+        candidates = np.sort(np.concatenate(
+            [self.row_ids[self.list_offsets[p]:self.list_offsets[p + 1]] for p in probe]
+        ))
+        if candidates.shape[0] == 0:
+            return candidates, np.zeros(0, dtype=np.float32)
+        scores = self.base.take(candidates) @ q
+        top = top_k_indices(scores, k, threshold)
+        return candidates[top], scores[top]
+
+    def remove(self, position: int) -> None:
+        start, end = self.base.remove(position)
+        owner = np.repeat(np.arange(self.centroids.shape[0]), np.diff(self.list_offsets))
+        keep = (self.row_ids < start) | (self.row_ids >= end)
+        row_ids = self.row_ids[keep]
+        row_ids[row_ids >= end] -= end - start
+        counts = np.bincount(owner[keep], minlength=self.centroids.shape[0])
+        self.row_ids = row_ids
+        self.list_offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+    def save(self, path: str) -> None:
+        tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_path, centroids=self.centroids, list_offsets=self.list_offsets, row_ids=self.row_ids)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str, base: StackedRows) -> Optional["IVFIndex"]:
+        with np.load(path) as data:
+            index = cls(base, data["centroids"], data["list_offsets"], data["row_ids"])
+        if index.row_ids.shape[0] != len(base) or index.centroids.shape[1] != base.dim:
+            return None
+        return index
+
+
+def build_index(matrices: List[np.ndarray], min_rows: int) -> VectorIndex:
+    """Exact search for small corpora, an IVF index once there are at least `min_rows` rows."""
+    base = StackedRows(matrices)
+    if len(base) < max(min_rows, 1):
+        return FlatIndex(base)
+    return IVFIndex.build(base)
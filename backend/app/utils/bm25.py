@@ -0,0 +1,126 @@
+import os
+import re
+from typing import Iterable, List, Optional, Sequence
+
+import numpy as np
+
+_TOKEN = re.compile(r"\b\w+\b")
+
+
+def tokenize(text: str) -> List[str]:
+    """Lower-cased word tokens, the same split the FAQ word-overlap scoring has always used."""
+    return _TOKEN.findall(text.lower())
+
+
+class BM25Index:
+    """
+    Inverted index over chunk texts with BM25 statistics.
+
+    Postings are kept in CSR form: the postings of term t are rows
+    doc_ids[term_offsets[t]:term_offsets[t + 1]] with their term frequencies in `tfs`.
+    Per-posting BM25 weights are precomputed, so a query only sums the postings of its terms.
+    """
+
+    def __init__(self, terms: Sequence[str], term_offsets: np.ndarray, doc_ids: np.ndarray,
+                 tfs: np.ndarray, doc_lengths: np.ndarray, k1: float = 1.5, b: float = 0.75):
+        self.terms = list(terms)
+        self.vocabulary = {term: i for i, term in enumerate(self.terms)}
+        self.term_offsets = term_offsets
+        self.doc_ids = doc_ids
+        self.tfs = tfs
+        self.doc_lengths = doc_lengths
+        self.k1 = k1
+        self.b = b
+        self._compute_weights()
+
+    def __len__(self) -> int:
+        return int(self.doc_lengths.shape[0])
+
+    @classmethod
+    def build(cls, texts: Iterable[str], **params) -> "BM25Index":
+        vocabulary = {}
+        term_ids: List[int] = []
+        posting_docs: List[int] = []
+        posting_tfs: List[int] = []
+        doc_lengths: List[int] = []
+        for doc_id, text in enumerate(texts):
+            tokens = tokenize(text or "")
+            doc_lengths.append(len(tokens))
+            counts = {}
+            for token in tokens:
+                counts[token] = counts.get(token, 0) + 1
+            for token, tf in counts.items():
+                term_ids.append(vocabulary.setdefault(token, len(vocabulary)))
+                posting_docs.append(doc_id)
+                posting_tfs.append(tf)
+
+        term_ids = np.asarray(term_ids, dtype=np.int64)
+        order = np.argsort(term_ids, kind="stable")  # keeps doc ids ascending within each term
+        counts = np.bincount(term_ids, minlength=len(vocabulary))
+        return cls(
+            terms=list(vocabulary),
+            term_offsets=np.concatenate([[0], np.cumsum(counts)]).astype(np.int64),
+            doc_ids=np.asarray(posting_docs, dtype=np.int32)[order],
+            tfs=np.asarray(posting_tfs, dtype=np.float32)[order],
+            doc_lengths=np.asarray(doc_lengths, dtype=np.float32),
+            **params,
+        )
+
+    def _compute_weights(self) -> None:
+        n = len(self)
+        df = np.diff(self.term_offsets).astype(np.float32)
+        self.idf = np.log1p((n - df + 0.5) / (df + 0.5)).astype(np.float32)
+        avgdl = float(self.doc_lengths.mean()) if n and self.doc_lengths.sum() > 0 else 1.0
+        posting_terms = np.repeat(np.arange(df.shape[0]), df.astype(np.int64))
+        norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[self.doc_ids] / avgdl)
+        self.weights = self.idf[posting_terms] * self.tfs * (self.k1 + 1) / (self.tfs + norm)
+
+    def _query_terms(self, query: str) -> List[int]:
+        return sorted({self.vocabulary[t] for t in tokenize(query) if t in self.vocabulary})
+
+    def _accumulate(self, term_ids: List[int], values: Optional[np.ndarray]) -> np.ndarray:
+        out = np.zeros(len(self), dtype=np.float32)
+        for t in term_ids:
+            lo, hi = self.term_offsets[t], self.term_offsets[t + 1]
+            out[self.doc_ids[lo:hi]] += values[lo:hi] if values is not None else 1.0
+        return out
+
+    def scores(self, query: str) -> np.ndarray:
+        """BM25 score of every chunk for the query."""
+        return self._accumulate(self._query_terms(query), self.weights)
+
+    def matched_terms(self, query: str) -> np.ndarray:
+        """Number of distinct query words each chunk contains."""
+        return self._accumulate(self._query_terms(query), None)
+
+    def remove(self, start: int, end: int) -> None:
+        """Drop chunks [start, end) (a deleted document) and renumber the chunks after them."""
+        keep = (self.doc_ids < start) | (self.doc_ids >= end)
+        posting_terms = np.repeat(np.arange(len(self.terms)), np.diff(self.term_offsets))[keep]
+        doc_ids = self.doc_ids[keep]
+        doc_ids[doc_ids >= end] -= end - start
+        counts = np.bincount(posting_terms, minlength=len(self.terms))
+        self.doc_ids = doc_ids
+        self.tfs = self.tfs[keep]
+        self.term_offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        self.doc_lengths = np.delete(self.doc_lengths, np.s_[start:end])
+        self._compute_weights()
+
+    def save(self, path: str) -> None:
+        # Tokens never contain whitespace, so the vocabulary is stored newline-joined
+        vocabulary = np.frombuffer("\n".join(self.terms).encode("utf-8"), dtype=np.uint8)
+        tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_path, vocabulary=vocabulary, term_offsets=self.term_offsets, doc_ids=self.doc_ids,
+                 tfs=self.tfs, doc_lengths=self.doc_lengths, params=np.array([self.k1, self.b]))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "BM25Index":
+        with np.load(path) as data:
+            vocabulary = bytes(data["vocabulary"]).decode("utf-8")
+            k1, b = data["params"].tolist()
+            return cls(
+                terms=vocabulary.split("\n") if vocabulary else [],
+                term_offsets=data["term_offsets"], doc_ids=data["doc_ids"], tfs=data["tfs"],
+                doc_lengths=data["doc_lengths"], k1=k1, b=b,
+            )
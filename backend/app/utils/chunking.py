@@ -0,0 +1,232 @@
+from typing import Iterable, Iterator, List, Optional, Tuple
+import re
+
+from app.config import CHUNK_MAX_TOKENS, CHUNK_OVERLAP_TOKENS, EMBEDDING_MODEL
+from app.utils.embeddings import embedding_tokenizer
+
+# Joins page texts into one document text; chunks never span it
+PAGE_SEPARATOR = "\n\n--- PAGE BREAK ---\n\n"
+
+# Markdown headings, numbered sections ("1.", "2.3", "IV.", "Article 5", "Section 2.1") and short all-caps lines
+_HEADING = re.compile(
+    r'^(?:#{1,6}\s+\S'
+    r'|(?:\d{1,2}(?:\.\d{1,2})*\.?|[IVXLC]{1,6}\.)\s+[A-Z]'
+    r'|(?i:article|section|chapter|schedule|annex|appendix)\s+[\dIVXLC])'
+)
+_SENTENCE_END = re.compile(r'(?<=[.!?])\s+')
+# A PAGE_SEPARATOR line, however much whitespace the page texts around it carry
+_PAGE_BREAK = re.compile(r'^[ \t]*--- PAGE BREAK ---[ \t]*$', re.MULTILINE)
+
+# Pieces longer than this many characters per budget token are split before they are encoded,
+# so no single encode call sees more than a few pages of text (tiktoken slows down on long
+# runs without whitespace)
+_MAX_CHARS_PER_TOKEN = 16
+
+# (text, tokens, separator placed before it when it follows another piece, is a heading)
+Piece = Tuple[str, int, str, bool]
+
+
+def _is_heading(line: str) -> bool:
+    if len(line) > 120:
+        return False
+    if _HEADING.match(line):
+        return True
+    letters = sum(1 for c in line if c.isalpha())
+    return 3 <= letters <= 80 and line.isupper()
+
+
+def _lines(text: str) -> Iterator[str]:
+    """Lines of `text`, without building a list of them."""
+    start = 0
+    while True:
+        end = text.find("\n", start)
+        if end < 0:
+            yield text[start:]
+            return
+        yield text[start:end]
+        start = end + 1
+
+
+def iter_pages(text: str) -> Iterator[str]:
+    """Page texts of a document whose pages are joined with PAGE_SEPARATOR."""
+    start = 0
+    for match in _PAGE_BREAK.finditer(text):
+        yield text[start:match.start()]
+        start = match.end()
+    yield text[start:]
+
+
+def page_spans(text: str) -> List[List[int]]:
+    """[start, end) character offsets of each page of a document (see iter_pages)."""
+    spans = []
+    start = 0
+    for match in _PAGE_BREAK.finditer(text):
+        spans.append([start, match.start()])
+        start = match.end()
+    spans.append([start, len(text)])
+    return spans
+
+
+class TokenChunker:
+    """
+    Splits document text into chunks of about `max_tokens` embedding-model tokens.
+
+    Pages are chunked separately, so no chunk spans a page break. Within a page, text is
+    split at headings and paragraphs; lines, then sentences, then word runs, then token
+    windows are only used to break up a paragraph that is larger than the budget on its
+    own. Consecutive pieces are packed until the budget is reached, and each chunk after
+    the first starts with the last sentences (at most `overlap_tokens`) of the one before
+    it. A heading starts a new chunk, without overlap, once the current one holds a
+    quarter of the budget.
+
+    Work is linear in the input: pages and lines are scanned once, no regex can backtrack
+    across more than a line, each character is encoded at most once per split level, and
+    chunks are produced lazily, so `chunk_pages` can run over documents far larger than memory.
+    """
+
+    def __init__(self, max_tokens: int = CHUNK_MAX_TOKENS, overlap_tokens: int = CHUNK_OVERLAP_TOKENS,
+                 model: str = EMBEDDING_MODEL):
+        self.max_tokens = max(16, max_tokens)
+        self.overlap_tokens = max(0, min(overlap_tokens, self.max_tokens // 2))
+        self.min_section_tokens = self.max_tokens // 4
+        self.max_piece_chars = self.max_tokens * _MAX_CHARS_PER_TOKEN
+        self.encoding = embedding_tokenizer(model)
+
+    def count(self, text: str) -> int:
+        return len(self.encoding.encode(text, disallowed_special=()))
+
+    def _units(self, page_text: str) -> Iterator[Tuple[str, bool]]:
+        """Paragraphs and headings of a page, in order."""
+        paragraph: List[str] = []
+        for raw in _lines(page_text):
+            line = raw.strip()
+            if not line or _is_heading(line):
+                if paragraph:
+                    yield "\n".join(paragraph), False
+                    paragraph = []
+                if line:
+                    yield line, True
+            else:
+                paragraph.append(line)
+        if paragraph:
+            yield "\n".join(paragraph), False
+
+    def _split_words(self, text: str) -> List[str]:
+        """Runs of whole words of at most max_piece_chars characters (longer words stand alone)."""
+        runs: List[str] = []
+        run: List[str] = []
+        size = 0
+        for word in text.split():
+            if run and size + len(word) + 1 > self.max_piece_chars:
+                runs.append(" ".join(run))
+                run, size = [], 0
+            run.append(word)
+            size += len(word) + 1
+        if run:
+            runs.append(" ".join(run))
+        return runs
+
+    def _fit(self, text: str, separator: str, heading: bool, level: int = 0) -> Iterator[Piece]:
+        """`text` as one piece, or broken into lines, sentences, word runs or token windows that fit the budget."""
+        if len(text) <= self.max_piece_chars:
+            tokens = self.count(text)
+            if tokens <= self.max_tokens:
+                yield text, tokens, separator, heading
+                return
+        splitters = (
+            (lambda t: t.split("\n"), "\n"),
+            (_SENTENCE_END.split, " "),
+            (self._split_words, " "),
+        )
+        for depth in range(level, len(splitters)):
+            split, joiner = splitters[depth]
+            parts = [p.strip() for p in split(text)]
+            parts = [p for p in parts if p]
+            if len(parts) > 1:
+                for i, part in enumerate(parts):
+                    yield from self._fit(part, separator if i == 0 else joiner, heading and i == 0, depth + 1)
+                return
+        # One unbroken run: fixed token windows over bounded character windows
+        first = True
+        for start in range(0, len(text), self.max_piece_chars):
+            ids = self.encoding.encode(text[start:start + self.max_piece_chars], disallowed_special=())
+            for offset in range(0, len(ids), self.max_tokens):
+                window = ids[offset:offset + self.max_tokens]
+                yield self.encoding.decode(window), len(window), separator if first else "", heading and first
+                first = False
+
+    def _overlap(self, pieces: List[Piece]) -> List[Piece]:
+        """Trailing sentences of a chunk, at most overlap_tokens long, to repeat at the start of the next one."""
+        tail: List[Piece] = []
+        size = 0
+        for text, tokens, separator, heading in reversed(pieces):
+            if size + tokens <= self.overlap_tokens:
+                tail.insert(0, (text, tokens, separator, heading))
+                size += tokens
+                continue
+            for sentence in reversed([s for s in _SENTENCE_END.split(text) if s.strip()]):
+                sentence_tokens = self.count(sentence)
+                if size + sentence_tokens > self.overlap_tokens:
+                    break
+                tail.insert(0, (sentence, sentence_tokens, " ", False))
+                size += sentence_tokens
+            break
+        return tail
+
+    def _page_chunks(self, page_text: str) -> Iterator[str]:
+        current: List[Piece] = []
+        size = 0
+        new_pieces = 0
+
+        def join(pieces: List[Piece]) -> str:
+            return "".join(text if i == 0 else separator + text
+                           for i, (text, _, separator, _) in enumerate(pieces))
+
+        page_text = page_text.replace('\r\n', '\n').replace('\r', '\n')
+        for unit, heading in self._units(page_text):
+            for piece in self._fit(unit, "\n\n", heading):
+                tokens, is_heading = piece[1], piece[3]
+                if is_heading and new_pieces and size >= self.min_section_tokens:
+                    yield join(current)
+                    current, size, new_pieces = [], 0, 0
+                elif new_pieces and size + tokens > self.max_tokens:
+                    # A heading at the end of a full chunk moves on with the text it introduces
+                    carried = [current.pop()] if current[-1][3] and len(current) > 1 else []
+                    yield join(current)
+                    current = carried or self._overlap(current)
+                    size = sum(p[1] for p in current)
+                    if not carried and size + tokens > self.max_tokens:
+                        current, size = [], 0
+                    new_pieces = len(carried)
+                current.append(piece)
+                size += tokens
+                new_pieces += 1
+        if new_pieces:
+            yield join(current)
+
+    def chunk_pages(self, pages: Iterable[str]) -> Iterator[Tuple[int, str]]:
+        """(page index, chunk) for every chunk of the given page texts, produced as the pages are consumed."""
+        for page_index, page_text in enumerate(pages):
+            for chunk in self._page_chunks(page_text):
+                yield page_index, chunk
+
+    def split_with_pages(self, text: Optional[str]) -> List[Tuple[int, str]]:
+        """(page number from 1, chunk) for every chunk of a document whose pages are joined with PAGE_SEPARATOR."""
+        if not text or not text.strip():
+            return []
+        return [(page_index + 1, chunk) for page_index, chunk in self.chunk_pages(iter_pages(text))]
+
+    def split_with_counts(self, text: Optional[str]) -> List[Tuple[int, str, int]]:
+        """
+        (page number from 1, chunk, embedding-model tokens) for every chunk of a document. The
+        counts let the embedding backend pack requests without encoding the chunks again; this
+        is CPU-bound, so async callers run it with asyncio.to_thread.
+        """
+        return [(page, chunk, self.count(chunk)) for page, chunk in self.split_with_pages(text)]
+
+    def split(self, text: Optional[str]) -> List[str]:
+        """Chunks of a document whose pages are joined with PAGE_SEPARATOR."""
+        return [chunk for _, chunk in self.split_with_pages(text)]
+
+
+document_chunker = TokenChunker()
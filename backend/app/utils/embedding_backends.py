@@ -0,0 +1,140 @@
+from abc import ABC, abstractmethod
+from collections import Counter
+from typing import List, Optional, Sequence
+import asyncio
+import functools
+import logging
+import zlib
+
+import numpy as np
+
+from app.config import LOCAL_EMBEDDING_DIMENSIONS
+from app.utils.bm25 import tokenize
+
+logger = logging.getLogger(__name__)
+
+LOCAL_MODEL_PREFIX = "local-"
+HASHING_MODEL = "local-hashing"
+
+# Texts encoded on the event loop; larger batches go to a worker thread
+_INLINE_BATCH = 16
+
+
+class EmbeddingBackend(ABC):
+    """
+    A family of embedding models. EmbeddingService resolves the backend from the model
+    name, so stored rows (whose embedding_version names the model) and the prompts searched
+    against them always go to the same backend.
+    """
+
+    # Remote backends are served through the embedding cache and the shared rate limiter
+    remote = True
+
+    @abstractmethod
+    def handles(self, model: str) -> bool:
+        """Whether `model` belongs to this backend."""
+
+    def request_dimensions(self, model: str, dimensions: Optional[int]) -> Optional[int]:
+        """Vector size to produce for `model`, or None for the model's own size."""
+        return None
+
+    @abstractmethod
+    async def embed(self, texts: Sequence[str], model: str, dimensions: Optional[int],
+                    **options) -> List[Optional[List[float]]]:
+        """Embeddings aligned with `texts`; None for empty texts and failures."""
+
+
+@functools.lru_cache(maxsize=1 << 18)
+def _feature_hash(feature: str) -> int:
+    return zlib.crc32(feature.encode("utf-8"))
+
+
+class HashingEncoder:
+    """
+    Stateless bag-of-words encoder: word unigrams and bigrams are hashed into `dimensions`
+    signed buckets (the hashing trick) with sublinear term-frequency weights, and the vector
+    is L2-normalized. Deterministic across processes and nodes, needs no vocabulary or
+    network, and costs microseconds per chunk.
+    """
+
+    def __init__(self, dimensions: int):
+        self.dimensions = dimensions
+
+    def _features(self, text: str) -> Counter:
+        tokens = tokenize(text)
+        features = Counter(tokens)
+        features.update(f"{a} {b}" for a, b in zip(tokens, tokens[1:]))
+        return features
+
+    def encode(self, texts: Sequence[str]) -> np.ndarray:
+        matrix = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            features = self._features(text or "")
+            if not features:
+                continue
+            hashes = np.fromiter((_feature_hash(f) for f in features), dtype=np.uint32, count=len(features))
+            counts = np.fromiter(features.values(), dtype=np.float32, count=len(features))
+            # Low bits pick the bucket, the top bit the sign (collisions cancel instead of piling up)
+            signs = np.where(hashes >> 31, -1.0, 1.0).astype(np.float32)
+            np.add.at(matrix[row], hashes % self.dimensions, signs * (1.0 + np.log(counts)))
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        np.divide(matrix, norms, out=matrix, where=norms > 0)
+        return matrix
+
+
+class LocalHashingBackend(EmbeddingBackend):
+    """CPU-only `local-*` models for air-gapped installs and offline runs."""
+
+    remote = False
+
+    def __init__(self, default_dimensions: int = LOCAL_EMBEDDING_DIMENSIONS):
+        self.default_dimensions = default_dimensions
+        self._encoders = {}
+
+    def handles(self, model: str) -> bool:
+        return model.startswith(LOCAL_MODEL_PREFIX)
+
+    def request_dimensions(self, model: str, dimensions: Optional[int]) -> Optional[int]:
+        # Always explicit, so the size is part of the embedding version
+        return dimensions or self.default_dimensions
+
+    def encoder(self, model: str, dimensions: int) -> HashingEncoder:
+        if model != HASHING_MODEL:
+            raise ValueError(f"Unknown local embedding model: {model!r}")
+        if dimensions not in self._encoders:
+            self._encoders[dimensions] = HashingEncoder(dimensions)
+        return self._encoders[dimensions]
+
+    async def embed(self, texts, model, dimensions, **options):
+        encoder = self.encoder(model, self.request_dimensions(model, dimensions))
+        if len(texts) <= _INLINE_BATCH:
+            matrix = encoder.encode(texts)
+        else:
+            matrix = await asyncio.to_thread(encoder.encode, texts)
+        return [row.tolist() if text and text.strip() else None for text, row in zip(texts, matrix)]
+
+
+_backends: List[EmbeddingBackend] = [LocalHashingBackend()]
+_default_backend: Optional[EmbeddingBackend] = None
+
+
+def register_embedding_backend(backend: EmbeddingBackend, default: bool = False) -> None:
+    """Add a backend; the default one serves every model no other backend handles."""
+    global _default_backend
+    if default:
+        _default_backend = backend
+    else:
+        _backends.insert(0, backend)
+
+
+def embedding_backend(model: str) -> EmbeddingBackend:
+    for backend in _backends:
+        if backend.handles(model):
+            return backend
+    if _default_backend is None:
+        raise ValueError(f"No embedding backend for model {model!r}")
+    return _default_backend
+
+
+def is_local_model(model: str) -> bool:
+    return not embedding_backend(model).remote
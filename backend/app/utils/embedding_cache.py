@@ -0,0 +1,167 @@
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Sequence
+import hashlib
+import logging
+import threading
+
+import numpy as np
+from pymongo import UpdateOne
+
+from app.config import EMBEDDING_CONTENT_CACHE_MB, EMBEDDING_CONTENT_CACHE_PERSIST
+from app.db.mongodb import embedding_cache_collection
+from app.utils.embedding_codec import decode_embedding, encode_embedding, is_packed
+
+logger = logging.getLogger(__name__)
+
+# Rough per-entry overhead of the key, the array header and the LRU links
+_ENTRY_OVERHEAD_BYTES = 200
+
+_ROW_PROJECTION = {"embedding": 1, "embedding_dtype": 1, "embedding_dim": 1, "embedding_scale": 1, "embedding_norm": 1}
+
+
+def _decode_row(row: Dict[str, Any]) -> Optional[np.ndarray]:
+    """Embedding of a persisted entry at its original length (entries from before packing hold raw float32)."""
+    if not is_packed(row):
+        return np.frombuffer(row["embedding"], dtype="<f4").copy()
+    vector = decode_embedding(row)
+    return vector * np.float32(row.get("embedding_norm", 1.0)) if vector is not None else None
+
+
+def embedding_cache_key(text: str, model: str, dimensions: Optional[int] = None) -> str:
+    """Content address of an embedding: SHA-256 of model, dimensions and the exact text embedded."""
+    payload = f"{model}\x00{dimensions or 0}\x00{text}"
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Two-tier cache of chunk embeddings keyed by `embedding_cache_key`.
+
+    The first tier is a process-local LRU of float32 arrays bounded by a byte budget.
+    The second tier is the embedding_cache MongoDB collection, shared by every worker
+    and kept across restarts; hits there are promoted into the LRU. It stores vectors
+    packed like chunk rows (EMBEDDING_STORAGE_DTYPE) and expires entries after
+    EMBEDDING_CONTENT_CACHE_TTL. Lookups and writes are batched so a document costs one
+    round trip per tier.
+    """
+
+    def __init__(self, max_mb: int = EMBEDDING_CONTENT_CACHE_MB, persist: bool = EMBEDDING_CONTENT_CACHE_PERSIST):
+        self.max_bytes = max(0, max_mb) * 1024 * 1024
+        self.persist = persist
+        self._entries: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.persistent_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _get_local(self, key: str) -> Optional[np.ndarray]:
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is not None:
+                self._entries.move_to_end(key)
+            return vector
+
+    def _put_local(self, key: str, vector: np.ndarray) -> None:
+        size = vector.nbytes + _ENTRY_OVERHEAD_BYTES
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.current_bytes -= previous.nbytes + _ENTRY_OVERHEAD_BYTES
+            self._entries[key] = vector
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self.current_bytes -= evicted.nbytes + _ENTRY_OVERHEAD_BYTES
+                self.evictions += 1
+
+    async def get_many(self, keys: Iterable[str]) -> Dict[str, List[float]]:
+        """Cached embeddings of the given keys; keys that are in neither tier are left out."""
+        found: Dict[str, List[float]] = {}
+        missing: List[str] = []
+        for key in dict.fromkeys(keys):
+            vector = self._get_local(key)
+            if vector is not None:
+                found[key] = vector.tolist()
+            else:
+                missing.append(key)
+        self.hits += len(found)
+
+        if missing and self.persist:
+            try:
+                cursor = embedding_cache_collection.find({"_id": {"$in": missing}}, _ROW_PROJECTION)
+                async for row in cursor:
+                    vector = _decode_row(row)
+                    if vector is None:
+                        continue
+                    self._put_local(row["_id"], vector)
+                    found[row["_id"]] = vector.tolist()
+                    self.persistent_hits += 1
+            except Exception as e:
+                logger.warning(f"Embedding cache lookup failed: {e}")
+
+        self.misses += sum(1 for key in missing if key not in found)
+        return found
+
+    async def get(self, key: str) -> Optional[List[float]]:
+        return (await self.get_many([key])).get(key)
+
+    async def put_many(self, entries: Dict[str, Sequence[float]], model: str,
+                       dimensions: Optional[int] = None) -> None:
+        """Store freshly generated embeddings in both tiers."""
+        if not entries:
+            return
+        operations = []
+        now = datetime.utcnow()
+        for key, embedding in entries.items():
+            vector = np.asarray(embedding, dtype="<f4")
+            self._put_local(key, vector)
+            if self.persist:
+                operations.append(UpdateOne(
+                    {"_id": key},
+                    {"$setOnInsert": {
+                        "model": model,
+                        "dimensions": int(vector.shape[0]),
+                        "requested_dimensions": dimensions or 0,
+                        **encode_embedding(vector),
+                        "created_at": now,
+                    }},
+                    upsert=True
+                ))
+        if operations:
+            try:
+                await embedding_cache_collection.bulk_write(operations, ordered=False)
+            except Exception as e:
+                logger.warning(f"Embedding cache write of {len(operations)} entries failed: {e}")
+
+    async def put(self, key: str, embedding: Sequence[float], model: str, dimensions: Optional[int] = None) -> None:
+        await self.put_many({key: embedding}, model, dimensions)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            entries = len(self._entries)
+            current_bytes = self.current_bytes
+        total = self.hits + self.persistent_hits + self.misses
+        return {
+            "entries": entries,
+            "bytes": current_bytes,
+            "max_bytes": self.max_bytes,
+            "persist": self.persist,
+            "hits": self.hits,
+            "persistent_hits": self.persistent_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": ((self.hits + self.persistent_hits) / total) if total else 0.0,
+        }
+
+
+embedding_cache = EmbeddingCache()
@@ -0,0 +1,122 @@
+from typing import Any, Dict, Mapping, Optional, Sequence, Tuple
+
+import numpy as np
+from bson.binary import Binary
+
+from app.config import EMBEDDING_STORAGE_DTYPE, EMBEDDING_LEGACY_VERSION
+
+# Stored dtype codes: packed little-endian values of the unit-length vector
+STORAGE_DTYPES = {
+    "float32": "<f4",
+    "float16": "<f2",
+    "int8": "i1",
+}
+_CODE_TO_DTYPE = {code: np.dtype(code) for code in STORAGE_DTYPES.values()}
+
+
+def embedding_version(model: str, dimensions: Optional[int] = None) -> str:
+    """Name of the vector space an embedding lives in: the model, plus the requested size when reduced."""
+    return f"{model}/{dimensions}" if dimensions else model
+
+
+def parse_embedding_version(version: str) -> Tuple[str, Optional[int]]:
+    """(model, dimensions) of a version built by `embedding_version`."""
+    model, _, dimensions = version.partition("/")
+    return model, int(dimensions) if dimensions else None
+
+
+def row_embedding_version(row: Mapping[str, Any]) -> str:
+    """Version of a stored row; rows written before versioning get EMBEDDING_LEGACY_VERSION."""
+    return row.get("embedding_version") or EMBEDDING_LEGACY_VERSION
+
+
+def encode_embedding(vector: Sequence[float], storage_dtype: str = EMBEDDING_STORAGE_DTYPE,
+                     version: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Pack an embedding into the fields stored on an embeddings_collection row.
+
+    The vector is normalized before packing (retrieval only uses cosine similarity) and
+    its original length is kept in `embedding_norm`, its dimension count in `embedding_dim` and,
+    when given, its version (see `embedding_version`) and model in `embedding_version` and
+    `embedding_model`. int8 rows store codes of
+    `value / embedding_scale`, with the scale chosen per vector so the largest component maps to 127.
+    """
+    code = STORAGE_DTYPES.get(storage_dtype)
+    if code is None:
+        raise ValueError(f"Unsupported embedding storage dtype: {storage_dtype!r}")
+
+    vec = np.asarray(vector, dtype=np.float32).ravel()
+    norm = float(np.linalg.norm(vec))
+    unit = vec / norm if norm > 0 else vec
+
+    scale = 1.0
+    if code == "i1":
+        peak = float(np.abs(unit).max()) if unit.size else 0.0
+        scale = peak / 127.0 if peak > 0 else 1.0
+        packed = np.clip(np.rint(unit / scale), -127, 127).astype("i1")
+    else:
+        packed = unit.astype(code)
+
+    fields = {
+        "embedding": Binary(packed.tobytes()),
+        "embedding_dtype": code,
+        "embedding_dim": int(vec.shape[0]),
+        "embedding_scale": scale,
+        "embedding_norm": norm,
+    }
+    if version:
+        fields["embedding_model"] = parse_embedding_version(version)[0]
+        fields["embedding_version"] = version
+    return fields
+
+
+def is_packed(row: Mapping[str, Any]) -> bool:
+    return "embedding_dtype" in row and isinstance(row.get("embedding"), (bytes, bytearray, memoryview))
+
+
+def decode_embedding_raw(row: Mapping[str, Any]) -> np.ndarray:
+    """Zero-copy view of a packed embedding in its stored dtype (codes for int8 rows)."""
+    return np.frombuffer(row["embedding"], dtype=_CODE_TO_DTYPE[row["embedding_dtype"]])
+
+
+def decode_embedding_into(out: np.ndarray, row: Mapping[str, Any]) -> bool:
+    """
+    Write a row's unit-length float32 embedding into `out` (e.g. one row of a preallocated
+    matrix). Handles packed rows and legacy rows stored as arrays of doubles.
+    Returns False when the embedding is missing or its dimension does not match.
+    """
+    embedding = row.get("embedding")
+    if embedding is None or len(embedding) == 0:
+        return False
+
+    if is_packed(row):
+        values = decode_embedding_raw(row)
+        if values.shape[0] != out.shape[0]:
+            return False
+        np.multiply(values, np.float32(row.get("embedding_scale", 1.0)), out=out, casting="unsafe")
+        return True
+
+    if len(embedding) != out.shape[0]:
+        return False
+    out[:] = embedding
+    norm = float(np.linalg.norm(out))
+    if norm > 0:
+        out /= norm
+    return True
+
+
+def decode_embedding(row: Mapping[str, Any], dim: Optional[int] = None) -> Optional[np.ndarray]:
+    """Unit-length float32 embedding of a row, or None when it is missing or the wrong size."""
+    embedding = row.get("embedding")
+    if embedding is None:
+        return None
+    if dim is None:
+        dim = int(row["embedding_dim"]) if is_packed(row) else len(embedding)
+    out = np.empty(dim, dtype=np.float32)
+    return out if decode_embedding_into(out, row) else None
+
+
+def embedding_dim(row: Mapping[str, Any]) -> int:
+    if is_packed(row):
+        return int(row.get("embedding_dim") or decode_embedding_raw(row).shape[0])
+    return len(row.get("embedding") or [])
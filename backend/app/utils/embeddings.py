@@ -3,10 +3,28 @@ from openai import AsyncOpenAI
 import os
 from dotenv import load_dotenv
 import asyncio
-from typing import List, Dict, Any
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+import functools
+import hashlib
+import threading
 import time
+import unicodedata
 import logging
 
+import tiktoken
+
+from app.config import (
+    QUERY_EMBEDDING_CACHE_SIZE, QUERY_EMBEDDING_CACHE_TTL, QUERY_EMBEDDING_CACHE_PERSIST,
+    EMBEDDING_REQUEST_MAX_TOKENS, EMBEDDING_REQUEST_CONCURRENCY, EMBEDDING_MODEL, EMBEDDING_DIMENSIONS
+)
+from app.utils.rate_limiter import get_rate_limiter
+from app.db.mongodb import query_embedding_cache_collection
+from app.utils.embedding_cache import embedding_cache, embedding_cache_key
+from app.utils.embedding_codec import embedding_version, parse_embedding_version
+from app.utils.embedding_backends import EmbeddingBackend, embedding_backend, register_embedding_backend
+
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -17,170 +35,365 @@ load_dotenv()
 # Initialize OpenAI clients
 client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 openai_client = client  # Alias for backward compatibility
+# Retries of rate-limited calls are left to the shared limiter so it can see every 429
+limited_client = client.with_options(max_retries=0)
 
-async def get_embedding(text: str, model: str = "text-embedding-ada-002") -> list[float]:
-    """Get embedding for a text using OpenAI's embedding model asynchronously."""
-    try:
-        # Ensure text is not empty
-        if not text or text.strip() == "":
-            logger.warning("Empty text provided to get_embedding")
-            return []
-        
-        # Truncate text if it's too long (OpenAI has token limits)
-        max_tokens = 8000  # Adjust based on model limits
-        if len(text) > max_tokens * 4:  # Rough estimate: 4 chars per token
-            text = text[:max_tokens * 4]
-        
-        # Get embedding from OpenAI asynchronously
-        response = await openai_client.embeddings.create(
-            model=model,
-            input=text
-        )
-        
-        # Extract embedding from response
-        if not response or not response.data or not response.data[0].embedding:
-            logger.error("Invalid response format from OpenAI embeddings API")
-            return []
-            
-        return response.data[0].embedding
-        
-    except Exception as e:
-        logger.error(f"Error getting embedding: {e}", exc_info=True)
-        return []
-
-def cosine_similarity(vec1: list[float], vec2: list[float]) -> float:
-    """Calculate cosine similarity between two vectors."""
-    vec1 = np.array(vec1)
-    vec2 = np.array(vec2)
-    return np.dot(vec1, vec2) / (np.linalg.norm(vec1) * np.linalg.norm(vec2))
-
-async def get_embeddings_batch(texts: List[str], batch_size: int = 20) -> List[List[float]]:
-    """Get embeddings for a batch of texts in parallel."""
-    start_time = time.time()
-    logger.info(f"Starting batch embedding generation for {len(texts)} chunks")
-    
-    # Process in batches to avoid rate limits
-    all_embeddings = []
-    for i in range(0, len(texts), batch_size):
-        batch = texts[i:i+batch_size]
-        # Create and run tasks for each text in the batch
-        tasks = [get_embedding(text) for text in batch]
-        # Run all tasks concurrently with error handling
-        batch_embeddings = await asyncio.gather(*tasks, return_exceptions=True)
-        # Filter out any failed embeddings
-        valid_embeddings = [e for e in batch_embeddings if isinstance(e, list) and len(e) > 0]
-        all_embeddings.extend(valid_embeddings)
-        
-        logger.info(f"Processed batch {i//batch_size + 1}/{(len(texts) + batch_size - 1)//batch_size}")
-    
-    total_time = time.time() - start_time
-    logger.info(f"Generated {len(all_embeddings)} embeddings in {total_time:.2f} seconds")
-    
-    return all_embeddings
-
-async def get_embeddings_batch_parallel(texts: List[str], max_workers: int = 10) -> List[List[float]]:
-    """Generate embeddings for multiple text chunks in parallel with optimized performance."""
-    if not texts:
-        return []
-    
-    logger.info(f"Generating embeddings for {len(texts)} chunks in parallel (max_workers={max_workers})")
-    start_time = time.time()
-    
-    # Create a client with optimized settings for parallel requests
-    client = AsyncOpenAI(
-        api_key=os.getenv("OPENAI_API_KEY"),
-        max_retries=1,
-        timeout=10.0
-    )
-    
-    # Create tasks for parallel processing
-    tasks = []
-    for i, text in enumerate(texts):
-        if not text or not text.strip():
-            tasks.append(None)
-            continue
-        
-        # Create task for this chunk
-        task = asyncio.create_task(
-            get_single_embedding_ultra_fast(text, client, i)
-        )
-        tasks.append(task)
-    
-    # Process in batches to avoid overwhelming the API
-    results = []
-    batch_size = max_workers
-    
-    for i in range(0, len(tasks), batch_size):
-        batch = tasks[i:i+batch_size]
-        batch = [t for t in batch if t is not None]
-        
-        if not batch:
-            continue
-        
-        try:
-            # Wait for this batch with timeout
-            batch_results = await asyncio.gather(*batch, return_exceptions=True)
-            
-            # Process results
-            for result in batch_results:
-                if isinstance(result, Exception):
-                    logger.warning(f"Error in parallel embedding: {result}")
-                    results.append(None)
-                else:
-                    results.append(result)
-                    
-        except Exception as e:
-            logger.error(f"Batch embedding error: {e}", exc_info=True)
-            # Add None for each failed embedding in this batch
-            results.extend([None] * len(batch))
-    
-    # Fill in any missing results (from skipped empty texts)
-    final_results = []
-    result_index = 0
-    
-    for task in tasks:
-        if task is None:
-            final_results.append(None)
-        else:
-            if result_index < len(results):
-                final_results.append(results[result_index])
-                result_index += 1
-            else:
-                final_results.append(None)
-    
-    elapsed = time.time() - start_time
-    success_count = sum(1 for r in final_results if r is not None)
-    logger.info(f"Generated {success_count}/{len(texts)} embeddings in {elapsed:.2f} seconds")
-    
-    return final_results
-
-async def get_single_embedding_ultra_fast(text: str, client: AsyncOpenAI, chunk_id: int = 0) -> List[float]:
-    """Get a single embedding with optimized performance and error handling."""
-    try:
-        # Skip empty text
-        if not text or not text.strip():
-            logger.warning(f"Empty text provided for chunk {chunk_id}")
+# OpenAI embeddings API limits
+EMBEDDING_MAX_INPUT_TOKENS = 8191   # Per input text
+EMBEDDING_MAX_INPUTS = 2048         # Inputs per request
+EMBEDDING_MAX_INPUT_CHARS = EMBEDDING_MAX_INPUT_TOKENS * 8  # Cap before tokenizing
+
+class OpenAIEmbeddingBackend(EmbeddingBackend):
+    """OpenAI embeddings API: token-packed multi-input requests through the shared rate limiter."""
+
+    def handles(self, model: str) -> bool:
+        return model.startswith("text-embedding")
+
+    def request_dimensions(self, model: str, dimensions: Optional[int]) -> Optional[int]:
+        # Only the text-embedding-3 models can shorten their vectors
+        if not dimensions:
             return None
-        
-        # Truncate text if it's too long (OpenAI has token limits)
-        max_tokens = 8000  # Adjust based on model limits
-        if len(text) > max_tokens * 4:  # Rough estimate: 4 chars per token
-            text = text[:max_tokens * 4]
-            logger.info(f"Truncated chunk {chunk_id} to {len(text)} chars")
-        
-        # Get embedding with optimized client
-        response = await client.embeddings.create(
-            model="text-embedding-3-small",  # Using the smaller, faster model
-            input=text
-        )
-        
-        # Extract embedding from response
-        if not response or not response.data or not response.data[0].embedding:
-            logger.error(f"Invalid response format from OpenAI embeddings API for chunk {chunk_id}")
+        if not model.startswith("text-embedding-3"):
+            logger.warning(f"{model} does not support reduced dimensions; using its default size")
             return None
-            
-        return response.data[0].embedding
-        
-    except Exception as e:
-        logger.error(f"Error getting embedding for chunk {chunk_id}: {str(e)}")
-        return None
\ No newline at end of file
+        return dimensions
+
+    async def embed(self, texts: Sequence[str], model: str, dimensions: Optional[int],
+                    max_request_tokens: int = EMBEDDING_REQUEST_MAX_TOKENS,
+                    concurrency: int = EMBEDDING_REQUEST_CONCURRENCY,
+                    token_counts: Optional[Sequence[int]] = None) -> List[Optional[List[float]]]:
+        """
+        Texts are measured with tiktoken, truncated to the per-input limit and packed into
+        multi-input requests below `max_request_tokens`; up to `concurrency` requests run at once.
+        `token_counts` (e.g. from the chunker) are used instead of encoding texts within the limit.
+        """
+        results: List[Optional[List[float]]] = [None] * len(texts)
+        encoder = embedding_tokenizer(model)
+        known_counts = token_counts
+        inputs: List[str] = []
+        positions: List[int] = []
+        token_counts: List[int] = []
+        for i, text in enumerate(texts):
+            if not text or not text.strip():
+                continue
+            inputs.append(text)
+            positions.append(i)
+            if known_counts is not None and known_counts[i] <= EMBEDDING_MAX_INPUT_TOKENS:
+                token_counts.append(known_counts[i])
+                continue
+            tokens = encoder.encode(text, disallowed_special=())
+            if len(tokens) > EMBEDDING_MAX_INPUT_TOKENS:
+                tokens = tokens[:EMBEDDING_MAX_INPUT_TOKENS]
+                inputs[-1] = encoder.decode(tokens)
+                logger.info(f"Truncated input {i} to {EMBEDDING_MAX_INPUT_TOKENS} tokens")
+            token_counts.append(len(tokens))
+
+        batches = pack_by_tokens(token_counts, max_request_tokens)
+        if not batches:
+            return results
+
+        semaphore = asyncio.Semaphore(max(1, concurrency))
+        limiter = get_rate_limiter("openai", model)
+        extra = {"dimensions": dimensions} if dimensions else {}
+
+        async def embed_batch(batch: List[int]) -> None:
+            async with semaphore:
+                try:
+                    response = await limiter.call_openai(
+                        limited_client.embeddings.with_raw_response.create,
+                        tokens=sum(token_counts[j] for j in batch),
+                        model=model,
+                        input=[inputs[j] for j in batch],
+                        **extra
+                    )
+                except Exception as e:
+                    logger.error(f"Embedding request for {len(batch)} inputs failed: {e}")
+                    return
+                # item.index is the position of the input within this request
+                for item in response.data:
+                    results[positions[batch[item.index]]] = item.embedding
+
+        await asyncio.gather(*(embed_batch(batch) for batch in batches))
+        return results
+
+
+register_embedding_backend(OpenAIEmbeddingBackend(), default=True)
+
+
+@functools.lru_cache(maxsize=None)
+def request_dimensions(model: str, dimensions: Optional[int]) -> Optional[int]:
+    """Vector size to ask the model's backend for (None = the model's own size)."""
+    return embedding_backend(model).request_dimensions(model, dimensions)
+
+# Version written on new chunk rows and expected by retrieval (see app.utils.embedding_codec)
+EMBEDDING_VERSION = embedding_version(EMBEDDING_MODEL, request_dimensions(EMBEDDING_MODEL, EMBEDDING_DIMENSIONS))
+
+@functools.lru_cache(maxsize=None)
+def embedding_tokenizer(model: str):
+    """tiktoken encoding used by an embedding model (cl100k_base for unknown models)."""
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def pack_by_tokens(token_counts: Sequence[int], max_tokens: int = EMBEDDING_REQUEST_MAX_TOKENS,
+                   max_inputs: int = EMBEDDING_MAX_INPUTS) -> List[List[int]]:
+    """Greedily group consecutive input positions into requests under the token and input limits."""
+    batches: List[List[int]] = []
+    current: List[int] = []
+    current_tokens = 0
+    for i, count in enumerate(token_counts):
+        if current and (current_tokens + count > max_tokens or len(current) >= max_inputs):
+            batches.append(current)
+            current, current_tokens = [], 0
+        current.append(i)
+        current_tokens += count
+    if current:
+        batches.append(current)
+    return batches
+
+
+def normalize_query_text(text: str) -> str:
+    """Canonical form of a prompt for cache lookups: NFKC, case-folded, single-spaced."""
+    return " ".join(unicodedata.normalize("NFKC", text).casefold().split())
+
+
+class QueryEmbeddingCache:
+    """
+    Bounded LRU cache of prompt embeddings with a time-to-live, keyed by
+    (model, dimensions, normalized prompt). Entries can also be written through to
+    MongoDB so that all workers and restarts share them; that collection expires
+    entries with a TTL index.
+    """
+
+    def __init__(self, max_entries: int = QUERY_EMBEDDING_CACHE_SIZE, ttl_seconds: int = QUERY_EMBEDDING_CACHE_TTL,
+                 persist: bool = QUERY_EMBEDDING_CACHE_PERSIST):
+        self.max_entries = max(0, max_entries)
+        self.ttl_seconds = ttl_seconds
+        self.persist = persist
+        self._entries: "OrderedDict[Tuple[str, int, str], Tuple[float, List[float]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.persistent_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(text: str, model: str, dimensions: Optional[int]) -> Tuple[str, int, str]:
+        return (model, dimensions or 0, normalize_query_text(text))
+
+    @staticmethod
+    def _persistent_id(key: Tuple[str, int, str]) -> str:
+        return hashlib.sha256("\x00".join(map(str, key)).encode("utf-8")).hexdigest()
+
+    def _get_local(self, key) -> Optional[List[float]]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stored_at, embedding = entry
+            if time.monotonic() - stored_at > self.ttl_seconds:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return embedding
+
+    def _put_local(self, key, embedding: List[float]) -> None:
+        if not self.max_entries:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic(), embedding)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    async def get(self, key) -> Optional[List[float]]:
+        embedding = self._get_local(key)
+        if embedding is not None:
+            self.hits += 1
+            return embedding
+
+        if self.persist:
+            try:
+                row = await query_embedding_cache_collection.find_one({"_id": self._persistent_id(key)})
+                if row and (datetime.utcnow() - row["created_at"]).total_seconds() <= self.ttl_seconds:
+                    embedding = np.frombuffer(row["embedding"], dtype="<f4").tolist()
+                    self._put_local(key, embedding)
+                    self.persistent_hits += 1
+                    return embedding
+            except Exception as e:
+                logger.warning(f"Query embedding cache lookup failed: {e}")
+
+        self.misses += 1
+        return None
+
+    async def put(self, key, embedding: List[float]) -> None:
+        self._put_local(key, embedding)
+        if self.persist:
+            try:
+                await query_embedding_cache_collection.replace_one(
+                    {"_id": self._persistent_id(key)},
+                    {
+                        "model": key[0],
+                        "dimensions": key[1],
+                        "embedding": np.asarray(embedding, dtype="<f4").tobytes(),
+                        "created_at": datetime.utcnow(),
+                    },
+                    upsert=True
+                )
+            except Exception as e:
+                logger.warning(f"Query embedding cache write failed: {e}")
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            entries = len(self._entries)
+        total = self.hits + self.persistent_hits + self.misses
+        return {
+            "entries": entries,
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "persistent_hits": self.persistent_hits,
+            "misses": self.misses,
+            "hit_rate": ((self.hits + self.persistent_hits) / total) if total else 0.0,
+        }
+
+
+query_embedding_cache = QueryEmbeddingCache()
+
+
+class EmbeddingError(RuntimeError):
+    """Raised when texts could not be embedded."""
+
+
+def clean_embedding_text(text: Optional[str]) -> str:
+    """The exact text that is embedded and cache-keyed: NUL-free, single-spaced, capped in length."""
+    if not text:
+        return ""
+    text = " ".join(text.replace("\x00", " ").split())
+    # Backends truncate by tokens; this only avoids tokenizing pathological inputs
+    return text[:EMBEDDING_MAX_INPUT_CHARS]
+
+
+class EmbeddingService:
+    """
+    The one way to embed text in the app.
+
+    `embed(texts)` returns a float32 matrix whose rows follow the input order. Texts are
+    cleaned the same way everywhere, served from the content-addressed embedding cache
+    when possible, and the rest are sent in batches to the model's backend through the
+    pooled, rate-limited client (or computed in-process for local models). Empty texts
+    get zero rows; if any other text cannot be embedded, EmbeddingError is raised rather
+    than returning a partial result. `embed_query` adds the prompt cache.
+    """
+
+    _by_version: Dict[str, "EmbeddingService"] = {}
+
+    def __init__(self, model: str = EMBEDDING_MODEL, dimensions: Optional[int] = EMBEDDING_DIMENSIONS,
+                 concurrency: int = EMBEDDING_REQUEST_CONCURRENCY,
+                 max_request_tokens: int = EMBEDDING_REQUEST_MAX_TOKENS, cache: bool = True):
+        self.model = model
+        self.dimensions = request_dimensions(model, dimensions)
+        self.version = embedding_version(model, self.dimensions)
+        self.backend = embedding_backend(model)
+        self.concurrency = concurrency
+        self.max_request_tokens = max_request_tokens
+        self.cache = cache and self.backend.remote
+
+    @classmethod
+    def for_version(cls, version: Optional[str]) -> "EmbeddingService":
+        """Service producing vectors of `version` (the default service for None or EMBEDDING_VERSION)."""
+        if not version or version == EMBEDDING_VERSION:
+            return embedding_service
+        if version not in cls._by_version:
+            model, dimensions = parse_embedding_version(version)
+            cls._by_version[version] = cls(model, dimensions)
+        return cls._by_version[version]
+
+    async def embed(self, texts: Sequence[str],
+                    lookup: Optional[Callable[[List[str]], Awaitable[Dict[int, np.ndarray]]]] = None,
+                    token_counts: Optional[Sequence[int]] = None) -> np.ndarray:
+        """
+        Embeddings of `texts` as a (len(texts), dim) float32 matrix in input order. `lookup`,
+        when given, is asked for stored embeddings of the texts the cache missed (keyed by
+        position in the list it gets) before they are sent to the backend. `token_counts`
+        of the texts in this model's tokenizer spare the backend from encoding them again.
+        """
+        start_time = time.time()
+        cleaned = [clean_embedding_text(text) for text in texts]
+        results: List[Optional[List[float]]] = [None] * len(cleaned)
+        keys = [embedding_cache_key(text, self.model, self.dimensions) if text else None for text in cleaned]
+
+        cached = await embedding_cache.get_many(k for k in keys if k) if self.cache else {}
+        pending = []
+        for i, key in enumerate(keys):
+            if key in cached:
+                results[i] = cached[key]
+            elif key is not None:
+                pending.append(i)
+
+        if pending and lookup is not None:
+            recovered = await lookup([texts[i] for i in pending])
+            restored: Dict[str, List[float]] = {}
+            for j, i in enumerate(pending):
+                if recovered.get(j) is not None:
+                    results[i] = restored[keys[i]] = recovered[j].tolist()
+            pending = [i for i in pending if results[i] is None]
+            if self.cache and restored:
+                await embedding_cache.put_many(restored, self.model, self.dimensions)
+
+        if pending:
+            extra = {"token_counts": [token_counts[i] for i in pending]} if token_counts is not None else {}
+            fresh_results = await self.backend.embed(
+                [cleaned[i] for i in pending], self.model, self.dimensions,
+                max_request_tokens=self.max_request_tokens, concurrency=self.concurrency, **extra
+            )
+            fresh: Dict[str, List[float]] = {}
+            for i, embedding in zip(pending, fresh_results):
+                if embedding:
+                    results[i] = embedding
+                    fresh[keys[i]] = embedding
+            if self.cache:
+                await embedding_cache.put_many(fresh, self.model, self.dimensions)
+            failed = sum(1 for i in pending if results[i] is None)
+            if failed:
+                raise EmbeddingError(f"{failed} of {len(texts)} texts could not be embedded with {self.version}")
+            if self.backend.remote:
+                logger.info(f"Generated {len(pending)}/{len(texts)} embeddings ({len(cached)} cached) "
+                            f"with {self.version} in {time.time() - start_time:.2f} seconds")
+
+        dim = next((len(r) for r in results if r is not None), self.dimensions or 0)
+        matrix = np.zeros((len(results), dim), dtype=np.float32)
+        for i, embedding in enumerate(results):
+            if embedding is not None:
+                matrix[i] = embedding
+        return matrix
+
+    async def embed_one(self, text: str) -> np.ndarray:
+        return (await self.embed([text]))[0]
+
+    async def embed_query(self, text: str) -> np.ndarray:
+        """
+        Embedding of a user prompt, served from the query embedding cache when the same
+        question (ignoring case and spacing) was embedded recently with the same model.
+        Prompts are kept out of the chunk embedding cache.
+        """
+        if not text or not text.strip():
+            raise EmbeddingError("Empty prompt")
+        key = query_embedding_cache.make_key(text, self.model, self.dimensions)
+        embedding = await query_embedding_cache.get(key)
+        if embedding is not None:
+            return np.asarray(embedding, dtype=np.float32)
+
+        cleaned = clean_embedding_text(text)
+        embedding = (await self.backend.embed([cleaned], self.model, self.dimensions))[0]
+        if not embedding:
+            raise EmbeddingError(f"Prompt could not be embedded with {self.version}")
+        await query_embedding_cache.put(key, embedding)
+        return np.asarray(embedding, dtype=np.float32)
+
+
+embedding_service = EmbeddingService()
@@ -0,0 +1,91 @@
+from typing import Iterable
+
+import numpy as np
+
+# Query topics whose chunks are lifted to at least 0.9 similarity when both mention them
+POLICY_TERMS = {
+    'working hours': ['timing', 'work schedule', 'office hours', '9:30', '6:30'],
+    'leave': ['vacation', 'time off', 'day off', 'holiday', 'casual', 'sick', 'maternity', 'paternity'],
+    'remote work': ['wfh', 'work from home', 'remote', 'hybrid', 'work location']
+}
+
+# Flat boosts for the first content type the query mentions
+CONTENT_BOOSTS = [
+    (['ceo', 'chief executive', 'founder', 'leadership'], 0.3),
+    (['company', 'about', 'overview', 'nova', 'tech'], 0.2),
+    (['product', 'service', 'solution', 'offering'], 0.2),
+    (['policy', 'guideline', 'rule', 'process'], 0.2),
+    (['value', 'mission', 'vision', 'principle'], 0.2),
+    (['event', 'meeting', 'conference', 'holiday'], 0.2),
+    (['benefit', 'perk', 'compensation', 'salary'], 0.2)
+]
+
+# Chunks always offered as extra context for general company questions
+COMPANY_INFO_TERMS = [
+    'ceo', 'company overview', 'about us', 'company name', 'products', 'services',
+    'core values', 'values', 'mission', 'vision', 'code of conduct', 'policies',
+    'annual events', 'calendar', 'holidays', 'leave policy', 'remote work', 'benefits'
+]
+
+HEADER_BOOST = 0.2
+SHORT_ANSWER_BOOST = 0.15
+
+# Feature bits of a chunk, one uint16 per chunk
+BLANK = 1 << 0          # whitespace only
+HEADER = 1 << 1         # contains a markdown section header
+SHORT_ANSWER = 1 << 2   # under 300 characters and not itself a question
+COMPANY_INFO = 1 << 3   # mentions one of COMPANY_INFO_TERMS
+POLICY_BIT = 4          # bit POLICY_BIT + i: mentions policy group i of POLICY_TERMS
+
+
+def _policy_groups():
+    return [[policy] + terms for policy, terms in POLICY_TERMS.items()]
+
+
+def chunk_features(texts: Iterable[str]) -> np.ndarray:
+    """Compute the feature bits of every chunk once, at knowledge-base indexing time."""
+    groups = _policy_groups()
+    features = []
+    for text in texts:
+        lower = text.lower()
+        bits = 0
+        if not text.strip():
+            bits |= BLANK
+        if '##' in lower:
+            bits |= HEADER
+        if len(text) < 300 and '?' not in text:
+            bits |= SHORT_ANSWER
+        if any(term in lower for term in COMPANY_INFO_TERMS):
+            bits |= COMPANY_INFO
+        for i, terms in enumerate(groups):
+            if any(term in lower for term in terms):
+                bits |= 1 << (POLICY_BIT + i)
+        features.append(bits)
+    return np.asarray(features, dtype=np.uint16)
+
+
+def boost_scores(prompt: str, similarity: np.ndarray, lexical: np.ndarray, features: np.ndarray) -> np.ndarray:
+    """
+    FAQ relevance of candidate chunks: vector similarity lifted by policy matches, plus the
+    lexical, content-type and structure boosts, clipped to [0.1, 1.0]. All arrays are
+    aligned with the candidates; `lexical` is the already-weighted BM25 boost.
+    """
+    prompt_lower = prompt.lower()
+    scores = np.asarray(similarity, dtype=np.float32).copy()
+
+    policy_mask = 0
+    for i, terms in enumerate(_policy_groups()):
+        if any(term in prompt_lower for term in terms):
+            policy_mask |= 1 << (POLICY_BIT + i)
+    if policy_mask:
+        scores = np.where(features & policy_mask, np.maximum(scores, 0.9), scores)
+
+    scores += lexical
+    for terms, boost in CONTENT_BOOSTS:
+        if any(term in prompt_lower for term in terms):
+            scores += boost
+            break
+
+    scores += np.where(features & HEADER, HEADER_BOOST, 0.0).astype(np.float32)
+    scores += np.where(features & SHORT_ANSWER, SHORT_ANSWER_BOOST, 0.0).astype(np.float32)
+    return np.clip(scores, 0.1, 1.0)
@@ -5,10 +5,11 @@ from app.logger import logger
 import os
 from dotenv import load_dotenv
 import json
+from app.utils.rate_limiter import get_rate_limiter, estimate_tokens
 
 # Load from the specific path
 load_dotenv()
-client = OpenAI()
+client = OpenAI(max_retries=0)  # 429 retries are handled by the shared rate limiter
 model = "gpt-3.5-turbo"
 
 def check_security(user_input: str) -> SecurityCheck:
@@ -26,13 +27,16 @@ def check_security(user_input: str) -> SecurityCheck:
     { "is_safe": true/false, "reason": "..." }
     """
     
-    completion = client.chat.completions.create(
-        model=model,
-        messages=[
-            { "role": "system", "content": system_prompt },
-            { "role": "user", "content": user_input },
-        ],
-        response_format={"type": "json_object"}
+    completion = get_rate_limiter("openai", model).call_sync(
+        lambda: client.chat.completions.create(
+            model=model,
+            messages=[
+                { "role": "system", "content": system_prompt },
+                { "role": "user", "content": user_input },
+            ],
+            response_format={"type": "json_object"}
+        ),
+        tokens=estimate_tokens(system_prompt, user_input) + 100
     )
 
     response_text = completion.choices[0].message.content
@@ -47,20 +51,24 @@ def check_security(user_input: str) -> SecurityCheck:
 
 def classify_task_category(prompt, task, files) -> TaskCategoryResponseFormat:
     """Classify the user prompt into a task category"""
-    completion = client.chat.completions.create(
-        model=model,
-        messages=[
-            {
-                "role": "system",
-                "content": (
-                    "Classify user prompt into one of: general conversation, summarization, comparison, data analysis, file Q&A."
-                    " Use context: task and files if needed."
-                    " Respond JSON: { 'task': ..., 'confidence_score': ... }"
-                )
-            },
-            { "role": "user", "content": f"Prompt: {prompt}\nTask hint: {task}\nFiles: {files}" }
-        ],
-        response_format={"type": "json_object"}
+    user_content = f"Prompt: {prompt}\nTask hint: {task}\nFiles: {files}"
+    completion = get_rate_limiter("openai", model).call_sync(
+        lambda: client.chat.completions.create(
+            model=model,
+            messages=[
+                {
+                    "role": "system",
+                    "content": (
+                        "Classify user prompt into one of: general conversation, summarization, comparison, data analysis, file Q&A."
+                        " Use context: task and files if needed."
+                        " Respond JSON: { 'task': ..., 'confidence_score': ... }"
+                    )
+                },
+                { "role": "user", "content": user_content }
+            ],
+            response_format={"type": "json_object"}
+        ),
+        tokens=estimate_tokens(user_content) + 150
     )
 
     response_text = completion.choices[0].message.content
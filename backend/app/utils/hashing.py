@@ -0,0 +1,6 @@
+import hashlib
+
+
+def chunk_content_hash(text: str) -> str:
+    """Content hash stored with each chunk row (`chunk_hash`) and used to key per-chunk caches."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
@@ -0,0 +1,328 @@
+from contextlib import asynccontextmanager
+import asyncio
+import logging
+import random
+import re
+import threading
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Mapping, Optional, Tuple
+
+from app.config import (
+    OPENAI_RPM, OPENAI_TPM, GEMINI_RPM, GEMINI_TPM, RATE_LIMIT_MAX_CONCURRENCY, RATE_LIMIT_MAX_RETRIES
+)
+
+logger = logging.getLogger(__name__)
+
+# Provider defaults: (requests per minute, tokens per minute)
+PROVIDER_LIMITS = {
+    "openai": (OPENAI_RPM, OPENAI_TPM),
+    "gemini": (GEMINI_RPM, GEMINI_TPM),
+}
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+def parse_duration(value: Optional[str]) -> Optional[float]:
+    """Seconds in a rate-limit header value such as '1s', '6m0s', '20ms' or a bare number."""
+    if not value:
+        return None
+    value = str(value).strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        return None
+    return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in parts)
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """True for HTTP 429 / quota errors from the OpenAI or Google client libraries."""
+    status = getattr(error, "status_code", None) or getattr(error, "code", None)
+    if status == 429:
+        return True
+    return type(error).__name__ in ("RateLimitError", "ResourceExhausted", "TooManyRequests")
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    """Server-requested delay of a 429 response, when it sent one."""
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    if headers.get("retry-after-ms"):
+        return parse_duration(f"{headers.get('retry-after-ms')}ms")
+    return parse_duration(headers.get("retry-after"))
+
+
+class TokenBucket:
+    """Refills `capacity` units per minute; callers take units and are told how long to wait when short."""
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.capacity / 60.0)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """Seconds until `amount` units are available (0 when they are available now)."""
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) * 60.0 / self.capacity
+
+    def take(self, amount: float) -> None:
+        self.tokens -= min(amount, self.capacity)
+
+    def refund(self, amount: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+    def observe(self, limit: Optional[float], remaining: Optional[float], now: float) -> None:
+        """Align the bucket with the limit and remaining budget the provider reported."""
+        if limit:
+            self.capacity = float(limit)
+        if remaining is not None:
+            self._refill(now)
+            self.tokens = min(self.tokens, float(remaining))
+
+
+class AdaptiveRateLimiter:
+    """
+    Process-wide limiter for one provider and model.
+
+    Every call waits for a concurrency slot and for room in both the requests/min and
+    tokens/min buckets. Concurrency adapts AIMD-style: it grows by about one slot per
+    window of successful calls and halves on a 429, at most once per backoff window (a
+    burst of in-flight calls hitting the same limit is one decrease). A 429 also pauses
+    all callers for the Retry-After time (or an exponential backoff with jitter) before retrying.
+    Works from coroutines and from worker threads (`call_sync`).
+    """
+
+    def __init__(self, name: str, requests_per_minute: float, tokens_per_minute: float,
+                 max_concurrency: int = RATE_LIMIT_MAX_CONCURRENCY, min_concurrency: int = 1,
+                 max_retries: int = RATE_LIMIT_MAX_RETRIES):
+        self.name = name
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_concurrency = max(1, max_concurrency)
+        self.min_concurrency = max(1, min(min_concurrency, self.max_concurrency))
+        self.concurrency = float(self.max_concurrency) / 2 if self.max_concurrency > 1 else 1.0
+        self.max_retries = max_retries
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.throttled = 0
+
+    # --- slot accounting -------------------------------------------------
+
+    def _try_acquire(self, tokens: float) -> float:
+        """Take a slot and bucket room; return 0 on success or the seconds to wait."""
+        with self._lock:
+            now = time.monotonic()
+            if now < self.paused_until:
+                return self.paused_until - now
+            if self.in_flight >= int(self.concurrency):
+                return 0.05
+            wait = max(self.requests.wait_time(1, now), self.tokens.wait_time(tokens, now))
+            if wait > 0:
+                return wait
+            self.requests.take(1)
+            self.tokens.take(tokens)
+            self.in_flight += 1
+            return 0.0
+
+    def _release(self) -> None:
+        with self._lock:
+            self.in_flight -= 1
+
+    async def acquire(self, tokens: float = 0) -> None:
+        while True:
+            wait = self._try_acquire(tokens)
+            if wait <= 0:
+                return
+            await asyncio.sleep(min(wait, 5.0))
+
+    def acquire_sync(self, tokens: float = 0) -> None:
+        while True:
+            wait = self._try_acquire(tokens)
+            if wait <= 0:
+                return
+            time.sleep(min(wait, 5.0))
+
+    # --- feedback ------------------------------------------------------------
+
+    def on_success(self) -> None:
+        with self._lock:
+            self.calls += 1
+            self.concurrency = min(self.max_concurrency, self.concurrency + 1.0 / max(self.concurrency, 1.0))
+
+    def on_rate_limited(self, attempt: int, retry_after: Optional[float]) -> float:
+        """Halve concurrency (unless already backing off), pause every caller and return the backoff delay."""
+        delay = retry_after if retry_after else min(60.0, 2 ** attempt)
+        delay *= 1 + random.uniform(0, 0.25)
+        with self._lock:
+            self.throttled += 1
+            now = time.monotonic()
+            # 429s of calls that were in flight before the pause belong to the same decrease
+            if now >= self.paused_until:
+                self.concurrency = max(self.min_concurrency, self.concurrency / 2)
+            self.paused_until = max(self.paused_until, now + delay)
+        logger.warning(f"Rate limited by {self.name}; backing off {delay:.1f}s (concurrency now {int(self.concurrency)})")
+        return delay
+
+    def observe_headers(self, headers: Optional[Mapping[str, str]]) -> None:
+        """Update the buckets from x-ratelimit-* response headers (OpenAI format)."""
+        if not headers:
+            return
+
+        def number(name: str) -> Optional[float]:
+            try:
+                return float(headers.get(name)) if headers.get(name) is not None else None
+            except (TypeError, ValueError):
+                return None
+
+        with self._lock:
+            now = time.monotonic()
+            self.requests.observe(number("x-ratelimit-limit-requests"), number("x-ratelimit-remaining-requests"), now)
+            self.tokens.observe(number("x-ratelimit-limit-tokens"), number("x-ratelimit-remaining-tokens"), now)
+
+    # --- call wrappers -----------------------------------------------------------
+
+    async def _start(self, fn: Callable[[], Awaitable[Any]], tokens: float) -> Any:
+        """`await fn()` under a slot, retrying 429 responses with backoff; the slot is still held on return."""
+        for attempt in range(self.max_retries + 1):
+            await self.acquire(tokens)
+            started = False
+            try:
+                result = await fn()
+                started = True
+                return result
+            except Exception as e:
+                if not is_rate_limit_error(e) or attempt == self.max_retries:
+                    raise
+                retry_after = _retry_after(e)
+            finally:
+                # Also on cancellation, which is not an Exception
+                if not started:
+                    self._release()
+            await asyncio.sleep(self.on_rate_limited(attempt, retry_after))
+
+    def _settle(self, reserved: float, used: Optional[float]) -> None:
+        """Refund the unused part of a token reservation, or charge what a call used beyond it."""
+        if used is None:
+            return
+        with self._lock:
+            if used < reserved:
+                self.tokens.refund(reserved - used)
+            elif used > reserved:
+                self.tokens.take(used - reserved)
+
+    async def call(self, fn: Callable[[], Awaitable[Any]], tokens: float = 0) -> Any:
+        """Run `await fn()` under the limiter, retrying 429 responses with backoff."""
+        result = await self._start(fn, tokens)
+        self._release()
+        self.on_success()
+        return result
+
+    @asynccontextmanager
+    async def stream(self, fn: Callable[[], Awaitable[Any]], tokens: float = 0) -> AsyncIterator[AsyncIterator[Any]]:
+        """
+        Open a streaming request (`await fn()` returning an async iterator of chunks) under the
+        limiter. The slot is held until the block exits, so long streamed answers count against
+        concurrency, and the token reservation is settled with the usage the stream reports
+        (OpenAI sends it in the last chunk when asked with stream_options={"include_usage": True}).
+        """
+        stream = await self._start(fn, tokens)
+        usage: Dict[str, float] = {}
+
+        async def chunks():
+            async for chunk in stream:
+                used = getattr(getattr(chunk, "usage", None), "total_tokens", None)
+                if used is not None:
+                    usage["total"] = used
+                yield chunk
+
+        completed = False
+        try:
+            yield chunks()
+            completed = True
+        finally:
+            self._release()
+            if completed:
+                self.on_success()
+            self._settle(tokens, usage.get("total"))
+
+    def call_sync(self, fn: Callable[[], Any], tokens: float = 0) -> Any:
+        """Blocking variant of `call` for synchronous clients and worker threads."""
+        for attempt in range(self.max_retries + 1):
+            self.acquire_sync(tokens)
+            try:
+                result = fn()
+            except Exception as e:
+                if not is_rate_limit_error(e) or attempt == self.max_retries:
+                    raise
+                retry_after = _retry_after(e)
+            else:
+                self.on_success()
+                return result
+            finally:
+                self._release()
+            time.sleep(self.on_rate_limited(attempt, retry_after))
+
+    async def call_openai(self, create: Callable[..., Awaitable[Any]], tokens: float = 0, **kwargs) -> Any:
+        """
+        Call an OpenAI `with_raw_response` create method under the limiter, feed its
+        rate-limit headers back into the buckets and return the parsed response.
+        """
+        async def request():
+            raw = await create(**kwargs)
+            self.observe_headers(raw.headers)
+            return raw.parse()
+
+        response = await self.call(request, tokens)
+        # Settle the reservation with what the request actually used
+        self._settle(tokens, getattr(getattr(response, "usage", None), "total_tokens", None))
+        return response
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "concurrency": int(self.concurrency),
+                "in_flight": self.in_flight,
+                "calls": self.calls,
+                "throttled": self.throttled,
+                "requests_per_minute": self.requests.capacity,
+                "tokens_per_minute": self.tokens.capacity,
+            }
+
+
+_limiters: Dict[Tuple[str, str], AdaptiveRateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(provider: str, model: str) -> AdaptiveRateLimiter:
+    """The shared limiter of a provider ('openai' or 'gemini') and model, created on first use."""
+    key = (provider, model)
+    with _limiters_lock:
+        limiter = _limiters.get(key)
+        if limiter is None:
+            rpm, tpm = PROVIDER_LIMITS[provider]
+            limiter = _limiters[key] = AdaptiveRateLimiter(f"{provider}:{model}", rpm, tpm)
+        return limiter
+
+
+def rate_limiter_stats() -> Dict[str, Dict[str, Any]]:
+    with _limiters_lock:
+        limiters = list(_limiters.values())
+    return {limiter.name: limiter.stats() for limiter in limiters}
+
+
+def estimate_tokens(*texts: str) -> int:
+    """Cheap token estimate (about 4 characters per token) used to reserve bucket room."""
+    return sum(len(t or "") for t in texts) // 4 + 1
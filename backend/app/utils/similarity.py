@@ -0,0 +1,76 @@
+import numpy as np
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+
+def normalize_vector(vector: Sequence[float]) -> np.ndarray:
+    """Return a unit-length float32 copy of a vector (zero vectors stay zero)."""
+    vec = np.asarray(vector, dtype=np.float32).ravel()
+    norm = float(np.linalg.norm(vec))
+    if norm == 0.0:
+        return vec
+    return vec / norm
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    """Normalize every row of a 2-D float32 matrix in place and return it."""
+    if matrix.size == 0:
+        return matrix
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    matrix /= norms
+    return matrix
+
+
+def stack_embeddings(vectors: Iterable[Sequence[float]], dim: Optional[int] = None) -> np.ndarray:
+    """
+    Stack embedding vectors into one pre-normalized float32 matrix.
+    Vectors whose length differs from the first one (or from `dim`) are zero-filled
+    so that row indexes stay aligned with the caller's chunk list.
+    """
+    rows = [np.asarray(v, dtype=np.float32).ravel() for v in vectors]
+    if not rows:
+        return np.zeros((0, dim or 0), dtype=np.float32)
+
+    dim = dim or rows[0].shape[0]
+    matrix = np.zeros((len(rows), dim), dtype=np.float32)
+    for i, row in enumerate(rows):
+        if row.shape[0] == dim:
+            matrix[i] = row
+    return normalize_rows(matrix)
+
+
+def cosine_scores(query: Sequence[float], matrix: np.ndarray) -> np.ndarray:
+    """Cosine similarity of a query against every row of a pre-normalized matrix."""
+    if matrix.shape[0] == 0:
+        return np.zeros(0, dtype=np.float32)
+    q = normalize_vector(query)
+    if q.shape[0] != matrix.shape[1]:
+        raise ValueError(f"Query dimension {q.shape[0]} does not match matrix dimension {matrix.shape[1]}")
+    return matrix @ q
+
+
+def top_k_indices(scores: np.ndarray, k: int, threshold: Optional[float] = None) -> np.ndarray:
+    """
+    Indexes of the k highest scores, best first, using argpartition instead of a full sort.
+    When a threshold is given, indexes scoring below it are dropped.
+    """
+    n = scores.shape[0]
+    if n == 0 or k <= 0:
+        return np.zeros(0, dtype=np.int64)
+
+    if k < n:
+        candidates = np.argpartition(-scores, k - 1)[:k]
+    else:
+        candidates = np.arange(n)
+
+    order = candidates[np.argsort(-scores[candidates], kind="stable")]
+    if threshold is not None:
+        order = order[scores[order] >= threshold]
+    return order
+
+
+def top_k_similar(query: Sequence[float], matrix: np.ndarray, k: int,
+                  threshold: Optional[float] = None) -> List[Tuple[int, float]]:
+    """Return (row_index, score) pairs for the k rows most similar to the query."""
+    scores = cosine_scores(query, matrix)
+    return [(int(i), float(scores[i])) for i in top_k_indices(scores, k, threshold)]
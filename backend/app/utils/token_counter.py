@@ -0,0 +1,209 @@
+# backend/app/utils/token_counter.py
+
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Optional, Sequence
+import asyncio
+import functools
+import logging
+import multiprocessing
+import threading
+
+import tiktoken
+
+from app.config import (
+    TOKEN_COUNT_MODEL, TOKEN_COUNT_WORKERS, TOKEN_COUNT_SHARD_CHARS,
+    TOKEN_COUNT_INLINE_CHARS, TOKEN_COUNT_CACHE_SIZE
+)
+from app.utils.hashing import chunk_content_hash
+
+logger = logging.getLogger(__name__)
+
+
+@functools.lru_cache(maxsize=None)
+def _encoding(model: str):
+    """tiktoken encoding of a chat model (o200k_base for unknown models); loaded once per process."""
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+
+def _count_texts(model: str, texts: List[str]) -> List[int]:
+    """Token counts of `texts`; runs in the pool's worker processes."""
+    encoding = _encoding(model)
+    return [len(encoding.encode(text, disallowed_special=())) if text else 0 for text in texts]
+
+
+def shard_text(text: str, shard_chars: int) -> List[str]:
+    """`text` cut into pieces of at most about `shard_chars` characters, at whitespace where there is any."""
+    shards = []
+    start = 0
+    while len(text) - start > shard_chars:
+        end = start + shard_chars
+        # Cut before a newline or space so no token straddles two shards
+        cut = max(text.rfind("\n", start + shard_chars // 2, end), text.rfind(" ", start + shard_chars // 2, end))
+        if cut > start:
+            end = cut
+        shards.append(text[start:end])
+        start = end
+    shards.append(text[start:])
+    return shards
+
+
+class TokenCounter:
+    """
+    Counts chat-model tokens without blocking the event loop.
+
+    Small texts are encoded inline. Anything larger goes to a process pool shared by the
+    whole process: a document is cut into shards at whitespace and the shards are encoded
+    in parallel, and chunk batches are grouped into shards of about the same size. Counts
+    of chunks and prompt parts are kept in an LRU keyed by content hash, so re-counting the
+    same chunk (re-embedding, prompt budgeting) costs a dictionary lookup. If the pool
+    cannot be started or breaks, counting falls back to a thread.
+    """
+
+    def __init__(self, model: str = TOKEN_COUNT_MODEL, workers: int = TOKEN_COUNT_WORKERS,
+                 shard_chars: int = TOKEN_COUNT_SHARD_CHARS, inline_chars: int = TOKEN_COUNT_INLINE_CHARS,
+                 cache_size: int = TOKEN_COUNT_CACHE_SIZE):
+        self.model = model
+        self.workers = max(0, workers)
+        self.shard_chars = max(1000, shard_chars)
+        self.inline_chars = inline_chars
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+        self._cache: "OrderedDict[str, int]" = OrderedDict()
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._pool_lock = threading.Lock()
+
+    def _get_pool(self) -> Optional[ProcessPoolExecutor]:
+        if self.workers == 0:
+            return None
+        with self._pool_lock:
+            if self._pool is None:
+                try:
+                    # spawn: workers must not inherit the API process's event loop, threads or sockets
+                    self._pool = ProcessPoolExecutor(max_workers=self.workers,
+                                                     mp_context=multiprocessing.get_context("spawn"))
+                    logger.info(f"Started token counting pool with {self.workers} processes")
+                except Exception as e:
+                    logger.warning(f"Token counting pool unavailable, counting in threads: {e}")
+                    self.workers = 0
+            return self._pool
+
+    def _reset_pool(self):
+        with self._pool_lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def shutdown(self):
+        """Stop the worker processes (a later count starts them again)."""
+        self._reset_pool()
+
+    async def _run_shards(self, shards: List[List[str]]) -> List[List[int]]:
+        """Counts of each shard (a list of texts), encoded in parallel."""
+        pool = self._get_pool()
+        if pool is not None:
+            loop = asyncio.get_running_loop()
+            try:
+                return await asyncio.gather(
+                    *(loop.run_in_executor(pool, _count_texts, self.model, shard) for shard in shards)
+                )
+            except BrokenProcessPool as e:
+                logger.warning(f"Token counting pool broke, retrying in a thread: {e}")
+                self._reset_pool()
+        return await asyncio.gather(*(asyncio.to_thread(_count_texts, self.model, shard) for shard in shards))
+
+    def count_local(self, text: str) -> int:
+        """Token count encoded on the calling thread; meant for short texts."""
+        if not text:
+            return 0
+        return _count_texts(self.model, [text])[0]
+
+    async def count(self, text: str) -> int:
+        """Token count of a whole document; long texts are sharded across the pool (not cached)."""
+        if not text:
+            return 0
+        if len(text) <= self.inline_chars:
+            return self.count_local(text)
+        shards = shard_text(text, self.shard_chars)
+        counts = await self._run_shards([[shard] for shard in shards])
+        return sum(c[0] for c in counts)
+
+    def _remember(self, key: str, count: int):
+        self._cache[key] = count
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def prime(self, texts: Sequence[str], counts: Sequence[int], encoding_name: str) -> None:
+        """
+        Cache counts already computed elsewhere (the chunker's), so count_many of the same
+        texts is a lookup. Ignored unless they come from this counter's tokenizer.
+        """
+        if encoding_name != _encoding(self.model).name:
+            return
+        for text, count in zip(texts, counts):
+            if text and len(text) <= self.shard_chars:
+                self._remember(chunk_content_hash(text), count)
+
+    async def count_many(self, texts: Sequence[str]) -> List[int]:
+        """Token counts of chunks in input order; cached counts are reused and the rest counted in shards."""
+        results: List[Optional[int]] = [None] * len(texts)
+        pending: "OrderedDict[str, List[int]]" = OrderedDict()
+        pending_texts = {}
+        for i, text in enumerate(texts):
+            if not text:
+                results[i] = 0
+                continue
+            if len(text) > self.shard_chars:
+                # Document-sized text: shard it rather than hash and cache it
+                results[i] = await self.count(text)
+                continue
+            key = chunk_content_hash(text)
+            count = self._cache.get(key)
+            if count is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                results[i] = count
+            else:
+                pending.setdefault(key, []).append(i)
+                pending_texts[key] = text
+
+        if pending:
+            self.misses += len(pending)
+            keys = list(pending)
+            total_chars = sum(len(pending_texts[k]) for k in keys)
+            if total_chars <= self.inline_chars:
+                counts = _count_texts(self.model, [pending_texts[k] for k in keys])
+            else:
+                # Group uncached texts into shards, one per worker up to shard_chars characters each
+                shard_size = min(self.shard_chars, max(self.inline_chars, total_chars // max(1, self.workers) + 1))
+                shards: List[List[str]] = [[]]
+                size = 0
+                for key in keys:
+                    if shards[-1] and size + len(pending_texts[key]) > shard_size:
+                        shards.append([])
+                        size = 0
+                    shards[-1].append(pending_texts[key])
+                    size += len(pending_texts[key])
+                counts = [c for shard_counts in await self._run_shards(shards) for c in shard_counts]
+            for key, count in zip(keys, counts):
+                self._remember(key, count)
+                for i in pending[key]:
+                    results[i] = count
+        return results
+
+    async def count_parts(self, parts: Sequence[str]) -> int:
+        """Token count of a prompt made of `parts` (system prompt, context, history...), reusing cached parts."""
+        return sum(await self.count_many(parts))
+
+    def stats(self) -> dict:
+        return {"model": self.model, "workers": self.workers, "cached": len(self._cache),
+                "hits": self.hits, "misses": self.misses}
+
+
+token_counter = TokenCounter()
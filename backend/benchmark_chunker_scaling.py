@@ -0,0 +1,118 @@
+import argparse
+import random
+import resource
+import time
+
+from dotenv import load_dotenv
+
+# Load environment variables from .env
+load_dotenv()
+
+from app.config import CHUNK_MAX_TOKENS, CHUNK_OVERLAP_TOKENS
+from app.utils.chunking import PAGE_SEPARATOR, TokenChunker
+from benchmark_chunking import legacy_text_to_chunks
+
+PAGE_CHARS = 4000
+PAGE_POOL = 64
+
+WORDS = (
+    "agreement party parties shall term notice payment services provider customer liability "
+    "confidential information obligations termination effective date governing law clause "
+    "invoice amount days written consent breach remedy warranty indemnify schedule annex"
+).split()
+
+
+def _sentence(rng: random.Random) -> str:
+    words = [rng.choice(WORDS) for _ in range(rng.randint(6, 20))]
+    return " ".join(words).capitalize() + "."
+
+
+def make_page(layout: str, rng: random.Random) -> str:
+    """About PAGE_CHARS characters of synthetic page text in one of the layouts."""
+    lines = []
+    size = 0
+    while size < PAGE_CHARS:
+        if layout == "paragraphs":
+            line = " ".join(_sentence(rng) for _ in range(rng.randint(2, 6))) + "\n"
+        elif layout == "ocr":
+            # Short lines and no blank lines, as OCR output comes
+            line = _sentence(rng)[:rng.randint(30, 80)]
+        elif layout == "numbered":
+            line = f"{rng.randint(1, 40)}. {_sentence(rng)}"
+        elif layout == "sparse":
+            # Form-like scans: a few words between long runs of blank lines and spaces
+            line = " ".join(rng.choice(WORDS) for _ in range(3)) + "\n \n" * rng.randint(20, 200)
+        else:  # "run": long lines without whitespace (encoded blobs, table rules)
+            line = "".join(rng.choice("abcdef0123456789=+/") for _ in range(rng.randint(500, 3000)))
+        lines.append(line)
+        size += len(line) + 1
+    return "\n".join(lines)
+
+
+def generate_pages(layout: str, total_bytes: int, seed: int):
+    """Page texts adding up to about total_bytes, generated lazily from a small pool."""
+    rng = random.Random(seed)
+    pool = [make_page(layout, rng) for _ in range(PAGE_POOL)]
+    pages = max(1, total_bytes // PAGE_CHARS)
+    for number in range(pages):
+        yield f"Page {number + 1}\n{pool[number % PAGE_POOL]}"
+
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_streaming(chunker: TokenChunker, layout: str, size_mb: float, seed: int) -> dict:
+    total_bytes = int(size_mb * 1024 * 1024)
+    chunks = 0
+    started = time.perf_counter()
+    for _, chunk in chunker.chunk_pages(generate_pages(layout, total_bytes, seed)):
+        chunks += 1
+    seconds = time.perf_counter() - started
+    return {"chunks": chunks, "seconds": seconds, "mb_per_s": size_mb / seconds if seconds else 0.0}
+
+
+def run_legacy(layout: str, size_mb: float, seed: int, timeout: float) -> dict:
+    text = PAGE_SEPARATOR.join(generate_pages(layout, int(size_mb * 1024 * 1024), seed))
+    started = time.perf_counter()
+    chunks = legacy_text_to_chunks(text)
+    seconds = time.perf_counter() - started
+    return {"chunks": len(chunks), "seconds": seconds, "mb_per_s": size_mb / seconds if seconds else 0.0,
+            "slow": seconds > timeout}
+
+
+def benchmark(args):
+    chunker = TokenChunker(args.max_tokens, args.overlap)
+    sizes = [float(s) for s in args.sizes_mb.split(",")]
+    layouts = args.layouts.split(",")
+    print(f"Token chunker at {chunker.max_tokens} tokens, {chunker.overlap_tokens} overlap; "
+          f"pages of about {PAGE_CHARS} characters, streamed")
+    print()
+    print(f"{'layout':<11} {'MB':>7} {'chunker':<8} {'chunks':>9} {'seconds':>9} {'MB/s':>7} {'s/MB':>7} {'peak RSS MB':>12}")
+    for layout in layouts:
+        legacy_too_slow = False
+        for size_mb in sizes:
+            row = run_streaming(chunker, layout, size_mb, args.seed)
+            print(f"{layout:<11} {size_mb:>7g} {'token':<8} {row['chunks']:>9} {row['seconds']:>9.2f} "
+                  f"{row['mb_per_s']:>7.2f} {row['seconds'] / size_mb:>7.3f} {peak_rss_mb():>12.0f}")
+            # The legacy chunker needs the whole text in memory and may be superlinear; stop once it gets slow
+            if size_mb <= args.legacy_max_mb and not legacy_too_slow:
+                row = run_legacy(layout, size_mb, args.seed, args.legacy_timeout)
+                legacy_too_slow = row["slow"]
+                print(f"{layout:<11} {size_mb:>7g} {'legacy':<8} {row['chunks']:>9} {row['seconds']:>9.2f} "
+                      f"{row['mb_per_s']:>7.2f} {row['seconds'] / size_mb:>7.3f} {peak_rss_mb():>12.0f}")
+    print("\nA linear chunker keeps s/MB flat as documents grow; peak RSS is the process high-water mark so far.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chunking time and memory on synthetic documents of growing size")
+    parser.add_argument("--sizes-mb", default="1,10,100,300", help="Comma-separated document sizes in MB")
+    parser.add_argument("--layouts", default="paragraphs,ocr,numbered,sparse,run",
+                        help="Comma-separated page layouts: paragraphs, ocr, numbered, sparse, run")
+    parser.add_argument("--max-tokens", type=int, default=CHUNK_MAX_TOKENS)
+    parser.add_argument("--overlap", type=int, default=CHUNK_OVERLAP_TOKENS)
+    parser.add_argument("--legacy-max-mb", type=float, default=10, help="Largest size also run through the legacy chunker")
+    parser.add_argument("--legacy-timeout", type=float, default=60, help="Skip larger legacy runs after one takes this long")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    benchmark(args)
@@ -0,0 +1,149 @@
+import argparse
+import asyncio
+import glob
+import os
+import random
+import re
+import time
+
+import fitz  # PyMuPDF
+import numpy as np
+from dotenv import load_dotenv
+
+# Load environment variables from .env
+load_dotenv()
+
+from app.config import CHUNK_MAX_TOKENS, CHUNK_OVERLAP_TOKENS, EMBEDDING_MODEL
+from app.utils.chunking import PAGE_SEPARATOR, TokenChunker
+from app.utils.embeddings import EmbeddingService, pack_by_tokens
+from app.utils.similarity import normalize_rows, top_k_indices
+
+
+def legacy_text_to_chunks(text: str) -> list:
+    """The chunker core.text_to_chunks used before the token-budgeted one (kept here for comparison)."""
+    if not text or not text.strip():
+        return []
+    text = text.replace('\r\n', '\n').replace('\r', '\n').strip()
+    section_regex = r'(\n|^)\s*(?:##\s*)?(?:\d{1,2}\.\s+.*?)(?=\n\s*(?:##\s*)?(?:\d{1,2}\.|\Z))'
+    sections = re.split(section_regex, text, flags=re.DOTALL)
+    if len(sections) > 1:
+        chunks = [s.strip() for s in sections if s.strip()]
+        chunks = [f"{chunks[i]} {chunks[i+1]}" for i in range(0, len(chunks)-1, 2)]
+        if len(chunks) >= 3:
+            return chunks
+    paragraphs = [p.strip() for p in text.split('\n\n') if p.strip()]
+    if len(paragraphs) > 1:
+        return paragraphs
+    lines = [line.strip() for line in text.split('\n') if line.strip()]
+    if lines:
+        return lines
+    sentences = [s.strip() for s in re.split(r'(?<=[.!?])\s+', text) if s.strip()]
+    return sentences or [text]
+
+
+def squash(text: str) -> str:
+    return " ".join(text.split())
+
+
+def load_documents(docs_dir: str) -> dict:
+    """Document text of every PDF in docs_dir, pages joined the way uploads store them."""
+    documents = {}
+    for path in sorted(glob.glob(os.path.join(docs_dir, "*.pdf"))):
+        with fitz.open(path) as doc:
+            documents[os.path.basename(path)] = PAGE_SEPARATOR.join(page.get_text() for page in doc)
+    return documents
+
+
+def make_queries(text: str, count: int, seed: int, words: int = 12) -> list:
+    """Known-item queries: runs of `words` consecutive words that occur once in the document."""
+    body = squash(text.replace(PAGE_SEPARATOR.strip(), " "))
+    tokens = body.split()
+    rng = random.Random(seed)
+    queries = []
+    for _ in range(count * 20):
+        if len(queries) >= count or len(tokens) <= words:
+            break
+        start = rng.randrange(len(tokens) - words)
+        query = " ".join(tokens[start:start + words])
+        if query not in queries and body.count(query) == 1:
+            queries.append(query)
+    return queries
+
+
+def relevant_chunks(query: str, chunks: list) -> set:
+    """Chunks holding the query; if it was split between chunks, those holding either half."""
+    found = {i for i, chunk in enumerate(chunks) if query in chunk}
+    if found:
+        return found
+    words = query.split()
+    halves = (" ".join(words[:len(words) // 2]), " ".join(words[len(words) // 2:]))
+    return {i for i, chunk in enumerate(chunks) if any(half in chunk for half in halves)}
+
+
+async def evaluate(name: str, chunks: list, queries: list, embedder: EmbeddingService,
+                   chunker: TokenChunker, k: int, seconds: float) -> dict:
+    token_counts = [chunker.count(chunk) for chunk in chunks]
+    corpus = normalize_rows(await embedder.embed(chunks))
+    query_matrix = normalize_rows(await embedder.embed(queries))
+    squashed = [squash(chunk) for chunk in chunks]
+    hits, reciprocal_ranks = 0, []
+    for query, vector in zip(queries, query_matrix):
+        relevant = relevant_chunks(query, squashed)
+        ranked = top_k_indices(corpus @ vector, k).tolist()
+        rank = next((r for r, i in enumerate(ranked, 1) if i in relevant), None)
+        hits += rank is not None
+        reciprocal_ranks.append(1.0 / rank if rank else 0.0)
+    return {
+        "name": name,
+        "chunks": len(chunks),
+        "tokens": sum(token_counts),
+        "mean_tokens": float(np.mean(token_counts)) if token_counts else 0.0,
+        "max_tokens": max(token_counts, default=0),
+        "requests": len(pack_by_tokens(token_counts)),
+        "hit": hits / len(queries) if queries else 0.0,
+        "mrr": float(np.mean(reciprocal_ranks)) if reciprocal_ranks else 0.0,
+        "chunk_ms": seconds * 1000,
+    }
+
+
+async def benchmark(args):
+    documents = load_documents(args.docs)
+    if not documents:
+        print(f"No PDFs found in {args.docs}")
+        return
+    chunker = TokenChunker(args.max_tokens, args.overlap)
+    embedder = EmbeddingService(args.model)
+    print(f"Embedding with {embedder.version}; token chunker at {chunker.max_tokens} tokens, "
+          f"{chunker.overlap_tokens} overlap; hit@{args.k} / MRR@{args.k} over known-item queries")
+
+    header = f"{'document':<22} {'layout':<7} {'chunker':<8} {'chunks':>7} {'tokens':>9} {'mean':>6} {'max':>6} " \
+             f"{'requests':>9} {'hit@k':>6} {'MRR':>6} {'chunk ms':>9}"
+    print()
+    print(header)
+    for filename, stored_text in documents.items():
+        queries = make_queries(stored_text, args.queries, args.seed)
+        # "flat" is the same text without blank lines, as OCR output and many text files come
+        for layout, text in (("stored", stored_text), ("flat", re.sub(r'\n\s*\n', '\n', stored_text))):
+            for name, split in (("legacy", legacy_text_to_chunks), ("token", chunker.split)):
+                started = time.perf_counter()
+                chunks = split(text)
+                seconds = time.perf_counter() - started
+                row = await evaluate(name, chunks, queries, embedder, chunker, args.k, seconds)
+                print(f"{filename:<22} {layout:<7} {name:<8} {row['chunks']:>7} {row['tokens']:>9} "
+                      f"{row['mean_tokens']:>6.0f} {row['max_tokens']:>6} {row['requests']:>9} "
+                      f"{row['hit']:>6.2f} {row['mrr']:>6.2f} {row['chunk_ms']:>9.1f}")
+    print("\nEach chunk is one embedding input and one MongoDB row; requests is the number of packed "
+          "embedding calls EmbeddingService makes for the document.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the token-budgeted chunker with the legacy text_to_chunks")
+    parser.add_argument("--docs", default="test_docs", help="Directory of PDFs to chunk")
+    parser.add_argument("--model", default=EMBEDDING_MODEL, help="Embedding model (local-hashing runs offline)")
+    parser.add_argument("--max-tokens", type=int, default=CHUNK_MAX_TOKENS)
+    parser.add_argument("--overlap", type=int, default=CHUNK_OVERLAP_TOKENS)
+    parser.add_argument("--queries", type=int, default=50, help="Known-item queries per document")
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    asyncio.run(benchmark(args))
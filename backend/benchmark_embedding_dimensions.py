@@ -0,0 +1,139 @@
+import argparse
+import asyncio
+import glob
+import os
+import random
+import re
+import time
+
+import fitz  # PyMuPDF
+import numpy as np
+from dotenv import load_dotenv
+
+# Load environment variables from .env
+load_dotenv()
+
+from app.services.ingestion_pipeline import page_chunks
+from app.utils.embeddings import EmbeddingService
+from app.utils.similarity import normalize_rows, top_k_indices
+
+
+def load_chunks(docs_dir: str, max_chunks: int) -> list:
+    """Chunk every PDF in docs_dir the way streamed uploads are chunked."""
+    chunks = []
+    for path in sorted(glob.glob(os.path.join(docs_dir, "*.pdf"))):
+        with fitz.open(path) as doc:
+            for page in doc:
+                chunks.extend(chunk for chunk, _ in page_chunks(page.get_text()))
+        print(f"{os.path.basename(path)}: {len(chunks)} chunks so far")
+    return chunks[:max_chunks] if max_chunks else chunks
+
+
+def make_queries(chunks: list, count: int, seed: int) -> list:
+    """Known-item queries: the first sentence (at most 200 characters) of randomly chosen chunks."""
+    rng = random.Random(seed)
+    picked = rng.sample(range(len(chunks)), min(count, len(chunks)))
+    queries = []
+    for i in picked:
+        sentence = re.split(r'(?<=[.!?])\s+', chunks[i].strip(), maxsplit=1)[0]
+        queries.append(sentence[:200])
+    return queries
+
+
+async def embed_matrix(texts: list, model: str, dimensions: int) -> np.ndarray:
+    return normalize_rows(await EmbeddingService(model, dimensions).embed(texts))
+
+
+def truncate(matrix: np.ndarray, dimensions: int) -> np.ndarray:
+    """Shorten full vectors locally (text-embedding-3 vectors keep their meaning when truncated and renormalized)."""
+    return normalize_rows(np.ascontiguousarray(matrix[:, :dimensions]))
+
+
+async def request_latency(queries: list, model: str, dimensions: int, samples: int) -> list:
+    """Wall-clock milliseconds of uncached single-query embedding requests."""
+    timings = []
+    embedder = EmbeddingService(model, dimensions, cache=False)
+    for text in queries[:samples]:
+        started = time.perf_counter()
+        await embedder.embed_one(text)
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings
+
+
+def top_k_sets(corpus: np.ndarray, queries: np.ndarray, k: int) -> list:
+    return [set(top_k_indices(corpus @ q, k).tolist()) for q in queries]
+
+
+def search_ms(corpus: np.ndarray, queries: np.ndarray, k: int, repeats: int = 5) -> float:
+    started = time.perf_counter()
+    for _ in range(repeats):
+        for q in queries:
+            top_k_indices(corpus @ q, k)
+    return (time.perf_counter() - started) * 1000 / (repeats * len(queries))
+
+
+async def benchmark(args):
+    chunks = load_chunks(args.docs, args.max_chunks)
+    if not chunks:
+        print(f"No PDF chunks found in {args.docs}")
+        return
+    queries = make_queries(chunks, args.queries, args.seed)
+    ks = sorted(int(k) for k in args.k.split(","))
+    dimensions = sorted(int(d) for d in args.dimensions.split(",") if int(d) < args.full)
+    print(f"{len(chunks)} chunks, {len(queries)} queries, model {args.model}, baseline {args.full} dimensions")
+
+    full_corpus = await embed_matrix(chunks, args.model, args.full)
+    full_queries = await embed_matrix(queries, args.model, args.full)
+    truth = {k: top_k_sets(full_corpus, full_queries, k) for k in ks}
+
+    rows = []
+    for dims in dimensions + [args.full]:
+        if dims == args.full:
+            corpus, query_matrix = full_corpus, full_queries
+        elif args.truncate:
+            corpus, query_matrix = truncate(full_corpus, dims), truncate(full_queries, dims)
+        else:
+            corpus = await embed_matrix(chunks, args.model, dims)
+            query_matrix = await embed_matrix(queries, args.model, dims)
+
+        recalls = {}
+        for k in ks:
+            found = top_k_sets(corpus, query_matrix, k)
+            recalls[k] = float(np.mean([len(f & t) / k for f, t in zip(found, truth[k])]))
+        latency = await request_latency(queries, args.model, dims, args.latency_samples) if args.latency_samples else []
+        rows.append({
+            "dims": dims,
+            "recalls": recalls,
+            "search_ms": search_ms(corpus, query_matrix, max(ks)),
+            "embed_p50": float(np.percentile(latency, 50)) if latency else None,
+            "embed_p95": float(np.percentile(latency, 95)) if latency else None,
+            "mb_per_million": dims * 4 * 1_000_000 / (1024 * 1024),
+        })
+
+    header = f"{'dims':>6} " + " ".join(f"{'recall@' + str(k):>10}" for k in ks) + \
+        f" {'search ms':>10} {'embed p50':>10} {'embed p95':>10} {'MB/1M chunks':>13}"
+    print()
+    print(header)
+    for row in rows:
+        p50 = f"{row['embed_p50']:.0f}" if row["embed_p50"] is not None else "-"
+        p95 = f"{row['embed_p95']:.0f}" if row["embed_p95"] is not None else "-"
+        print(f"{row['dims']:>6} " + " ".join(f"{row['recalls'][k]:>10.3f}" for k in ks) +
+              f" {row['search_ms']:>10.3f} {p50:>10} {p95:>10} {row['mb_per_million']:>13.0f}")
+    print("\nRecall is measured against the top-k of the full-size vectors; search ms is per query over this corpus.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recall and latency of reduced-dimension embeddings against full-size vectors")
+    parser.add_argument("--docs", default="test_docs", help="Directory of PDFs to use as the corpus")
+    parser.add_argument("--model", default="text-embedding-3-small", help="A text-embedding-3 model")
+    parser.add_argument("--full", type=int, default=1536, help="Baseline (full) dimensions")
+    parser.add_argument("--dimensions", default="256,512,1024", help="Comma-separated reduced sizes to compare")
+    parser.add_argument("--k", default="5,10", help="Comma-separated k values for recall@k")
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--max-chunks", type=int, default=5000, help="0 = use every chunk")
+    parser.add_argument("--latency-samples", type=int, default=10, help="Uncached embedding requests timed per size (0 = skip)")
+    parser.add_argument("--truncate", action="store_true",
+                        help="Derive reduced vectors by truncating the full ones instead of requesting each size")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    asyncio.run(benchmark(args))
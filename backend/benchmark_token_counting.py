@@ -0,0 +1,75 @@
+import argparse
+import asyncio
+import time
+
+from dotenv import load_dotenv
+
+# Load environment variables from .env
+load_dotenv()
+
+from app.config import TOKEN_COUNT_MODEL, TOKEN_COUNT_SHARD_CHARS, TOKEN_COUNT_WORKERS
+from app.utils.chunking import PAGE_SEPARATOR, document_chunker
+from app.utils.token_counter import TokenCounter
+from benchmark_chunker_scaling import generate_pages
+
+
+async def measure(label: str, work) -> None:
+    """Run `work` while a ticker on the same event loop records its longest stall."""
+    stalls = []
+    done = asyncio.Event()
+
+    async def ticker():
+        while not done.is_set():
+            before = time.perf_counter()
+            await asyncio.sleep(0.01)
+            stalls.append(time.perf_counter() - before - 0.01)
+
+    tick = asyncio.create_task(ticker())
+    await asyncio.sleep(0)  # let the ticker start its first sleep
+    started = time.perf_counter()
+    result = await work()
+    seconds = time.perf_counter() - started
+    done.set()
+    await tick
+    print(f"{label:<34} {result:>12} {seconds:>9.2f} {max(stalls, default=0.0) * 1000:>14.0f}")
+
+
+async def benchmark(args):
+    text = PAGE_SEPARATOR.join(generate_pages(args.layout, int(args.size_mb * 1024 * 1024), args.seed))
+    chunks = document_chunker.split(text)
+    pooled = TokenCounter(args.model, workers=args.workers, shard_chars=args.shard_chars)
+    print(f"{args.size_mb:g} MB of '{args.layout}' text, {len(chunks)} chunks; {args.workers} counting processes")
+    print()
+    print(f"{'run':<34} {'tokens':>12} {'seconds':>9} {'max stall ms':>14}")
+
+    async def inline_document():
+        return pooled.count_local(text)
+
+    async def inline_chunks():
+        return sum(pooled.count_local(chunk) for chunk in chunks)
+
+    await measure("document, on the event loop", inline_document)
+    # The first pooled run also pays for starting the processes
+    await measure("document, pool (cold)", lambda: pooled.count(text))
+    await measure("document, pool", lambda: pooled.count(text))
+    await measure("chunks, on the event loop", inline_chunks)
+    await measure("chunks, pool", lambda: _sum(pooled.count_many(chunks)))
+    await measure("chunks again, cached", lambda: _sum(pooled.count_many(chunks)))
+    pooled.shutdown()
+    print("\nMax stall is the longest time the event loop could not serve other requests.")
+
+
+async def _sum(counts) -> int:
+    return sum(await counts)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Token counting on the event loop vs the sharded process pool")
+    parser.add_argument("--size-mb", type=float, default=50)
+    parser.add_argument("--layout", default="ocr", help="Page layout from benchmark_chunker_scaling")
+    parser.add_argument("--model", default=TOKEN_COUNT_MODEL)
+    parser.add_argument("--workers", type=int, default=TOKEN_COUNT_WORKERS)
+    parser.add_argument("--shard-chars", type=int, default=TOKEN_COUNT_SHARD_CHARS)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    asyncio.run(benchmark(args))
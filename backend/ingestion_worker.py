@@ -0,0 +1,34 @@
+import argparse
+import asyncio
+import logging
+
+from dotenv import load_dotenv
+
+# Load environment variables from .env
+load_dotenv()
+
+from app.config import INGESTION_WORKERS
+from app.services.ingestion_jobs import IngestionWorkerPool
+from app.utils.token_counter import token_counter
+
+
+async def run_workers(workers: int):
+    """Process queued ingestion jobs until interrupted; crashed jobs are resumed when their lease lapses."""
+    pool = IngestionWorkerPool(workers=workers)
+    print(f"Ingestion worker {pool.worker_id} running {workers} concurrent jobs")
+    try:
+        await pool.run_forever()
+    finally:
+        await pool.stop()
+        token_counter.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run document ingestion workers outside the API process.")
+    parser.add_argument("--workers", type=int, default=INGESTION_WORKERS, help="Concurrent jobs in this process")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(run_workers(args.workers))
+    except KeyboardInterrupt:
+        print("Stopped.")
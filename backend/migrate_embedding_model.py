@@ -0,0 +1,50 @@
+import argparse
+import asyncio
+import time
+
+from dotenv import load_dotenv
+
+# Load environment variables from .env
+load_dotenv()
+
+from app.config import EMBEDDING_MIGRATION_CONCURRENCY
+from app.db.mongodb import embeddings_collection
+from app.services.embedding_migration import EmbeddingMigration, stale_rows_filter
+
+
+async def migrate_embedding_model(model: str, dimensions: int, concurrency: int,
+                                  max_documents: int, dry_run: bool):
+    """
+    Re-embed stored chunks with another embedding model. Safe to stop and re-run:
+    progress is checkpointed per document and the next run resumes from the checkpoint.
+    """
+    migration = EmbeddingMigration(model, dimensions or None, concurrency)
+    remaining = await embeddings_collection.count_documents(stale_rows_filter(migration.target_version))
+    print(f"{remaining} chunk rows to re-embed as {migration.target_version}")
+    if dry_run or not remaining:
+        return
+
+    started = time.time()
+    status = await migration.run(max_documents or None)
+    if status is None:
+        print("Migration already completed or running in another process")
+        return
+    print(f"{status['state']}: {status['documents_done']} documents, {status['chunks_done']} chunks re-embedded, "
+          f"{len(status['failed'])} failed ({time.time() - started:.1f}s)")
+    for key in status["failed"]:
+        print(f"  failed: {key}")
+    if status["state"] == "completed":
+        print(f"Set EMBEDDING_MODEL={model}" + (f" and EMBEDDING_DIMENSIONS={dimensions}" if dimensions else "") +
+              " and restart the API so new uploads and prompts use the new model")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-embed stored document chunks with a new embedding model")
+    parser.add_argument("--model", required=True, help="Target embedding model, e.g. text-embedding-3-small")
+    parser.add_argument("--dimensions", type=int, default=0, help="Reduced size for text-embedding-3 models (0 = model default)")
+    parser.add_argument("--concurrency", type=int, default=EMBEDDING_MIGRATION_CONCURRENCY,
+                        help="Embedding requests in flight")
+    parser.add_argument("--max-documents", type=int, default=0, help="Pause after this many documents (0 = run to the end)")
+    parser.add_argument("--dry-run", action="store_true", help="Only count the rows to re-embed")
+    args = parser.parse_args()
+    asyncio.run(migrate_embedding_model(args.model, args.dimensions, args.concurrency, args.max_documents, args.dry_run))
@@ -0,0 +1,60 @@
+import argparse
+import asyncio
+import time
+
+from dotenv import load_dotenv
+from pymongo import UpdateOne
+
+# Load environment variables from .env
+load_dotenv()
+
+from app.config import EMBEDDING_STORAGE_DTYPE
+from app.db.mongodb import embeddings_collection
+from app.utils.embedding_codec import STORAGE_DTYPES, encode_embedding
+
+# Rows still stored as arrays of doubles have no embedding_dtype field
+LEGACY_QUERY = {"embedding_dtype": {"$exists": False}, "embedding.0": {"$exists": True}}
+
+
+async def migrate_embeddings(storage_dtype: str, batch_size: int, dry_run: bool):
+    """
+    Re-encode legacy embeddings_collection rows as packed Binary vectors.
+    Safe to stop and re-run: each batch only touches rows that are still in the legacy format.
+    """
+    remaining = await embeddings_collection.count_documents(LEGACY_QUERY)
+    print(f"{remaining} embedding rows to convert to {storage_dtype}")
+    if dry_run or not remaining:
+        return
+
+    converted = 0
+    started = time.time()
+    last_id = None
+    while True:
+        query = dict(LEGACY_QUERY)
+        if last_id is not None:
+            query["_id"] = {"$gt": last_id}
+        rows = await embeddings_collection.find(query, {"embedding": 1}) \
+            .sort("_id", 1).limit(batch_size).to_list(length=batch_size)
+        if not rows:
+            break
+
+        updates = [
+            UpdateOne({"_id": row["_id"], "embedding_dtype": {"$exists": False}},
+                      {"$set": encode_embedding(row["embedding"], storage_dtype)})
+            for row in rows
+        ]
+        result = await embeddings_collection.bulk_write(updates, ordered=False)
+        converted += result.modified_count
+        last_id = rows[-1]["_id"]
+        print(f"Converted {converted}/{remaining} rows ({time.time() - started:.1f}s)")
+
+    print(f"Done: converted {converted} rows in {time.time() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert stored embeddings to packed binary vectors")
+    parser.add_argument("--dtype", choices=sorted(STORAGE_DTYPES), default=EMBEDDING_STORAGE_DTYPE)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--dry-run", action="store_true", help="Only count the rows to convert")
+    args = parser.parse_args()
+    asyncio.run(migrate_embeddings(args.dtype, args.batch_size, args.dry_run))